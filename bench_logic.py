@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Times logic.handle() per command, on sessions like the one in TestSequences.test_make_reference (everybody joins,
+# then the current player asks /show_random, draws /random, and the chosen one does /do_w), in rooms of 2 to 5000
+# players. Also times to_dict(), from_dict() and saving everything (what BotState.save_ongoing_games() does) for fleets
+# of 1 to 100k chats. All numbers are nanoseconds per call, respectively per chat.
+#
+# --save FILE stores the results as a JSON baseline; --compare FILE prints the change against such a baseline and
+# exits with 1 if anything got slower by more than --threshold.
+
+import argparse
+import games
+import json
+import logic
+import os
+import platform
+import storage
+import sys
+import tempfile
+import time
+
+ROOM_SIZES = [2, 10, 100, 1000, 5000]
+ROUNDS = 200
+FLEET_SIZES = [1, 100, 10000, 100000]
+FLEET_PLAYERS = 5
+FLEET_ROUNDS = 10
+FLEET_TEMPLATES = 100  # Distinct games; larger fleets repeat them under other chat ids
+SEED = 'Static seed for reproducible benchmarks, do not change'
+REPEAT = 3  # Every number is the best of this many runs
+BASELINE_VERSION = 1
+
+
+def player(i):
+    """Returns (firstname, username, user id) of player i, like handle() gets them."""
+    return f'Firstname {i}', f'username_{i}', 1000000000 + i
+
+
+def play_session(game, num_players, num_rounds, timings=None):
+    """Plays the session on game. If timings is given, adds (total ns, calls) per command to it."""
+    def observe(command, argument, i):
+        if timings is None:
+            return logic.handle(game, command, argument, *player(i))
+        begin = time.perf_counter_ns()
+        tuple_out = logic.handle(game, command, argument, *player(i))
+        duration = time.perf_counter_ns() - begin
+        total, calls = timings.get(command, (0, 0))
+        timings[command] = (total + duration, calls + 1)
+        return tuple_out
+
+    for i in range(num_players):
+        observe('join', '', i)
+    current = 0
+    for _ in range(num_rounds):
+        observe('show_random', '', current)
+        tuple_out = observe('random', '', current)
+        assert tuple_out[0] == 'random_chosen', tuple_out
+        observe('whytho', '', current)
+        chosen = int(tuple_out[1].split('_')[1])
+        observe('do_w', '', chosen)
+        observe('players', '', chosen)
+        current = chosen
+
+
+def best(results, name, ns):
+    results[name] = min(ns, results.get(name, ns))
+
+
+def bench_rooms(room_sizes, results):
+    for num_players in room_sizes:
+        for _ in range(REPEAT):
+            # Same seed, so each run plays the same session.
+            timings = dict()
+            play_session(logic.OngoingGame(f'{SEED} {num_players}'), num_players, ROUNDS, timings)
+            for command, (total, calls) in timings.items():
+                best(results, f'handle {command} players={num_players}', total / calls)
+        report(results, f'players={num_players}')
+
+
+def make_fleet(num_chats):
+    templates = []
+    for t in range(min(num_chats, FLEET_TEMPLATES)):
+        game = logic.OngoingGame(f'{SEED} {t}')
+        play_session(game, FLEET_PLAYERS, FLEET_ROUNDS)
+        templates.append(game.to_dict())
+    return {-1000000 - i: logic.OngoingGame.from_dict(templates[i % len(templates)]) for i in range(num_chats)}
+
+
+def save(fleet):
+    # Like BotState.save_ongoing_games(), but synchronous, and into a temporary directory.
+    with tempfile.TemporaryDirectory() as dirname:
+        target = storage.SnapshotStorage(os.path.join(dirname, 'data.json'), os.path.join(dirname, 'data.journal'), 1000)
+        store = games.GameStore(target)
+        for chat_id, game in fleet.items():
+            store[chat_id] = game
+        begin = time.perf_counter_ns()
+        game_dicts, versions = store.collect_all()
+        target.write_all(game_dicts)
+        store.mark_saved(versions)
+        duration = time.perf_counter_ns() - begin
+        target.close()
+    return duration
+
+
+def bench_fleets(fleet_sizes, results):
+    for num_chats in fleet_sizes:
+        fleet = make_fleet(num_chats)
+        for _ in range(REPEAT):
+            begin = time.perf_counter_ns()
+            game_dicts = [game.to_dict() for game in fleet.values()]
+            best(results, f'to_dict chats={num_chats}', (time.perf_counter_ns() - begin) / num_chats)
+            game_dicts = json.loads(json.dumps(game_dicts))  # Like after a restart
+            begin = time.perf_counter_ns()
+            for game_dict in game_dicts:
+                logic.OngoingGame.from_dict(game_dict)
+            best(results, f'from_dict chats={num_chats}', (time.perf_counter_ns() - begin) / num_chats)
+            best(results, f'save chats={num_chats}', save(fleet) / num_chats)
+        report(results, f'chats={num_chats}')
+
+
+def report(results, suffix):
+    for name, ns in results.items():
+        if name.endswith(f' {suffix}'):
+            print(f'{name:40} {ns:14.0f}')
+    sys.stdout.flush()
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of each result against the baseline, and returns the names of the regressions."""
+    regressions = []
+    print(f'{"benchmark":40} {"baseline_ns":>14} {"now_ns":>14} {"change":>8}')
+    for name, ns in results.items():
+        if name not in baseline:
+            print(f'{name:40} {"-":>14} {ns:14.0f}')
+            continue
+        change = ns / baseline[name] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  <- REGRESSION'
+        print(f'{name:40} {baseline[name]:14.0f} {ns:14.0f} {change:+8.1%}{flag}')
+    return regressions
+
+
+def run(args):
+    results = dict()
+    print(f'{"benchmark":40} {"ns":>14}')
+    bench_rooms([n for n in ROOM_SIZES if n <= args.max_players], results)
+    bench_fleets([n for n in FLEET_SIZES if n <= args.max_chats], results)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(dict(version=BASELINE_VERSION, python=platform.python_version(), results=results), fp, indent=1)
+        print(f'Saved {len(results)} results to {args.save}.')
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('version') != BASELINE_VERSION:
+            print(f'Baseline {args.compare} has version {baseline.get("version")}, expected {BASELINE_VERSION}.')
+            return 1
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmarks got slower by more than {args.threshold:.0%}.')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks logic.handle() and saving the games.')
+    parser.add_argument('--save', metavar='FILE', help='store the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown that counts as a regression')
+    parser.add_argument('--max-players', type=int, default=max(ROOM_SIZES), help='skip larger rooms')
+    parser.add_argument('--max-chats', type=int, default=max(FLEET_SIZES), help='skip larger fleets')
+    exit(run(parser.parse_args()))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Measures the memory that games take after being loaded from a snapshot, in bytes per joined player. The players of
+# all chats come from one population, so the same usernames appear in several chats, like in the real bot.
+#
+# --dense loads the individual trackers in the legacy dense layout instead: one GenerationTracker per player,
+# with an entry for every other player, like in fuzz.DensePairs, from the dicts of PairTracker.to_legacy_dict(). The
+# rest of the game is loaded as usual, so the difference is what PairTracker saves.
+#
+# The "before" column in the log of "Slot the game objects and intern player names" (b218f72) was measured with the
+# bench_memory.py of that commit, on a checkout of its parent:
+#     git worktree add /tmp/before b218f72^ && git show b218f72:bench_memory.py > /tmp/before/bench_memory.py
+#     cp secret.py /tmp/before && cd /tmp/before && python3 bench_memory.py
+# which prints 1838, 1655 and 1652 bytes per player. The current bench_memory.py no longer runs there, as players have
+# been keyed by user id since.
+
+from generation import GenerationTracker
+import json
+import logic
+import random
+import sys
+import tracemalloc
+
+SCENARIOS = [
+    # (players per chat, number of chats)
+    (10, 1000),
+    (100, 100),
+    (1000, 10),
+]
+POPULATION = 5000
+ROUNDS_PER_PLAYER = 5
+
+
+def make_game_dicts(num_players, num_chats):
+    rng = random.Random(f'{num_players} {num_chats}')
+    game_dicts = []
+    for i in range(num_chats):
+        game = logic.OngoingGame(i)
+        for user in rng.sample(range(POPULATION), num_players):
+            game.notify_join(f'username_{user}', f'Firstname {user}', 1000000000 + user)  # Like Telegram user ids
+        keys = list(game.joined_users.keys())
+        for _ in range(ROUNDS_PER_PLAYER * num_players):
+            chooser, chosen = rng.sample(keys, 2)
+            game.notify_chosen(chooser, chosen, 'choose')
+        # Like after a restart: every game comes from its own JSON document.
+        game_dicts.append(json.dumps(game.to_dict()))
+    return game_dicts
+
+
+def to_legacy_json(game_dict):
+    """Returns the individual trackers of a game as JSON, in the legacy dense layout."""
+    track_pairs = logic.OngoingGame.from_dict(json.loads(game_dict)).track_individual
+    return json.dumps({str(key): tracker for key, tracker in track_pairs.to_legacy_dict().items()})
+
+
+def load_dense(game_dict, legacy_json):
+    game = logic.OngoingGame.from_dict(json.loads(game_dict))
+    # Only to be measured, not played.
+    game.track_individual = {int(key): GenerationTracker.from_dict(sub_dict, int)
+                             for key, sub_dict in json.loads(legacy_json).items()}
+    return game
+
+
+def run(dense):
+    print('players chats | bytes_per_player')
+    for num_players, num_chats in SCENARIOS:
+        game_dicts = make_game_dicts(num_players, num_chats)
+        if dense:
+            legacy_jsons = [to_legacy_json(game_dict) for game_dict in game_dicts]
+        tracemalloc.start()
+        if dense:
+            games = [load_dense(game_dict, legacy_json) for game_dict, legacy_json in zip(game_dicts, legacy_jsons)]
+        else:
+            games = [logic.OngoingGame.from_dict(json.loads(game_dict)) for game_dict in game_dicts]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{num_players:7} {num_chats:5} | {size / (num_players * num_chats):16.0f}')
+        del games
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    # No argparse, nor any other imports that intern strings: They shift when the table of interned strings grows,
+    # which is up to ~100 bytes per player.
+    if sys.argv[1:] not in [[], ['--dense']]:
+        print(f'USAGE: {sys.argv[0]} [--dense]')
+        exit(1)
+    run(sys.argv[1:] == ['--dense'])
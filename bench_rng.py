@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Compares the kinds of RNG in randomness.py on the draws that the bot actually makes.
+
+import msg
+import randomness
+import sys
+import time
+
+DRAWS = 100000
+PLAYERS = 10
+
+
+def draw_message(rng):
+    templates = msg.MESSAGES['welcome']
+    for _ in range(DRAWS):
+        rng.choice(templates)
+
+
+def draw_random(rng):
+    # Like logic.compute_random() with the 'shuffle' sampler.
+    weight_tuples = [(f'usna{i}', i + 1) for i in range(PLAYERS)]
+    for _ in range(DRAWS):
+        rng.shuffle(weight_tuples)
+        rng.choices(*zip(*weight_tuples))
+
+
+def draw_true_random(rng):
+    for _ in range(DRAWS):
+        rng.randrange(PLAYERS - 1)
+
+
+def restore(_rng):
+    rng = randomness.GameRandom()
+    for _ in range(randomness.RESEED_WORDS // 2 - 1):
+        rng.random()
+    state = rng.to_dict()
+    for _ in range(DRAWS // 100):
+        randomness.GameRandom.from_dict(state)
+
+
+def measure(fn, arg, repeat=3):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn(arg)
+        duration = time.perf_counter() - begin
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def run():
+    print(f'{"draw":16} {"kind":6} ns_per_draw')
+    for name, fn, draws in [
+            ('message', draw_message, DRAWS),
+            ('random', draw_random, DRAWS),
+            ('true_random', draw_true_random, DRAWS),
+            ('restore', restore, DRAWS // 100),
+        ]:
+        for kind in randomness.KINDS:
+            if fn is restore and kind != 'fast':
+                continue  # Only the fast RNG has any state to restore
+            duration = measure(fn, randomness.make_rng(kind))
+            print(f'{name:16} {kind:6} {duration / draws * 1e9:11.0f}')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    run()
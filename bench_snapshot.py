@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import json
+import logic
+import snapshot
+import sys
+import time
+
+SCENARIOS = [
+    # (number of chats, players per chat, rounds per chat)
+    (1000, 10, 50),
+    (100, 100, 200),
+    (1, 1000, 1000),
+]
+
+
+def make_game(seed, num_players, num_rounds):
+    game = logic.OngoingGame(seed)
+    for i in range(num_players):
+        game.notify_join(f'username_{seed}_{i}', f'Firstname {i}', 1000000000 + seed * 10000 + i)  # Like Telegram user ids
+    keys = list(game.joined_users.keys())
+    for _ in range(num_rounds):
+        chooser, chosen = game.rng.sample(keys, 2)
+        game.notify_chosen(chooser, chosen, 'choose')
+    return game
+
+
+def measure(fn, arg, repeat=3):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = fn(arg)
+        duration = time.perf_counter() - begin
+        best = duration if best is None else min(best, duration)
+    return result, best
+
+
+def run():
+    print('chats players rounds | format    size_bytes  encode_ms  decode_ms')
+    for num_chats, num_players, num_rounds in SCENARIOS:
+        games = {-1000000 - i: make_game(i, num_players, num_rounds).to_dict() for i in range(num_chats)}
+        formats = [
+            ('json', lambda g: json.dumps(g, indent=1).encode(), lambda d: json.loads(d)),
+            ('binary', snapshot.encode, snapshot.decode),
+        ]
+        for name, encode, decode in formats:
+            data, encode_time = measure(encode, games)
+            _, decode_time = measure(decode, data)
+            print(f'{num_chats:5} {num_players:7} {num_rounds:6} | {name:6} {len(data):13} {encode_time * 1000:10.1f} {decode_time * 1000:10.1f}')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    run()
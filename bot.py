@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 # Heavily inspired by chatmemberbot.py in the examples folder.
 
-from atomicwrites import atomic_write
-import json
+import botstate
+import datetime
+import functools
+import games
 import logging
-import os
+import matrix
+import randomness
 import secret  # See secret_template.py
-import secrets
+import storage
 import sys
 from telegram import Chat, ChatMember, ChatMemberUpdated, Update
 from telegram.ext import CallbackContext, ChatMemberHandler, CommandHandler, Updater
@@ -17,32 +20,68 @@ import msg
 
 logger = logging.getLogger(__name__)
 
+# 'json' keeps everything in PERMANENCE_FILENAME and JOURNAL_FILENAME, 'binary' likewise in BINARY_PERMANENCE_FILENAME
+# and JOURNAL_FILENAME, 'sqlite' in SQLITE_FILENAME, 'sharded' has one file per chat in SHARD_DIRNAME.
+STORAGE_KIND = getattr(secret, 'STORAGE_KIND', 'json')
 PERMANENCE_FILENAME = 'wopper_data.json'
+BINARY_PERMANENCE_FILENAME = 'wopper_data.wops'
+JOURNAL_FILENAME = 'wopper_data.journal'
+JOURNAL_COMPACT_EVERY = 1000  # Entries; afterwards the journal is folded into PERMANENCE_FILENAME
+SQLITE_FILENAME = 'wopper_data.sqlite'
+SHARD_DIRNAME = 'wopper_data.d'
+# Games are only read from storage when their chat is first used. If set, at most this many games are kept in memory.
+GAME_CACHE_SIZE = getattr(secret, 'GAME_CACHE_SIZE', None)
+# Games without any activity for this many days are only kept compressed in memory, using 'zlib' or 'lzma'.
+COLD_AFTER_DAYS = getattr(secret, 'COLD_AFTER_DAYS', 30)
+COLD_COMPRESSION = getattr(secret, 'COLD_COMPRESSION', 'zlib')
+COLD_SWEEP_INTERVAL = 3600  # seconds
+# 'fsync' writes every change before replying, 'group' coalesces changes for up to
+# FLUSH_WINDOW seconds or FLUSH_MAX_CHANGES chats, 'periodic' writes every FLUSH_WINDOW seconds.
+PERSISTENCE_MODE = getattr(secret, 'PERSISTENCE_MODE', 'group')
+FLUSH_WINDOW = getattr(secret, 'FLUSH_WINDOW', 0.2)
+FLUSH_MAX_CHANGES = getattr(secret, 'FLUSH_MAX_CHANGES', 100)
+# Where the Bot API lives, e.g. 'http://127.0.0.1:8081/bot' for the stand-in of loadgen.py. Telegram's by default.
+BOT_API_URL = getattr(secret, 'BOT_API_URL', None)
+
+MESSAGE_RNG = randomness.make_rng(logic.RNG)  # Picks the reply templates
+
+
+def make_storage(kind=STORAGE_KIND):
+    if kind == 'json':
+        return storage.SnapshotStorage(PERMANENCE_FILENAME, JOURNAL_FILENAME, JOURNAL_COMPACT_EVERY, 'json')
+    elif kind == 'binary':
+        return storage.SnapshotStorage(BINARY_PERMANENCE_FILENAME, JOURNAL_FILENAME, JOURNAL_COMPACT_EVERY, 'binary')
+    elif kind == 'sqlite':
+        return storage.SqliteStorage(SQLITE_FILENAME)
+    elif kind == 'sharded':
+        return storage.ShardedStorage(SHARD_DIRNAME)
+    else:
+        raise ValueError(f'Unknown storage kind {kind}')
+
 
-ONGOING_GAMES = dict()
+STORAGE = make_storage()
+STATE = botstate.BotState(games.GameStore(STORAGE, GAME_CACHE_SIZE, COLD_COMPRESSION), PERSISTENCE_MODE, FLUSH_WINDOW,
+                          FLUSH_MAX_CHANGES)
+ONGOING_GAMES = STATE.ongoing_games
+STATE_LOCK = STATE.lock  # Guards ONGOING_GAMES and all games in it
 
 
 def load_ongoing_games():
-    global ONGOING_GAMES
-    if os.path.exists(PERMANENCE_FILENAME):
-        with open(PERMANENCE_FILENAME, 'r') as fp:
-            ongoing_games = json.load(fp)
-        for chat_id, game_dict in ongoing_games.items():
-            ONGOING_GAMES[int(chat_id)] = logic.OngoingGame.from_dict(game_dict)
-        logger.info(f'Loaded {len(ONGOING_GAMES)} games.')
-    else:
-        logger.info(f'Permanence file {PERMANENCE_FILENAME} does not exist; starting with all games denied.')
+    with STATE_LOCK:
+        ONGOING_GAMES.load()
+    logger.info(f'Found {len(ONGOING_GAMES)} games.')
 
 
-def save_ongoing_games():
-    ongoing_games = {k: v.to_dict() for k, v in ONGOING_GAMES.items()}
-    with atomic_write(PERMANENCE_FILENAME, overwrite=True) as fp:
-        json.dump(ongoing_games, fp, indent=1)
-    logger.info(f'Wrote {len(ONGOING_GAMES)} to {PERMANENCE_FILENAME}.')
+def with_state_lock(handler):
+    @functools.wraps(handler)
+    def locked_handler(update: Update, context: CallbackContext):
+        with STATE_LOCK:
+            return handler(update, context)
+    return locked_handler
 
 
 def message(msg_id):
-    return secrets.choice(msg.MESSAGES[msg_id])
+    return MESSAGE_RNG.choice(msg.MESSAGES[msg_id])
 
 
 def cmd_admin(update: Update, _context: CallbackContext) -> None:
@@ -58,9 +97,12 @@ def cmd_admin(update: Update, _context: CallbackContext) -> None:
         '\n/permit → permit games in the current room, if not already'
         '\n/deny → stop and deny games in the current room'
         '\n/denyall → stop and deny all games in all rooms'
+        '\n/tiers → show how many games are in memory, compressed, or only on disk, the last snapshot, and cache statistics'
+        '\n/matrix → show who would choose whom with which probability in the current room'
     )
 
 
+@with_state_lock
 def cmd_show_state(update: Update, _context: CallbackContext) -> None:
     if update.effective_user.username != secret.OWNER:
         return
@@ -68,70 +110,61 @@ def cmd_show_state(update: Update, _context: CallbackContext) -> None:
     update.effective_message.reply_text(str(ONGOING_GAMES))
 
 
-def cmd_resetall(update: Update, _context: CallbackContext) -> None:
-    global ONGOING_GAMES
-
+@with_state_lock
+def cmd_tiers(update: Update, _context: CallbackContext) -> None:
     if update.effective_user.username != secret.OWNER:
         return
 
-    for key in ONGOING_GAMES.keys():
-        ONGOING_GAMES[key] = logic.OngoingGame()
-    save_ongoing_games()
-    update.effective_message.reply_text(f'Alle Spiele zurückgesetzt. ({len(ONGOING_GAMES.keys())} erlaubte Räume blieben erhalten.)')
-
+    lines = [f'{tier}: {count} games, {size} bytes' for tier, (count, size) in ONGOING_GAMES.tier_stats().items()]
+    lines.append(f'{ONGOING_GAMES.hydrations} hydrations, {ONGOING_GAMES.evictions} evictions, {ONGOING_GAMES.demotions} demotions so far.')
+    lines.append(STATE.snapshots.stats())
+    lines.append(f'Weight cache: {logic.WEIGHT_CACHE_STATS["hits"]} hits, {logic.WEIGHT_CACHE_STATS["misses"]} misses.')
+    update.effective_message.reply_text('\n'.join(lines))
 
-def cmd_resethere(update: Update, _context: CallbackContext) -> None:
-    global ONGOING_GAMES
 
+@with_state_lock
+def cmd_matrix(update: Update, _context: CallbackContext) -> None:
     if update.effective_user.username != secret.OWNER:
         return
 
-    if update.effective_chat.id in ONGOING_GAMES.keys():
-        ONGOING_GAMES[update.effective_chat.id] = logic.OngoingGame()
-        save_ongoing_games()
-        update.effective_message.reply_text('Spiel in diesem Raum zurückgesetzt. Spieler müssen erneut /join-en.')
-    else:
+    if update.effective_chat.id not in ONGOING_GAMES:
         update.effective_message.reply_text('In diesem Raum sind noch keine Spiele erlaubt. Meintest du /permit?')
-
-
-def cmd_permit(update: Update, _context: CallbackContext) -> None:
-    global ONGOING_GAMES
-
-    if update.effective_user.username != secret.OWNER:
         return
-
-    if update.effective_chat.id in ONGOING_GAMES.keys():
-        update.effective_message.reply_text('In diesem Raum kann man mit mir bereits Spiele spielen. Vielleicht meintest du /reset, /start, oder /join?')
-    else:
-        ONGOING_GAMES[update.effective_chat.id] = logic.OngoingGame()
-        save_ongoing_games()
-        update.effective_message.reply_text('In diesem Raum kann man nun Wahrheit oder Pflicht mit meiner Hilfe spielen. Probier doch mal /start oder /join! :)')
+    usernames, weights = matrix.weight_matrix(ONGOING_GAMES[update.effective_chat.id])
+    if len(usernames) <= 1:
+        update.effective_message.reply_text('Zu wenige Spieler.')
+        return
+    for text in matrix.format_matrix(usernames, weights):
+        update.effective_message.reply_text(text)
 
 
-def cmd_deny(update: Update, _context: CallbackContext) -> None:
-    global ONGOING_GAMES
+def demote_idle_games(_context: CallbackContext) -> None:
+    with STATE_LOCK:
+        ONGOING_GAMES.demote_idle(datetime.timedelta(days=COLD_AFTER_DAYS))
 
-    if update.effective_user.username != secret.OWNER:
-        return
 
-    if update.effective_chat.id in ONGOING_GAMES.keys():
-        del ONGOING_GAMES[update.effective_chat.id]
-        save_ongoing_games()
-        update.effective_message.reply_text('Spiel gelöscht.')
-    else:
-        update.effective_message.reply_text('Spiel ist bereits gelöscht(?)')
+# Replies to the OWNER_COMMANDS, if they changed any chats, and if they didn't. Formatted with the number of chats.
+OWNER_REPLIES = {
+    'resetall': ('Alle Spiele zurückgesetzt. ({} erlaubte Räume blieben erhalten.)',) * 2,
+    'resethere': ('Spiel in diesem Raum zurückgesetzt. Spieler müssen erneut /join-en.',
+                  'In diesem Raum sind noch keine Spiele erlaubt. Meintest du /permit?'),
+    'permit': ('In diesem Raum kann man nun Wahrheit oder Pflicht mit meiner Hilfe spielen. Probier doch mal /start oder /join! :)',
+               'In diesem Raum kann man mit mir bereits Spiele spielen. Vielleicht meintest du /reset, /start, oder /join?'),
+    'deny': ('Spiel gelöscht.',
+             'Spiel ist bereits gelöscht(?)'),
+    'denyall': ('Alle {} Spiele gelöscht.',) * 2,
+}
 
 
-def cmd_denyall(update: Update, _context: CallbackContext) -> None:
-    global ONGOING_GAMES
+def cmd_owner(command):
+    @with_state_lock
+    def cmd_handler(update: Update, _context: CallbackContext) -> None:
+        if update.effective_user.username != secret.OWNER:
+            return
 
-    if update.effective_user.username != secret.OWNER:
-        return
-
-    count = len(ONGOING_GAMES)
-    ONGOING_GAMES = dict()
-    save_ongoing_games()
-    update.effective_message.reply_text(f'Alle {count} Spiele gelöscht.')
+        changed = STATE.apply_owner_command(command, update.effective_chat.id)
+        update.effective_message.reply_text(OWNER_REPLIES[command][0 if changed else 1].format(changed))
+    return cmd_handler
 
 
 def cmd_start(update: Update, _context: CallbackContext) -> None:
@@ -171,8 +204,9 @@ def cmd_start(update: Update, _context: CallbackContext) -> None:
 
 def cmd_random_reply(command):
     def cmd_handler(update: Update, _context: CallbackContext):
-        ongoing_game = ONGOING_GAMES.get(update.effective_chat.id)
-        if ongoing_game is None:
+        with STATE_LOCK:
+            permitted = update.effective_chat.id in ONGOING_GAMES
+        if not permitted:
             return  # No interactions permitted
         update.effective_message.reply_text(
             message(command).format(update.effective_user.first_name, update.effective_user.username, secret.MESSAGES_SHEET)
@@ -187,11 +221,10 @@ def cmd_for(command):
         text = update.message.text.split(' ', 1)
         argument = text[1] if len(text) == 2 else ''
 
-        ongoing_game = ONGOING_GAMES.get(update.effective_chat.id)
-        if ongoing_game is None:
-            return  # No interactions permitted
-        maybe_response = logic.handle(ongoing_game, command, argument, update.effective_user.first_name, update.effective_user.username)
-        save_ongoing_games()
+        with STATE_LOCK:
+            if update.effective_chat.id not in ONGOING_GAMES:
+                return  # No interactions permitted
+            maybe_response = STATE.handle(update.effective_chat.id, command, argument, update.effective_user.first_name, update.effective_user.username, update.effective_user.id)
         if maybe_response is None:
             return  # Don't respond at all
         update.effective_message.reply_text(
@@ -206,43 +239,33 @@ def run():
     logger.info("Alive")
 
     load_ongoing_games()
+    STATE.flusher.start()
 
     # Create the Updater and pass it your bot's token.
-    updater = Updater(secret.TOKEN)
+    updater = Updater(secret.TOKEN, base_url=BOT_API_URL)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
     dispatcher.add_handler(CommandHandler("admin", cmd_admin))
     dispatcher.add_handler(CommandHandler("show_state", cmd_show_state))
-    dispatcher.add_handler(CommandHandler("resetall", cmd_resetall))
-    dispatcher.add_handler(CommandHandler("resethere", cmd_resethere))
-    dispatcher.add_handler(CommandHandler("permit", cmd_permit))
-    dispatcher.add_handler(CommandHandler("deny", cmd_deny))
-    dispatcher.add_handler(CommandHandler("denyall", cmd_denyall))
+    for command in botstate.OWNER_COMMANDS:
+        dispatcher.add_handler(CommandHandler(command, cmd_owner(command)))
+    dispatcher.add_handler(CommandHandler("tiers", cmd_tiers))
+    dispatcher.add_handler(CommandHandler("matrix", cmd_matrix))
 
     dispatcher.add_handler(CommandHandler("start", cmd_start))
-    dispatcher.add_handler(CommandHandler("join", cmd_for('join')))
-    dispatcher.add_handler(CommandHandler("leave", cmd_for('leave')))
-    dispatcher.add_handler(CommandHandler("show_random", cmd_for('show_random')))
-    dispatcher.add_handler(CommandHandler("random", cmd_for('random')))
-    dispatcher.add_handler(CommandHandler("true_random", cmd_for('true_random')))
-    dispatcher.add_handler(CommandHandler("wop", cmd_for('wop')))
-    dispatcher.add_handler(CommandHandler("who", cmd_for('who')))
-    dispatcher.add_handler(CommandHandler("kick", cmd_for('kick')))
-    dispatcher.add_handler(CommandHandler("do_w", cmd_for('do_w')))
-    dispatcher.add_handler(CommandHandler("do_p", cmd_for('do_p')))
-    dispatcher.add_handler(CommandHandler("chicken", cmd_for('chicken')))
-    dispatcher.add_handler(CommandHandler("nope", cmd_for('chicken')))
-    dispatcher.add_handler(CommandHandler("choose", cmd_for('choose')))
-    dispatcher.add_handler(CommandHandler("whytho", cmd_for('whytho')))
-    dispatcher.add_handler(CommandHandler("uptime", cmd_for('uptime')))
-    dispatcher.add_handler(CommandHandler("players", cmd_for('players')))
-    dispatcher.add_handler(CommandHandler("unknown_command", cmd_for('unknown_command')))  # By popular opinion
+    for command in botstate.LOGIC_COMMANDS:
+        dispatcher.add_handler(CommandHandler(command, cmd_for(command)))
+    for alias, command in botstate.ALIASES.items():
+        dispatcher.add_handler(CommandHandler(alias, cmd_for(command)))
 
     for cmd_name in msg.RANDOM_REPLY:
         dispatcher.add_handler(CommandHandler(cmd_name, cmd_random_reply(cmd_name)))
 
+    if COLD_AFTER_DAYS is not None:
+        updater.job_queue.run_repeating(demote_idle_games, COLD_SWEEP_INTERVAL)
+
     # Start the Bot
     # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
     # To reset this, simply pass `allowed_updates=[]`
@@ -254,14 +277,19 @@ def run():
     logger.info("Begin idle loop")
     updater.idle()
 
+    # idle() only returns after a stop signal and after all handlers are done, so this is the last write.
+    STATE.stop()
+    STORAGE.close()
+    logger.info("Flushed all games, bye")
+
 
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         run()
     elif len(sys.argv) == 2 and sys.argv[1] == '--dry-run':
-        print(f'Dry-running from file {PERMANENCE_FILENAME}')
+        print(f'Dry-running from {STORAGE_KIND} storage')
         load_ongoing_games()
-        print(f'Loaded: {ONGOING_GAMES}')
+        print(f'Loaded: {dict(ONGOING_GAMES)}')
     else:
         print(f'USAGE: {sys.argv[0]} [--dry-run]')
         exit(1)
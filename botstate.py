@@ -0,0 +1,130 @@
+#!/bin/false
+# Not for execution
+
+import collections
+import flusher
+import logging
+import logic
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The commands that go to logic.handle(), and their aliases:
+LOGIC_COMMANDS = ['join', 'leave', 'show_random', 'random', 'true_random', 'wop', 'who', 'kick', 'do_w', 'do_p',
+                  'chicken', 'choose', 'whytho', 'uptime', 'players', 'unknown_command']
+ALIASES = {'nope': 'chicken'}
+# The commands that only the owner may use to change which chats are permitted:
+OWNER_COMMANDS = ['resetall', 'resethere', 'permit', 'deny', 'denyall']
+
+
+class BotState:
+    """
+    The permitted chats and their games, and how they get written: Changed games go to the storage through a Flusher,
+    snapshots of all games are written on a SnapshotWriter's thread.
+
+    bot.py has one of these, and replay.py replays recorded commands against another one.
+    """
+
+    def __init__(self, ongoing_games, mode='group', window=0.2, max_changes=100):
+        self.ongoing_games = ongoing_games
+        self.storage = ongoing_games.storage
+        self.lock = threading.RLock()  # Guards ongoing_games and all games in it
+        self.snapshots = flusher.SnapshotWriter()
+        self.saved_snapshots = collections.deque()  # Versions of written snapshots, see save_ongoing_games()
+        self.flusher = flusher.Flusher(self.write_games, mode, window, max_changes)
+
+    def mark_snapshots_saved(self):
+        # Must hold lock.
+        while self.saved_snapshots:
+            self.ongoing_games.mark_saved(self.saved_snapshots.popleft())
+
+    def save_ongoing_games(self, wait=True):
+        """
+        Starts writing a snapshot of all games on the snapshots' thread. If the previous one is still running, waits
+        for it, or returns False without starting one if wait is False.
+        """
+        # Only capturing the games holds lock; encoding and writing them happens on the snapshots' thread. That thread
+        # never takes lock, so that nobody holding it can deadlock with it. Instead, the next capture or flush marks
+        # its games as saved.
+        if not wait and self.snapshots.busy():
+            return False
+        self.snapshots.wait()
+        with self.lock:
+            self.mark_snapshots_saved()
+            ongoing_games, versions = self.ongoing_games.collect_all()
+        write = self.storage.begin_write_all(ongoing_games)
+
+        def write_and_post_versions():
+            write()
+            self.saved_snapshots.append(versions)
+        self.snapshots.start(write_and_post_versions)
+        return True
+
+    def write_games(self, chat_ids, snapshot_requested):
+        # Called by flusher, never concurrently. In 'fsync' mode, that happens in the handlers, while holding lock, so
+        # rather than waiting for a running snapshot, the next flush takes it. The journal has everything in the meantime.
+        with self.lock:
+            changes, versions = self.ongoing_games.collect(chat_ids)
+        if changes:
+            # Even if a snapshot follows, so that the journal stays complete in case the snapshot fails.
+            self.storage.write(changes)
+        with self.lock:
+            self.ongoing_games.mark_saved(versions)
+            self.mark_snapshots_saved()
+        logger.debug(f'Wrote {len(changes)} changed games.')
+        if snapshot_requested or self.storage.wants_snapshot:
+            return not self.save_ongoing_games(wait=self.flusher.mode != 'fsync')
+        return False
+
+    def stop(self):
+        """Writes everything that is left. Call this only after the last command."""
+        self.flusher.stop()
+        self.snapshots.wait()
+        self.flusher.flush()  # In 'fsync' mode, the last snapshot may have been put off while another one was running.
+        self.snapshots.wait()
+
+    def handle(self, chat_id, command, argument, firstname, username, user_id):
+        """
+        Passes one of LOGIC_COMMANDS to logic.handle(), and returns its response. Must hold lock, and the chat must be
+        permitted.
+        """
+        ongoing_game = self.ongoing_games[chat_id]
+        version_before = ongoing_game.version
+        maybe_response = logic.handle(ongoing_game, command, argument, firstname, username, user_id)
+        if ongoing_game.version != version_before:
+            # Most commands (/who, /players, errors, ...) don't change anything, so there's nothing to save.
+            self.flusher.mark_dirty(chat_id)
+        return maybe_response
+
+    def apply_owner_command(self, command, chat_id):
+        """
+        Applies one of OWNER_COMMANDS, in chat_id, and returns how many chats it changed. Must hold lock; checking that
+        the owner sent it is up to the caller.
+        """
+        if command == 'resetall':
+            for key in self.ongoing_games.keys():
+                self.ongoing_games[key] = logic.OngoingGame()
+            # The changes are journaled, too: Until the snapshot is complete, the journal must reflect everything.
+            self.flusher.request_snapshot(self.ongoing_games.keys())
+            return len(self.ongoing_games)
+        elif command == 'denyall':
+            chat_ids = list(self.ongoing_games.keys())
+            self.ongoing_games.clear()
+            self.flusher.request_snapshot(chat_ids)
+            return len(chat_ids)
+        elif command == 'permit':
+            if chat_id in self.ongoing_games:
+                return 0
+            self.ongoing_games[chat_id] = logic.OngoingGame()
+        elif command == 'resethere':
+            if chat_id not in self.ongoing_games:
+                return 0
+            self.ongoing_games[chat_id] = logic.OngoingGame()
+        elif command == 'deny':
+            if chat_id not in self.ongoing_games:
+                return 0
+            del self.ongoing_games[chat_id]
+        else:
+            raise ValueError(f'Unknown owner command {command}')
+        self.flusher.mark_dirty(chat_id)
+        return 1
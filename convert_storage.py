@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import bot
+import logging
+import sys
+
+
+def run(from_kind, to_kind):
+    source = bot.make_storage(from_kind)
+    games = source.load()
+    source.close()
+    destination = bot.make_storage(to_kind)
+    destination.write_all(games)
+    destination.close()
+    print(f'Converted {len(games)} games from {from_kind} to {to_kind} storage.')
+    print(f'Remember to set STORAGE_KIND = \'{to_kind}\' in secret.py.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) == 3:
+        run(sys.argv[1], sys.argv[2])
+    else:
+        print(f'USAGE: {sys.argv[0]} FROM_KIND TO_KIND')
+        print('Kinds are json, binary, sqlite, sharded. For example, to split up wopper_data.json:')
+        print(f'    {sys.argv[0]} json sharded')
+        exit(1)
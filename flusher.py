@@ -0,0 +1,166 @@
+#!/bin/false
+# Not for execution
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MODES = ('fsync', 'group', 'periodic')
+
+
+class Flusher:
+    """
+    Remembers which chats changed, and hands them to write_fn in batches.
+
+    'fsync': every change is written synchronously, before the handler replies.
+    'group': changes are coalesced for up to `window` seconds or `max_changes` chats, whichever comes first.
+    'periodic': changes are written every `window` seconds.
+
+    write_fn is called as write_fn(chat_ids, snapshot_requested), and never concurrently with itself. If it returns True,
+    it had to put off the snapshot, which is then requested again for the next flush.
+    """
+
+    def __init__(self, write_fn, mode='group', window=0.2, max_changes=100):
+        assert mode in MODES, mode
+        self.write_fn = write_fn
+        self.mode = mode
+        self.window = window
+        self.max_changes = max_changes
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock()
+        self.dirty = set()
+        self.snapshot_requested = False
+        self.stopping = False
+        self.thread = None
+
+    def mark_dirty(self, chat_id):
+        with self.cond:
+            self.dirty.add(chat_id)
+            if self.mode == 'group':
+                self.cond.notify()
+        if self.mode == 'fsync':
+            self.flush()
+
+    def request_snapshot(self, chat_ids=()):
+        """Like mark_dirty() for all of chat_ids, plus a snapshot afterwards."""
+        with self.cond:
+            self.dirty.update(chat_ids)
+            self.snapshot_requested = True
+            if self.mode == 'group':
+                self.cond.notify()
+        if self.mode == 'fsync':
+            self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            with self.cond:
+                dirty, self.dirty = self.dirty, set()
+                snapshot_requested, self.snapshot_requested = self.snapshot_requested, False
+            if not dirty and not snapshot_requested:
+                return
+            try:
+                snapshot_put_off = self.write_fn(dirty, snapshot_requested)
+            except BaseException:
+                # Don't lose track of anything, the next flush will try again.
+                with self.cond:
+                    self.dirty.update(dirty)
+                    self.snapshot_requested |= snapshot_requested
+                raise
+            if snapshot_put_off:
+                with self.cond:
+                    self.snapshot_requested = True
+
+    def start(self):
+        if self.mode == 'fsync':
+            return  # Nothing to do in the background
+        self.thread = threading.Thread(target=self.run, name='flusher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if self.mode == 'group':
+                    while not self.dirty and not self.snapshot_requested and not self.stopping:
+                        self.cond.wait()
+                    deadline = time.monotonic() + self.window
+                    while len(self.dirty) < self.max_changes and not self.snapshot_requested and not self.stopping:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                elif not self.stopping:  # periodic
+                    self.cond.wait(self.window)
+                if self.stopping:
+                    return  # stop() does the final flush
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing failed, will retry')
+
+
+class SnapshotWriter:
+    """
+    Runs snapshot writes on a background thread, one at a time, and keeps track of how long they take.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.running_since = None  # time.time() when the current snapshot began, if any
+        self.last_duration = None  # seconds, of the last successful snapshot
+        self.last_finished = None  # time.time() when the last successful snapshot was done
+        self.failures = 0
+
+    def busy(self):
+        """Returns whether a snapshot is still being written."""
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self):
+        """Waits for the current snapshot, if any. Must not be called concurrently with start()."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def start(self, write_fn):
+        """Calls write_fn() in the background, after waiting for the previous snapshot."""
+        self.wait()
+        self.running_since = time.time()
+        self.thread = threading.Thread(target=self.run, args=(write_fn,), name='snapshot', daemon=True)
+        self.thread.start()
+
+    def run(self, write_fn):
+        begin = time.monotonic()
+        try:
+            write_fn()
+        except Exception:
+            self.failures += 1
+            logger.exception('Writing the snapshot failed, will try again with the next one')
+        else:
+            self.last_duration = time.monotonic() - begin
+            self.last_finished = time.time()
+            logger.info(f'Snapshot took {self.last_duration:.3f} seconds.')
+        finally:
+            self.running_since = None
+
+    def stats(self):
+        """Returns a human-readable summary."""
+        now = time.time()
+        if self.last_finished is None:
+            text = 'No snapshot written yet'
+        else:
+            text = f'Last snapshot took {self.last_duration:.3f} seconds, {now - self.last_finished:.0f} seconds ago'
+        if self.running_since is not None:
+            text += f'; one is running for {now - self.running_since:.0f} seconds'
+        if self.failures:
+            text += f'; {self.failures} failed'
+        return text + '.'
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+# Differential fuzzer: Plays random command sequences through logic.handle() on the reference and on a candidate
+# engine, and checks after every command that both gave the same response, and every few commands that to_dict() and
+# compute_weigths_for() of every player agree. Mismatches are shrunk to a minimal sequence and printed in the format of
+# TestSequences.check_sequence(), with the responses of the reference, so they can be pasted into tests.py right away.
+#
+# The reference is DenseGame: OngoingGame's commands on top of the engine as it was before the rewrites, i.e. a dense
+# GenerationTracker per player, players in a plain dict in join order that is searched linearly, no weight cache, and
+# /true_random picking with rng.choice() from the list of the others. The current engine is the candidate 'current'.
+#
+# To fuzz a new tracker or sampler, add a Candidate to CANDIDATES. Games use the seed of check_sequence(), so the
+# sequences are reproducible; sequences are spread over all cores.
+
+import argparse
+import collections
+import collections.abc
+import concurrent.futures
+from generation import GenerationTracker
+import json
+import logic
+import random
+import randomness
+import time
+
+SEED = 'Static seed for reproducible randomness, do not change'  # Like TestSequences.check_sequence()
+NUM_USERS = 8
+# (command, weight); no /uptime, as it depends on the clock.
+COMMANDS = [
+    ('join', 4), ('leave', 1), ('random', 4), ('true_random', 1), ('choose', 2), ('wop', 2), ('do_w', 2), ('do_p', 2),
+    ('chicken', 1), ('who', 1), ('kick', 1), ('players', 1), ('show_random', 1), ('whytho', 1), ('unknown_command', 1),
+]
+IGNORED_KEYS = {'init_datetime', 'last_activity'}  # Depend on the clock
+ALIASES = 0.03  # Share of commands sent under other names, and without user id
+BATCH = 100  # Sequences per task for the worker processes
+
+Mismatch = collections.namedtuple('Mismatch', 'step what expected actual')
+
+
+def make_query(rng, aliases=ALIASES):
+    """
+    Returns a random (command, argument, firstname, username, user_id), as handle() takes them. The sender has other
+    names than usual with a probability of aliases, and equally often no user id.
+    """
+    command = rng.choices(*zip(*COMMANDS))[0]
+    argument = ''
+    if command in ('choose', 'show_random'):
+        other = rng.randrange(NUM_USERS)
+        argument = rng.choice([f'@usna{other}', f'usna{other}', f'fina{other}', f'FINA{other}', '', '@nobody'])
+    user = rng.randrange(NUM_USERS)
+    username, firstname, user_id = f'usna{user}', f'fina{user}', 1000000000 + user
+    variant = rng.random()
+    if variant < aliases:
+        username, firstname = f'usna{user}x', f'fina{user}x'  # Renamed
+    elif variant < 2 * aliases:
+        user_id = None  # Like the tests, or very old clients
+    return command, argument, firstname, username, user_id
+
+
+def make_sequence(seed, length, aliases=ALIASES):
+    rng = random.Random(seed)
+    return [make_query(rng, aliases) for _ in range(length)]
+
+
+def exception_response(e):
+    return ('exception', f'{type(e).__name__}: {e}')
+
+
+def call(fn, *args):
+    """Returns what fn returns, or what it raised, so that exceptions can be compared, too."""
+    try:
+        return fn(*args)
+    except Exception as e:
+        return exception_response(e)
+
+
+def copy_rng(rng):
+    copy = randomness.GameRandom(0, reseed=False)
+    copy.setstate(rng.getstate())
+    copy.seed_value, copy.words, copy.reseed_after = rng.seed_value, rng.words, rng.reseed_after
+    return copy
+
+
+class DenseRegistry(collections.abc.Mapping):
+    """The players like players.PlayerRegistry has them, but only as a dict key -> (username, firstname)."""
+
+    def __init__(self):
+        self.entries = dict()  # In join order
+
+    def __getitem__(self, key):
+        return self.entries[key][1]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def to_dict(self):
+        return {str(key): list(entry) for key, entry in self.entries.items()}
+
+    def username(self, key):
+        return self.entries[key][0]
+
+    def add(self, key, username, firstname):
+        if key is None:
+            key = min([key for key in self.entries if key < 0], default=0) - 1
+        self.entries[key] = (username, firstname)
+        return key
+
+    def remove(self, key):
+        del self.entries[key]
+
+    def rename(self, key, username, firstname):
+        self.entries[key] = (username, firstname)
+
+    def rekey(self, mapping):
+        self.entries = {mapping.get(key, key): entry for key, entry in self.entries.items()}
+
+    def find_by_username(self, username):
+        keys = [key for key, entry in self.entries.items() if entry[0] == username]
+        return keys[-1] if keys else None  # The last one to join
+
+    def find_by_firstname(self, firstname):
+        for matches in [lambda fina: fina == firstname, lambda fina: fina.casefold() == firstname.casefold()]:
+            for key, (_, fina) in self.entries.items():
+                if matches(fina):
+                    return key
+        return None
+
+    @property
+    def roster(self):
+        return sorted(fina for _, fina in self.entries.values())
+
+    def render_roster(self):
+        roster = self.roster
+        return f'{", ".join(roster[:-1])} und {roster[-1]}'
+
+    def pick_other(self, rng, key):
+        return rng.choice([other for other in self.entries if other != key])
+
+
+class DensePairs:
+    """One GenerationTracker per player, like OngoingGame.track_individual used to be."""
+
+    def __init__(self):
+        self.trackers = dict()  # key to GenerationTracker, in join order
+
+    def notify_join(self, key):
+        new_tracker = GenerationTracker()
+        for other_key, other_tracker in self.trackers.items():
+            new_tracker.notify_join(other_key)
+            other_tracker.notify_join(key)
+        self.trackers[key] = new_tracker
+
+    def notify_leave(self, key):
+        del self.trackers[key]
+        for other_tracker in self.trackers.values():
+            other_tracker.notify_leave(key)
+
+    def notify_chosen(self, chooser, chosen):
+        self.trackers[chooser].notify_chosen(chosen)
+
+    def get_weights(self, key, additive_offset=None):
+        return self.trackers[key].get_weights(additive_offset)
+
+    def rekey(self, mapping):
+        self.trackers = {mapping.get(key, key): tracker for key, tracker in self.trackers.items()}
+        for tracker in self.trackers.values():
+            tracker.rekey(mapping)
+
+    def to_dict(self, convert_key=None):
+        return {convert_key(key): tracker.to_dict(convert_key) for key, tracker in self.trackers.items()}
+
+    def to_legacy_dict(self):
+        return {key: tracker.to_dict() for key, tracker in self.trackers.items()}
+
+
+class DenseGame(logic.OngoingGame):
+    """The reference, see above. Always seeded, and draws like the 'shuffle' sampler."""
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(SEED, 'shuffle')
+        self.joined_users = DenseRegistry()
+        self.track_individual = DensePairs()
+
+    def compute_weigths_for(self, sender):
+        w_overall = self.track_overall.get_weights(0)
+        w_individual = self.track_individual.get_weights(sender, 0)
+        return GenerationTracker.combine_weights(logic.OVERALL_WEIGHT, w_overall, logic.INDIVIDUAL_WEIGHT, w_individual)
+
+
+class Candidate:
+    """Plays the same queries as the reference. As is, that's the current OngoingGame. Override make_game() and
+    handle()."""
+
+    def make_game(self):
+        return logic.OngoingGame(SEED, 'shuffle')
+
+    def handle(self, game, query, reference, expected):
+        """Returns (game, response) after handling query. The reference already did, and responded expected."""
+        return game, logic.handle(game, *query)
+
+
+class UncachedGame(logic.OngoingGame):
+    __slots__ = ()
+
+    def compute_weigths_for(self, sender):
+        self.weight_cache_version = None  # Never hit the cache
+        return super().compute_weigths_for(sender)
+
+
+class Uncached(Candidate):
+    """The weight cache must not change anything."""
+
+    def make_game(self):
+        return UncachedGame(SEED, 'shuffle')
+
+
+class Roundtrip(Candidate):
+    """Saving and loading before every command must not change anything."""
+
+    def handle(self, game, query, reference, expected):
+        restored = logic.OngoingGame.from_dict(json.loads(json.dumps(game.to_dict())))
+        restored.sampler = None  # 'shuffle', whatever SAMPLER is
+        restored.rng = game.rng  # Restoring would enable reseeding, unlike in a seeded game
+        return restored, logic.handle(restored, *query)
+
+
+class Fenwick(Candidate):
+    """
+    sampler.FenwickSampler must draw with exactly the weights of compute_weigths_for(). It uses the random numbers
+    differently, so instead of comparing /random itself, every possible draw is checked against the weights, and then
+    the draw of the reference is copied, along with its RNG.
+    """
+
+    def make_game(self):
+        return logic.OngoingGame(SEED, 'fenwick')
+
+    def handle(self, game, query, reference, expected):
+        if expected[0] != 'random_chosen' or query[0] != 'random':
+            return game, logic.handle(game, *query)
+        command, argument, firstname, username, user_id = query
+        sender = game.identify(user_id, username, firstname)
+        weights = game.compute_weigths_for(sender)
+        total = sum(weights.values())
+        begin = 0
+        for candidate, weight in weights.items():
+            for r in [begin, begin + weight - 1] if weight else []:
+                drawn = game.sampler.draw(sender, FixedRandom(r), logic.OVERALL_WEIGHT, logic.INDIVIDUAL_WEIGHT)
+                if drawn != (candidate, weight, total):
+                    return game, ('draw', r, drawn)
+            begin += weight
+        game.notify_chosen(sender, reference.last_chosen, json.loads(json.dumps(reference.last_reason)))
+        game.rng = copy_rng(reference.rng)
+        return game, ('random_chosen', game.username(reference.last_chosen))
+
+
+class FixedRandom:
+    def __init__(self, r):
+        self.r = r
+
+    def randrange(self, total):
+        return self.r
+
+
+CANDIDATES = {
+    'current': Candidate,
+    'uncached': Uncached,
+    'roundtrip': Roundtrip,
+    'fenwick': Fenwick,
+}
+
+
+def state(game):
+    d = {key: value for key, value in game.to_dict().items() if key not in IGNORED_KEYS}
+    d['track_pairs'] = game.track_individual.to_legacy_dict()  # The only format that dense trackers have, too
+    weights = {key: list(game.compute_weigths_for(key).items()) for key in game.joined_users.keys()}
+    return d, weights
+
+
+def find_mismatch(candidate, queries, check_every=1):
+    """Returns the first Mismatch between the reference and candidate on queries, or None."""
+    reference = DenseGame()
+    game = candidate.make_game()
+    for step, query in enumerate(queries):
+        expected = call(logic.handle, reference, *query)
+        try:
+            game, actual = candidate.handle(game, query, reference, expected)
+        except Exception as e:
+            actual = exception_response(e)
+        if expected != actual:
+            return Mismatch(step, 'response', expected, actual)
+        if step % check_every == check_every - 1 or step == len(queries) - 1:
+            expected_dict, expected_weights = state(reference)
+            try:
+                actual_dict, actual_weights = state(game)
+            except Exception as e:
+                return Mismatch(step, 'state', None, exception_response(e))
+            if expected_dict != actual_dict:
+                return Mismatch(step, 'to_dict', expected_dict, actual_dict)
+            if expected_weights != actual_weights:
+                return Mismatch(step, 'compute_weigths_for', expected_weights, actual_weights)
+    return None
+
+
+def shrink(candidate, queries):
+    """Returns a minimal subsequence of queries that still makes candidate mismatch, with simplified arguments."""
+    def fails(trial):
+        mismatch = find_mismatch(candidate, trial)
+        return None if mismatch is None else trial[:mismatch.step + 1]
+
+    queries = fails(queries)
+    assert queries is not None, 'Not failing in the first place'
+    # Drop chunks of queries, from half of them down to single ones.
+    chunk = len(queries) // 2
+    while chunk >= 1:
+        shrunk = False
+        i = 0
+        while i < len(queries):
+            trial = fails(queries[:i] + queries[i + chunk:])
+            if trial:
+                queries = trial
+                shrunk = True
+            else:
+                i += chunk
+        if not shrunk:
+            chunk //= 2
+    # Prefer queries like in the existing tests: without arguments, and with the usual names.
+    for i, query in enumerate(queries):
+        command, argument, firstname, username, user_id = query
+        user = username.removeprefix('usna').removesuffix('x')
+        for simpler in [(command, '', firstname, username, user_id),
+                        (command, argument, f'fina{user}', f'usna{user}', user_id),
+                        (command, argument, f'fina{user}', f'usna{user}', 1000000000 + int(user))]:
+            if simpler != queries[i]:
+                trial = fails(queries[:i] + [simpler] + queries[i + 1:])
+                if trial and len(trial) == len(queries):
+                    queries = trial
+    return queries
+
+
+def format_sequence(queries):
+    """Returns queries in the format of TestSequences.check_sequence(), with the responses of the reference."""
+    reference = DenseGame()
+    lines = ['self.check_sequence([']
+    for query in queries:
+        lines.append(f'    ({query!r}, {call(logic.handle, reference, *query)!r}),')
+    lines.append('])')
+    return '\n'.join(lines)
+
+
+def fuzz_batch(task):
+    """Runs sequences first_seed, first_seed + 1, ... and returns the (seed, Mismatch) of those that fail."""
+    candidate_name, first_seed, count, length, check_every, aliases = task
+    candidate = CANDIDATES[candidate_name]()
+    failures = []
+    for seed in range(first_seed, first_seed + count):
+        mismatch = find_mismatch(candidate, make_sequence(seed, length, aliases), check_every)
+        if mismatch is not None:
+            failures.append((seed, mismatch))
+    return failures
+
+
+def run(args):
+    tasks = [(args.candidate, args.seed + first, min(BATCH, args.sequences - first), args.length, args.check_every,
+              args.aliases) for first in range(0, args.sequences, BATCH)]
+    begin = time.perf_counter()
+    failures = []
+    sequences = 0
+    with concurrent.futures.ProcessPoolExecutor(args.processes) as executor:
+        for task, batch_failures in zip(tasks, executor.map(fuzz_batch, tasks)):
+            sequences += task[2]
+            failures.extend(batch_failures)
+            if failures and args.stop_early:
+                executor.shutdown(cancel_futures=True)
+                break
+    duration = time.perf_counter() - begin
+    print(f'Candidate {args.candidate}: {sequences} sequences of {args.length} commands in {duration:.1f} seconds '
+          f'({sequences * 60 / duration:.0f} sequences/min, {sequences * args.length / duration:.0f} commands/s), '
+          f'{len(failures)} failed.')
+    if not failures:
+        return 0
+    seed, mismatch = failures[0]
+    print(f'Sequence {seed} first differs in the {mismatch.what} after command {mismatch.step}:')
+    print(f'  reference: {mismatch.expected!r}')
+    print(f'  candidate: {mismatch.actual!r}')
+    candidate = CANDIDATES[args.candidate]()
+    queries = shrink(candidate, make_sequence(seed, args.length, args.aliases))
+    mismatch = find_mismatch(candidate, queries)
+    print(f'Shrunk to {len(queries)} commands, differing in the {mismatch.what}:')
+    print(f'  reference: {mismatch.expected!r}')
+    print(f'  candidate: {mismatch.actual!r}')
+    print(format_sequence(queries))
+    return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares a candidate engine against the reference logic.')
+    parser.add_argument('candidate', choices=sorted(CANDIDATES.keys()))
+    parser.add_argument('--sequences', type=int, default=20000)
+    # Long enough for players to rename, be replaced by someone with their old names, and come back.
+    parser.add_argument('--length', type=int, default=300, help='commands per sequence')
+    parser.add_argument('--seed', type=int, default=0, help='of the first sequence')
+    parser.add_argument('--check-every', type=int, default=1, help='commands between comparing to_dict and weights')
+    parser.add_argument('--aliases', type=float, default=ALIASES, help='share of commands under other names, and '
+                        'without user id')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes; all cores by default')
+    parser.add_argument('--stop-early', action='store_true', help='stop at the first failing batch')
+    exit(run(parser.parse_args()))
@@ -0,0 +1,174 @@
+#!/bin/false
+# Not for execution
+
+import collections
+import collections.abc
+import datetime
+import logic
+import lzma
+import snapshot
+import storage
+import zlib
+
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+class GameStore(collections.abc.MutableMapping):
+    """
+    All permitted chats, as chat_id -> OngoingGame.
+
+    Only the chat ids are read at startup; each game is hydrated from the storage the first time it is accessed.
+    If capacity is set, the least recently used games are evicted again, but only after they have been written.
+    Games that haven't seen any activity for a while can be demoted to the cold tier: They are kept in memory only
+    in compressed form, and are transparently hydrated again when accessed.
+    Only the most recently accessed game is safe from eviction, so don't hold on to games across accesses.
+    Not thread-safe; the bot guards it with STATE_LOCK.
+    """
+
+    def __init__(self, storage, capacity=None, compression='zlib'):
+        self.storage = storage
+        self.capacity = capacity
+        self.compress, self.decompress = COMPRESSORS[compression]
+        self.hydrated = collections.OrderedDict()  # chat_id to OngoingGame, least recently used first
+        self.cold = dict()  # chat_id to compressed record, of games that were demoted after being written
+        self.unhydrated = set()  # Permitted chats that only exist in storage
+        self.saved_versions = dict()  # chat_id to the version of the hydrated game that is in storage
+        self.hydrations = 0
+        self.evictions = 0
+        self.demotions = 0
+
+    def load(self):
+        self.clear()
+        self.unhydrated = set(self.storage.chat_ids())
+
+    def __getitem__(self, chat_id):
+        game = self.hydrated.get(chat_id)
+        if game is not None:
+            self.hydrated.move_to_end(chat_id)
+            return game
+        if chat_id in self.cold:
+            game_dict = snapshot.decode_record(self.decompress(self.cold.pop(chat_id)), 0, None)
+        elif chat_id in self.unhydrated:
+            game_dict = self.storage.load_game(chat_id)
+            self.unhydrated.discard(chat_id)
+        else:
+            raise KeyError(chat_id)
+        game = logic.OngoingGame.from_dict(game_dict)
+        self.hydrated[chat_id] = game
+        self.saved_versions[chat_id] = game.version
+        self.hydrations += 1
+        self.evict()
+        return game
+
+    def __setitem__(self, chat_id, game):
+        self.unhydrated.discard(chat_id)
+        self.cold.pop(chat_id, None)
+        self.hydrated[chat_id] = game
+        self.hydrated.move_to_end(chat_id)
+        self.saved_versions.pop(chat_id, None)  # Not in storage yet
+        self.evict()
+
+    def __delitem__(self, chat_id):
+        if chat_id in self.hydrated:
+            del self.hydrated[chat_id]
+        elif chat_id in self.cold:
+            del self.cold[chat_id]
+        elif chat_id in self.unhydrated:
+            self.unhydrated.discard(chat_id)
+        else:
+            raise KeyError(chat_id)
+        self.saved_versions.pop(chat_id, None)
+
+    def __contains__(self, chat_id):
+        # Overridden so that checking for permission doesn't hydrate the game.
+        return chat_id in self.hydrated or chat_id in self.cold or chat_id in self.unhydrated
+
+    def __iter__(self):
+        return iter(list(self.hydrated.keys()) + list(self.cold.keys()) + list(self.unhydrated))
+
+    def __len__(self):
+        return len(self.hydrated) + len(self.cold) + len(self.unhydrated)
+
+    def clear(self):
+        self.hydrated.clear()
+        self.cold.clear()
+        self.unhydrated.clear()
+        self.saved_versions.clear()
+
+    def __repr__(self):
+        return f'{dict(self.hydrated)} and {len(self.cold)} cold games {sorted(self.cold.keys())} and {len(self.unhydrated)} unhydrated games: {sorted(self.unhydrated)}'
+
+    def is_clean(self, chat_id):
+        return self.saved_versions.get(chat_id) == self.hydrated[chat_id].version
+
+    def evict(self):
+        if self.capacity is None:
+            return
+        excess = len(self.hydrated) - self.capacity
+        # Never evict the most recently used game, as the caller is probably about to modify it.
+        for chat_id in list(self.hydrated.keys())[:-1]:
+            if excess <= 0:
+                break
+            # Dirty games stay until the flusher has written them, and calls mark_saved().
+            if self.is_clean(chat_id):
+                del self.hydrated[chat_id]
+                del self.saved_versions[chat_id]
+                self.unhydrated.add(chat_id)
+                self.evictions += 1
+                excess -= 1
+
+    def collect(self, chat_ids):
+        """Returns the changes for storage.write(), and the versions for mark_saved()."""
+        changes = dict()
+        versions = dict()
+        for chat_id in chat_ids:
+            game = self.hydrated.get(chat_id)
+            if game is not None:
+                changes[chat_id] = game.to_dict()
+                versions[chat_id] = (game, game.version)
+            elif chat_id not in self.unhydrated and chat_id not in self.cold:
+                changes[chat_id] = None
+            # Otherwise it was evicted or demoted, which only happens after it was written.
+        return changes, versions
+
+    def collect_all(self):
+        """Returns the games for storage.write_all(), and the versions for mark_saved()."""
+        games = {chat_id: storage.UNCHANGED for chat_id in self.unhydrated}
+        games.update({chat_id: storage.UNCHANGED for chat_id in self.cold.keys()})
+        versions = dict()
+        for chat_id, game in self.hydrated.items():
+            games[chat_id] = storage.UNCHANGED if self.is_clean(chat_id) else game.to_dict()
+            versions[chat_id] = (game, game.version)
+        return games, versions
+
+    def mark_saved(self, versions):
+        for chat_id, (game, version) in versions.items():
+            # The game might have been replaced in the meantime, e.g. by /resethere.
+            if self.hydrated.get(chat_id) is game:
+                self.saved_versions[chat_id] = version
+        self.evict()
+
+    def demote_idle(self, max_idle):
+        """Compresses all written games that had no activity for max_idle (a timedelta)."""
+        threshold = datetime.datetime.now() - max_idle
+        # Never demote the most recently used game, as the caller is probably about to modify it.
+        for chat_id in list(self.hydrated.keys())[:-1]:
+            game = self.hydrated[chat_id]
+            if game.last_activity < threshold and self.is_clean(chat_id):
+                self.cold[chat_id] = self.compress(snapshot.encode_record(game.to_dict()))
+                del self.hydrated[chat_id]
+                del self.saved_versions[chat_id]
+                self.demotions += 1
+
+    def tier_stats(self):
+        """Returns a dict tier -> (number of games, bytes in memory). Hot games are counted by their encoded size."""
+        hot_bytes = sum(len(snapshot.encode_record(game.to_dict())) for game in self.hydrated.values())
+        cold_bytes = sum(len(record) for record in self.cold.values())
+        return dict(
+            hot=(len(self.hydrated), hot_bytes),
+            cold=(len(self.cold), cold_bytes),
+            unhydrated=(len(self.unhydrated), 0),
+        )
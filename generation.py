@@ -1,41 +1,223 @@
 #!/bin/false
 # Not for execution
 
-DEFAULT_AGE = 3
+DEFAULT_AGE = 3  # Generations that a new player counts as not chosen; see simulate_fairness.py for tuning
+WEIGHT_EXPONENT = 2  # The weight grows with (generations since last chosen) ** WEIGHT_EXPONENT
+
+
+def convert_keys(d, convert_key):
+    if convert_key is None:
+        return dict(d)
+    return {convert_key(key): value for key, value in d.items()}
 
 
 class GenerationTracker:
+    __slots__ = ('last_chosen', 'generation', 'version')
+
     def __init__(self):
         self.last_chosen = dict()
         self.generation = 1
+        self.version = 0  # Bumped on every mutation, never persisted
 
     def get_weights(self, additive_offset=None):
         if additive_offset is None:
             additive_offset = 0
-        return {o: (self.generation - last_time + additive_offset) ** 2 for o, last_time in self.last_chosen.items()}
+        return {o: (self.generation - last_time + additive_offset) ** WEIGHT_EXPONENT for o, last_time in self.last_chosen.items()}
 
     def notify_join(self, option):
         assert option not in self.last_chosen
         self.last_chosen[option] = self.generation - DEFAULT_AGE
+        self.version += 1
 
     def notify_leave(self, option):
         assert option in self.last_chosen
         del self.last_chosen[option]
+        self.version += 1
 
     def notify_chosen(self, chosen_option):
         self.generation += 1
         self.last_chosen[chosen_option] = self.generation
+        self.version += 1
 
-    def to_dict(self):
-        return dict(g=self.generation, lc=self.last_chosen)
+    def rekey(self, mapping):
+        """Replaces options according to mapping, from old to new ones."""
+        self.last_chosen = {mapping.get(o, o): last_time for o, last_time in self.last_chosen.items()}
+        self.version += 1
+
+    def to_dict(self, convert_key=None):
+        # convert_key turns the options into strings for JSON, and back in from_dict().
+        return dict(g=self.generation, lc=convert_keys(self.last_chosen, convert_key))
 
     @staticmethod
-    def from_dict(d):
+    def from_dict(d, convert_key=None):
         gt = GenerationTracker()
         gt.generation = d['g']
-        gt.last_chosen = d['lc']
+        gt.last_chosen = convert_keys(d['lc'], convert_key)
         return gt
 
     @staticmethod
     def combine_weights(coeff1, weights1, coeff2, weights2):
         return {p: coeff1 * w + coeff2 * weights2[p] for p, w in weights1.items() if p in weights2}
+
+
+class Chooser:
+    __slots__ = ('joined', 'generation', 'last_chosen', 'choices')
+
+    def __init__(self, joined):
+        self.joined = joined  # PairTracker.join_seq when this user joined
+        self.generation = 1
+        self.last_chosen = dict()  # username to generation, only for users this one has actually chosen
+        self.choices = []  # [join_seq, count] runs: how often this user chose while join_seq had that value
+
+    def to_dict(self, convert_key=None):
+        return dict(j=self.joined, g=self.generation, lc=convert_keys(self.last_chosen, convert_key), c=[list(run) for run in self.choices])
+
+    @staticmethod
+    def from_dict(d, convert_key=None):
+        c = Chooser(d['j'])
+        c.generation = d['g']
+        c.last_chosen = convert_keys(d['lc'], convert_key)
+        c.choices = [list(run) for run in d['c']]
+        return c
+
+
+class PairTracker:
+    """
+    Tracks for every chooser when they last chose each other player, like a dict username -> GenerationTracker.
+
+    Only pairs that have actually been chosen are stored. Any other pair counts as chosen DEFAULT_AGE generations
+    before it came to be, i.e. before the later of both users joined, which is what GenerationTracker.notify_join()
+    would have stored. To recover the chooser's generation at that time, every chooser counts their choices per join.
+    This makes join and leave independent of the number of players, and the weights exactly the same.
+
+    "Usernames" can be any hashable keys; OngoingGame uses the keys of its PlayerRegistry.
+    """
+
+    __slots__ = ('join_seq', 'choosers', 'chosen_by', 'version')
+
+    def __init__(self):
+        self.join_seq = 0  # Number of joins so far
+        self.choosers = dict()  # username to Chooser, in join order
+        self.chosen_by = dict()  # username to set of usernames that have chosen them
+        self.version = 0  # Bumped on every mutation, never persisted
+
+    def notify_join(self, username):
+        assert username not in self.choosers
+        self.join_seq += 1
+        self.choosers[username] = Chooser(self.join_seq)
+        self.chosen_by[username] = set()
+        self.version += 1
+
+    def notify_leave(self, username):
+        chooser = self.choosers.pop(username)
+        for chosen_username in chooser.last_chosen.keys():
+            self.chosen_by[chosen_username].discard(username)
+        for chooser_username in self.chosen_by.pop(username):
+            del self.choosers[chooser_username].last_chosen[username]
+        self.version += 1
+
+    def notify_chosen(self, chooser_username, chosen_username):
+        chooser = self.choosers[chooser_username]
+        chooser.generation += 1
+        chooser.last_chosen[chosen_username] = chooser.generation
+        self.chosen_by[chosen_username].add(chooser_username)
+        if chooser.choices and chooser.choices[-1][0] == self.join_seq:
+            chooser.choices[-1][1] += 1
+        else:
+            chooser.choices.append([self.join_seq, 1])
+            if len(chooser.choices) > 2 * len(self.choosers):
+                # Compacting leaves at most one run per player, so this is amortized O(1) per choice.
+                self.compact(chooser_username)
+        self.version += 1
+
+    def compact(self, chooser_username):
+        """Merges the runs of choices that no join of another current player separates. Same weights, but bounded by
+        the number of players."""
+        chooser = self.choosers[chooser_username]
+        choices = chooser.choices
+        i = 0
+        compacted = []
+        for username, other in self.choosers.items():  # In join order
+            if username == chooser_username or i == len(choices) or choices[i][0] >= other.joined:
+                continue
+            # All runs before this join only matter in sum, so keep just one.
+            count = 0
+            while i < len(choices) and choices[i][0] < other.joined:
+                seq = choices[i][0]
+                count += choices[i][1]
+                i += 1
+            compacted.append([seq, count])
+        if i < len(choices):
+            compacted.append([choices[-1][0], sum(count for _, count in choices[i:])])
+        chooser.choices = compacted
+
+    def last_chosen(self, chooser_username):
+        """Returns what the chooser's GenerationTracker.last_chosen would be."""
+        chooser = self.choosers[chooser_username]
+        choices = chooser.choices
+        result = dict()
+        i = 0
+        earlier = 0  # Choices made before the current user joined
+        for username, other in self.choosers.items():  # In join order
+            if username == chooser_username:
+                continue
+            while i < len(choices) and choices[i][0] < other.joined:
+                earlier += choices[i][1]
+                i += 1
+            last_time = chooser.last_chosen.get(username)
+            if last_time is None:
+                last_time = 1 + earlier - DEFAULT_AGE
+            result[username] = last_time
+        return result
+
+    def get_weights(self, chooser_username, additive_offset=None):
+        if additive_offset is None:
+            additive_offset = 0
+        generation = self.choosers[chooser_username].generation
+        return {o: (generation - last_time + additive_offset) ** WEIGHT_EXPONENT for o, last_time in self.last_chosen(chooser_username).items()}
+
+    def rekey(self, mapping):
+        """Replaces usernames according to mapping, from old to new ones, keeping the join order."""
+        self.choosers = {mapping.get(username, username): chooser for username, chooser in self.choosers.items()}
+        for chooser in self.choosers.values():
+            chooser.last_chosen = {mapping.get(username, username): last_time for username, last_time in chooser.last_chosen.items()}
+        self.chosen_by = {mapping.get(username, username): {mapping.get(other, other) for other in others} for username, others in self.chosen_by.items()}
+        self.version += 1
+
+    def to_dict(self, convert_key=None):
+        return dict(s=self.join_seq, u={username: chooser.to_dict(convert_key) for username, chooser in convert_keys(self.choosers, convert_key).items()})
+
+    @staticmethod
+    def from_dict(d, convert_key=None):
+        pt = PairTracker()
+        pt.join_seq = d['s']
+        pt.choosers = {username: Chooser.from_dict(sub_dict, convert_key) for username, sub_dict in convert_keys(d['u'], convert_key).items()}
+        pt.chosen_by = {username: set() for username in pt.choosers.keys()}
+        for chooser_username, chooser in pt.choosers.items():
+            for chosen_username in chooser.last_chosen.keys():
+                pt.chosen_by[chosen_username].add(chooser_username)
+        return pt
+
+    def to_legacy_dict(self):
+        """Returns the equivalent of {username: GenerationTracker.to_dict()}, as stored by older versions."""
+        return {username: dict(g=chooser.generation, lc=self.last_chosen(username)) for username, chooser in self.choosers.items()}
+
+    @staticmethod
+    def from_legacy_dict(d):
+        """Takes {username: GenerationTracker.to_dict()}, in join order."""
+        pt = PairTracker()
+        for username in d.keys():
+            pt.notify_join(username)
+        for username, sub_dict in d.items():
+            chooser = pt.choosers[username]
+            chooser.generation = sub_dict['g']
+            if chooser.generation > 1:
+                # When, exactly, is lost; but the pairs that exist now have explicit entries where necessary, and
+                # future pairs only need the sum.
+                chooser.choices = [[pt.join_seq, chooser.generation - 1]]
+            for other_username, last_time in sub_dict['lc'].items():
+                if last_time != 1 - DEFAULT_AGE:
+                    chooser.last_chosen[other_username] = last_time
+                    pt.chosen_by[other_username].add(username)
+        pt.version = 0
+        return pt
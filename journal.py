@@ -0,0 +1,81 @@
+#!/bin/false
+# Not for execution
+
+import json
+import os
+import shutil
+
+
+class Journal:
+    """
+    Append-only log of per-chat state changes, stored next to the snapshot.
+
+    Each line is one JSON object {"c": chat_id, "g": game_dict}, where game_dict is None if the chat was denied.
+    Entries carry the complete state of a single chat, so replaying them is idempotent.
+
+    While a snapshot is being written in the background, the entries it covers are moved aside to old_filename by
+    rotate(), so that new entries can be appended in the meantime. Both files are replayed, old entries first.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.old_filename = filename + '.old'
+        self.entries = 0  # Number of entries since the last rotate()
+
+    def replay(self):
+        """Returns a dict chat_id -> game_dict (or None) with the most recent entry for each chat."""
+        latest = dict()
+        self.replay_file(self.old_filename, latest)
+        self.entries = self.replay_file(self.filename, latest)
+        return latest
+
+    @staticmethod
+    def replay_file(filename, latest):
+        if not os.path.exists(filename):
+            return 0
+        entries = 0
+        good_size = 0
+        with open(filename, 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break  # Torn write, the bot died while appending. Everything before it is fine.
+                entry = json.loads(line)
+                latest[int(entry['c'])] = entry['g']
+                good_size += len(line)
+                entries += 1
+        if good_size != os.path.getsize(filename):
+            # Otherwise, the next append would end up behind the garbage, and be ignored in turn.
+            os.truncate(filename, good_size)
+        return entries
+
+    @staticmethod
+    def encode_fragment(chat_id, fragment):
+        """Returns the entry for a chat, with its game_dict already encoded as compact JSON."""
+        return f'{{"c":{chat_id},"g":{fragment}}}\n'
+
+    def write(self, lines):
+        """Appends already-encoded entries, and makes them durable with a single fsync."""
+        with open(self.filename, 'a') as fp:
+            fp.write(''.join(lines))
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.entries += len(lines)
+
+    def rotate(self):
+        """Starts a new journal. The old entries are kept until drop_old(), which must only be called after all of
+        them have been written to a snapshot."""
+        if os.path.exists(self.filename):
+            if os.path.exists(self.old_filename):
+                # The previous snapshot failed, so its entries are still needed, too.
+                with open(self.old_filename, 'ab') as dst, open(self.filename, 'rb') as src:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.filename)
+            else:
+                os.rename(self.filename, self.old_filename)
+        self.entries = 0
+
+    def drop_old(self):
+        if os.path.exists(self.old_filename):
+            os.remove(self.old_filename)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# End-to-end load test of bot.py without any network: Serves the Bot API locally (see mock_bot_api.py), lets
+# thousands of players in many chats send a realistic mix of commands at a fixed rate, and reports the latency from
+# queueing an update to receiving the bot's reply, and the replies per second that the bot sustained.
+#
+# Set BOT_API_URL = 'http://127.0.0.1:8081/bot' in secret.py, then either start bot.py yourself after this, or pass
+# --spawn to run it in a temporary directory (so that the real permanence files are not touched). Each chat is first
+# permitted by OWNER, and all its players join; only afterwards the measurement begins.
+
+import argparse
+import itertools
+import mock_bot_api
+import os
+import random
+import secret  # See secret_template.py
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# (command, weight) as seen in real games: mostly drawing the next player and picking truth or dare.
+COMMAND_MIX = [
+    ('/random', 25),
+    ('/wop', 10),
+    ('/do_w', 10),
+    ('/do_p', 10),
+    ('/who', 10),
+    ('/choose', 5),
+    ('/players', 5),
+    ('/whytho', 5),
+    ('/nope', 4),
+    ('/true_random', 3),
+    ('/show_random', 2),
+    ('/leave', 2),
+    ('/join', 2),
+    ('/uptime', 1),
+    ('/how', 1),
+    ('/start', 1),
+]
+OWNER_ID = 1
+PERCENTILES = [0.5, 0.9, 0.99, 0.999, 1]
+
+
+class LoadGenerator:
+    def __init__(self, api, num_chats, players_per_chat, seed):
+        self.api = api
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.outstanding = dict()  # (chat_id, message_id) to the time it was queued
+        self.latencies = []  # seconds, of the measured phase
+        self.measuring = False
+        self.begin = None  # Of the measured phase
+        self.last_reply = None
+        self.chats = dict()  # chat_id to list of players
+        for c in range(num_chats):
+            chat_id = -1000000000 - c
+            self.chats[chat_id] = [{'id': 1000000000 + c * players_per_chat + p, 'first_name': f'Spieler {p}',
+                                    'username': f'spieler_{c}_{p}'} for p in range(players_per_chat)]
+        self.chat_ids = list(self.chats.keys())
+        commands, weights = zip(*COMMAND_MIX)
+        self.commands = commands
+        self.cum_weights = list(itertools.accumulate(weights))
+
+    def on_reply(self, chat_id, reply_to_message_id, _text, timestamp):
+        with self.lock:
+            queued = self.outstanding.pop((chat_id, reply_to_message_id), None)
+            if queued is not None and self.measuring:
+                self.latencies.append(timestamp - queued)
+                self.last_reply = timestamp
+
+    def send(self, chat_id, user, text):
+        with self.lock:
+            # Holding the lock, so that the reply can't overtake us.
+            message_id = self.api.push_command(chat_id, user, text)
+            self.outstanding[(chat_id, message_id)] = time.perf_counter()
+
+    def wait_for_replies(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.outstanding:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def setup(self, timeout):
+        owner = {'id': OWNER_ID, 'first_name': 'Owner', 'username': secret.OWNER}
+        for chat_id, players in self.chats.items():
+            self.send(chat_id, owner, '/permit')
+            for user in players:
+                self.send(chat_id, user, '/join')
+        return self.wait_for_replies(timeout)
+
+    def random_command(self):
+        chat_id = self.rng.choice(self.chat_ids)
+        players = self.chats[chat_id]
+        user = self.rng.choice(players)
+        command = self.rng.choices(self.commands, cum_weights=self.cum_weights)[0]
+        if command == '/choose':
+            command = f'/choose @{self.rng.choice(players)["username"]}'
+        return chat_id, user, command
+
+    def run(self, rate, duration):
+        """Sends rate updates per second for duration seconds. Returns the number of updates sent."""
+        with self.lock:
+            self.outstanding.clear()  # Stragglers of the setup don't count
+            self.measuring = True
+        begin = self.begin = time.perf_counter()
+        sent = 0
+        while True:
+            elapsed = time.perf_counter() - begin
+            if elapsed >= duration:
+                break
+            # Open loop: Catch up with the schedule, however slow the bot is.
+            due = min(int(elapsed * rate) + 1, int(duration * rate))
+            while sent < due:
+                self.send(*self.random_command())
+                sent += 1
+            time.sleep(max(0.0, (sent / rate) - (time.perf_counter() - begin)))
+        return sent
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def report(load, sent, rate, duration, drained):
+    with load.lock:
+        latencies = sorted(load.latencies)
+        unanswered = len(load.outstanding)
+        last_reply = load.last_reply
+    print(f'Offered {sent} updates in {duration:.1f} seconds ({rate:.0f}/s); {len(latencies)} answered, {unanswered} '
+          f'without reply{"" if drained else " (still waiting when giving up)"}; {load.api.backlog()} never fetched.')
+    if not latencies:
+        return
+    elapsed = last_reply - load.begin
+    print(f'Sustained {len(latencies) / elapsed:.0f} replies/s ({sent / elapsed:.0f} updates/s) over {elapsed:.1f} '
+          f'seconds, in {load.api.polls} polls.')
+    print('  '.join(f'p{q * 100:g}={percentile(latencies, q) * 1000:.1f}ms' for q in PERCENTILES))
+
+
+def spawn_bot(dirname):
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    return subprocess.Popen([sys.executable, bot_path], cwd=dirname, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def run(args):
+    api_url = getattr(secret, 'BOT_API_URL', None)
+    if api_url is None:
+        print('Set BOT_API_URL in secret.py, e.g. to \'http://127.0.0.1:8081/bot\'.')
+        return 1
+    location = urllib.parse.urlsplit(api_url)
+    load = LoadGenerator(None, args.chats, args.players, args.seed)
+    api = mock_bot_api.MockBotApi(location.hostname, location.port, load.on_reply)
+    load.api = api
+    api.start()
+    with tempfile.TemporaryDirectory() as dirname:
+        bot = spawn_bot(dirname) if args.spawn else None
+        try:
+            print(f'Serving the Bot API at {api_url}, waiting for the bot ...')
+            while api.polls == 0:
+                if bot is not None and bot.poll() is not None:
+                    print(f'bot.py exited with {bot.returncode}.')
+                    return 1
+                time.sleep(0.1)
+            print(f'Setting up {args.chats} chats with {args.players} players each ...')
+            if not load.setup(args.drain + args.chats * args.players / 100):
+                print('The bot didn\'t answer all /permit and /join in time.')
+                return 1
+            sent = load.run(args.rate, args.duration)
+            drained = load.wait_for_replies(args.drain)
+            report(load, sent, args.rate, args.duration, drained)
+        finally:
+            if bot is not None:
+                bot.send_signal(signal.SIGINT)  # Flushes and exits like on Ctrl-C
+                bot.wait()
+            api.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-tests bot.py against a local stand-in of the Bot API.')
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--players', type=int, default=8, help='per chat')
+    parser.add_argument('--rate', type=float, default=500, help='updates per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for the last replies')
+    parser.add_argument('--seed', default='loadgen', help='for the choice of commands')
+    parser.add_argument('--spawn', action='store_true', help='run bot.py in a temporary directory')
+    exit(run(parser.parse_args()))
@@ -1,11 +1,15 @@
 #!/bin/false
 # Not for execution
 
+import bisect
+import collections
 import datetime
-from generation import GenerationTracker
-import random
+import itertools
+from generation import GenerationTracker, PairTracker
+from players import PlayerRegistry
+import randomness
+import sampler
 import secret  # For MESSAGES_SHEET
-import secrets
 
 WOP_TO_WOP = {
     'w': 'Wahrheit',
@@ -14,96 +18,215 @@ WOP_TO_WOP = {
 
 DATETIME_FORMAT = '%Y-%m-%d %T'
 
+# How /random draws: 'shuffle' builds all weights and shuffles them, 'fenwick' uses sampler.FenwickSampler, which takes
+# O(log n) per draw. Both use the same weights, but draw different players from the same seed.
+SAMPLER = getattr(secret, 'SAMPLER', 'shuffle')
+# Where unseeded games get their randomness from, see randomness.py: 'fast' or 'system'.
+RNG = getattr(secret, 'RNG', 'fast')
+# Coefficients of both trackers in the combined weights; see simulate_fairness.py for tuning.
+OVERALL_WEIGHT = 1
+INDIVIDUAL_WEIGHT = 1
+
+WEIGHT_CACHE_STATS = collections.Counter()  # 'hits' and 'misses' of OngoingGame.compute_weigths_for(), in all games
+
+# Reasons for /whytho are kept as plain strings, or as dicts that are only rendered when asked for:
+#     m: 'random', 'true_random', or 'fenwick' (the method)
+#     c: the candidates (usernames; firstnames for 'true_random'), at most REASON_MAX_CANDIDATES of them
+#     w: their weights, if any
+#     n: the total number of candidates
+#     r: the random number that decided, if any
+#     t: the total weight, for 'fenwick'
+REASON_MAX_CANDIDATES = 20
+
+
+def render_reason(reason):
+    if isinstance(reason, str):
+        return reason
+    if reason['m'] == 'fenwick':
+        return f'random({reason["c"][0]} had weight {reason["w"][0]} of {reason["t"]})'
+    if reason['m'] == 'random':
+        text = f'random{list(zip(reason["c"], reason["w"]))}'
+    else:
+        text = f'true_random{reason["c"]}'
+    omitted = reason['n'] - len(reason['c'])
+    if omitted:
+        text = f'{text[:-1]}, … and {omitted} more]'
+    return text
+
 
 class OngoingGame:
-    def __init__(self, seed=None):
-        self.joined_users = dict() # username to firstname
-        self.last_chooser = None # or (username, firstname) tuple
-        self.last_chosen = None # or (username, firstname) tuple
+    __slots__ = ('version', 'joined_users', 'last_chooser', 'last_chosen', '_last_wop', 'last_reason', 'init_datetime',
+                 'last_activity', 'track_overall', 'track_individual', 'sampler', 'weight_cache_version', 'weight_cache',
+                 'rng')
+
+    # Players are identified by their key in joined_users, see PlayerRegistry. Only the registry knows their names.
+    def __init__(self, seed=None, sampler_kind=None):
+        self.version = 0 # Bumped on every mutation, so that the bot knows what to save; never persisted
+        self.joined_users = PlayerRegistry() # key to firstname, plus usernames
+        self.last_chooser = None # or key
+        self.last_chosen = None # or key
         self.last_wop = None # or 'w' or 'p'
-        self.last_reason = 'dunno' # text that can be queried with /whytho
+        self.last_reason = 'dunno' # for /whytho, see render_reason()
         self.init_datetime = datetime.datetime.now()
+        self.last_activity = self.init_datetime # Updated by every command, but doesn't count as a mutation
         self.track_overall = GenerationTracker() # Overall; ensuring that noone has to wait too long
-        self.track_individual = dict() # username to GenerationTracker; ensuring that no pair happens too often / too seldomly
+        self.track_individual = PairTracker() # Ensuring that no pair happens too often / too seldomly
+        if sampler_kind is None:
+            sampler_kind = SAMPLER
+        assert sampler_kind in ('shuffle', 'fenwick'), sampler_kind
+        self.sampler = sampler.FenwickSampler(self) if sampler_kind == 'fenwick' else None # Derived from the trackers, never persisted
+        self.weight_cache_version = None # self.version for which weight_cache is valid
+        self.weight_cache = dict() # sender key (or None for w_overall) to weights; never persisted
         if seed is not None:
-            self.rng = random.Random(seed)  # Necessary for testing
+            self.rng = randomness.GameRandom(seed, reseed=False)  # Necessary for testing
         else:
-            self.rng = secrets.SystemRandom()
-
-    def notify_join(self, username, firstname):
-        new_tracker = GenerationTracker()
-        for other_username, other_tracker in self.track_individual.items():
-            new_tracker.notify_join(other_username)
-            other_tracker.notify_join(username)
-        self.track_individual[username] = new_tracker
-        self.track_overall.notify_join(username)
-
-        self.joined_users[username] = firstname
-
-    def notify_leave(self, username):
-        del self.track_individual[username]
-        for other_tracker in self.track_individual.values():
-            other_tracker.notify_leave(username)
-        self.track_overall.notify_leave(username)
-
-        del self.joined_users[username]
-        if self.last_chooser is not None and self.last_chooser[0] == username:
+            self.rng = randomness.make_rng(RNG)
+
+    @property
+    def last_wop(self):
+        return self._last_wop
+
+    @last_wop.setter
+    def last_wop(self, value):
+        self._last_wop = value
+        self.version += 1
+
+    def identify(self, user_id, username, firstname):
+        """
+        Returns the key of the sender: their user id, or the provisional key of a player with that username if the id
+        is unknown. A provisional key is replaced by the user id right away. Keeps the names of players up to date.
+        """
+        registry = self.joined_users
+        if user_id is not None and user_id in registry:
+            if registry.entries[user_id] != (username, firstname) and username:
+                registry.rename(user_id, username, firstname)
+                self.version += 1
+            return user_id
+        key = registry.find_by_username(username) if username else None
+        if user_id is None:
+            return key  # Without ids, usernames are all there is
+        if key is not None and key < 0:
+            self.rekey({key: user_id})
+        # Otherwise, the user isn't a player; a player with the same username must have renamed and not written since.
+        return user_id
+
+    def rekey(self, mapping):
+        """Replaces player keys according to mapping, from old to new keys."""
+        self.track_individual.rekey(mapping)
+        self.track_overall.rekey(mapping)
+        self.joined_users.rekey(mapping)
+        self.last_chooser = mapping.get(self.last_chooser, self.last_chooser)
+        self.last_chosen = mapping.get(self.last_chosen, self.last_chosen)
+        if self.sampler is not None:
+            self.sampler.stale = True
+        self.version += 1
+
+    def notify_join(self, username, firstname, key=None):
+        """Returns the key of the new player, which is a provisional one if key is None."""
+        key = self.joined_users.add(key, username, firstname)
+        self.track_individual.notify_join(key)
+        self.track_overall.notify_join(key)
+        if self.sampler is not None:
+            self.sampler.notify_join(key)
+        self.version += 1
+        return key
+
+    def notify_leave(self, key):
+        if self.sampler is not None:
+            self.sampler.notify_leave(key)
+        self.track_individual.notify_leave(key)
+        self.track_overall.notify_leave(key)
+
+        self.joined_users.remove(key)
+        if self.last_chooser == key:
             self.last_chooser = None
             # self.last_wop = None  # Debatable, but let's try to keep it.
-        if self.last_chosen is not None and self.last_chosen[0] == username:
+        if self.last_chosen == key:
             self.last_chosen = None
             self.last_wop = None
+        self.version += 1
 
-    def notify_chosen(self, chooser_username, chooser_firstname, chosen_username, chosen_firstname, reason):
-        self.track_overall.notify_chosen(chosen_username)
-        self.track_individual[chooser_username].notify_chosen(chosen_username)
+    def notify_chosen(self, chooser, chosen, reason):
+        old_last_chosen = self.track_overall.last_chosen[chosen]
+        self.track_overall.notify_chosen(chosen)
+        self.track_individual.notify_chosen(chooser, chosen)
+        if self.sampler is not None:
+            self.sampler.notify_chosen(chooser, chosen, old_last_chosen)
 
-        self.last_chooser = (chooser_username, chooser_firstname)
-        self.last_chosen = (chosen_username, chosen_firstname)
+        self.last_chooser = chooser
+        self.last_chosen = chosen
         self.last_wop = None
         self.last_reason = reason
-
-    def compute_weigths_for(self, sender_username):
+        self.version += 1
+
+    def username(self, key):
+        return self.joined_users.username(key)
+
+    def firstname(self, key):
+        return self.joined_users[key]
+
+    def compute_weigths_for(self, sender):
+        # The result is cached until the next mutation, so the caller must not modify it.
+        if self.weight_cache_version != self.version:
+            self.weight_cache.clear()
+            self.weight_cache_version = self.version
+        weights = self.weight_cache.get(sender)
+        if weights is not None:
+            WEIGHT_CACHE_STATS['hits'] += 1
+            return weights
+        WEIGHT_CACHE_STATS['misses'] += 1
         # All numbers are configurable. In particular the coefficient for w_individual could be 2, to prioritize that.
-        w_overall = self.track_overall.get_weights(0)
-        w_individual = self.track_individual[sender_username].get_weights(0)
-        return GenerationTracker.combine_weights(1, w_overall, 1, w_individual)
+        w_overall = self.weight_cache.get(None)
+        if w_overall is None:
+            w_overall = self.weight_cache[None] = self.track_overall.get_weights(0)  # The same for every sender
+        w_individual = self.track_individual.get_weights(sender, 0)
+        weights = GenerationTracker.combine_weights(OVERALL_WEIGHT, w_overall, INDIVIDUAL_WEIGHT, w_individual)
+        self.weight_cache[sender] = weights
+        return weights
 
     def to_dict(self):
-        return dict(
-            joined_users=self.joined_users,
+        # Must not share any mutable state with the game, as the result may be written out on another thread.
+        d = dict(
+            schema_version=SCHEMA_VERSION,
+            players=self.joined_users.to_dict(),
             last_chooser=self.last_chooser,
             last_chosen=self.last_chosen,
             last_wop=self.last_wop,
+            last_reason=self.last_reason if isinstance(self.last_reason, str) else {k: list(v) if isinstance(v, list) else v for k, v in self.last_reason.items()},
             init_datetime=self.init_datetime.timestamp(),
-            track_overall=self.track_overall.to_dict(),
-            track_individual={u: t.to_dict() for u, t in self.track_individual.items()},
+            last_activity=self.last_activity.timestamp(),
+            track_overall=self.track_overall.to_dict(str),  # Like JSON would, so that loading gives the same dict
+            track_pairs=self.track_individual.to_dict(str),
         )
+        if isinstance(self.rng, randomness.GameRandom):
+            d['rng'] = self.rng.to_dict()
+        return d
 
     def from_dict(d):
+        d = migrate(d)
         g = OngoingGame()
-        assert ('track_overall' in d) == ('track_individual' in d)
-        if 'track_overall' in d:
-            g.track_overall = GenerationTracker.from_dict(d['track_overall'])
-            g.track_individual = {u: GenerationTracker.from_dict(sub_dict) for u, sub_dict in d['track_individual'].items()}
-            g.joined_users = d['joined_users']
-        else:
-            print(f'WARNING: Migrating users to generational RNG! Affected users: {list(d["joined_users"].keys())}\nRNG experience may feel discontinuous.')
-            for username, firstname in d['joined_users'].items():
-                g.notify_join(username, firstname)
-            # No need to set g.joined_users
-
+        g.joined_users = PlayerRegistry.from_dict(d['players'])
+        # The keys are strings in JSON. Use the same int objects everywhere, rather than many equal ones.
+        convert_key = {str(key): key for key in g.joined_users.keys()}.__getitem__
+        g.track_overall = GenerationTracker.from_dict(d['track_overall'], convert_key)
+        g.track_individual = PairTracker.from_dict(d['track_pairs'], convert_key)
         g.last_chooser = d['last_chooser']
         g.last_chosen = d['last_chosen']
         g.last_wop = d['last_wop']
+        g.last_reason = d.get('last_reason', 'dunno')
+        if 'rng' in d and RNG == 'fast':
+            g.rng = randomness.GameRandom.from_dict(d['rng'])
+        if g.sampler is not None:
+            g.sampler.stale = True  # The trackers were replaced
         g.init_datetime = datetime.datetime.fromtimestamp(d['init_datetime'])
+        g.last_activity = datetime.datetime.fromtimestamp(d.get('last_activity', d['init_datetime']))
         return g
 
     def __repr__(self):
         return str(self.to_dict())
 
-    def check_can_choose_player(self, sender_firstname, sender_username):
-        if sender_username not in self.joined_users.keys():
+    def check_can_choose_player(self, sender_firstname, sender_username, sender):
+        if sender not in self.joined_users:
             return ('nonplayer', sender_firstname)
 
         # If both last_chooser and last_chosen are None, then we're in the first round, and we want to allow it anyway.
@@ -115,154 +238,239 @@ class OngoingGame:
         # If both exist, only allow the last_chosen to do /random:
         if self.last_chooser is not None and self.last_chosen is not None:
             # There's a good chance the player just misunderstood.
-            if self.last_chooser[0] == sender_username:
-                return ('random_already_chosen', sender_firstname, self.last_chosen[0])
-            if self.last_chosen[0] != sender_username:
-                return ('random_not_involved', sender_firstname, self.last_chooser[1], self.last_chosen[0])
+            if self.last_chooser == sender:
+                return ('random_already_chosen', sender_firstname, self.username(self.last_chosen))
+            if self.last_chosen != sender:
+                return ('random_not_involved', sender_firstname, self.firstname(self.last_chooser), self.username(self.last_chosen))
             if self.last_wop is None:
-                return ('random_nowop', sender_username, self.last_chooser[1])
+                return ('random_nowop', sender_username, self.firstname(self.last_chooser))
 
         return None
 
 
-def compute_join(game, argument, sender_firstname, sender_username):
+# Game dicts carry a schema_version; older ones are upgraded step by step when loading, see migrate().
+#     0: joined_users, last_chooser and last_chosen only
+#     1: plus track_overall, and track_individual with a GenerationTracker for each user
+#     2: track_pairs, a PairTracker, instead of track_individual
+#     3: players keyed by user id, see PlayerRegistry; stored since schema_version was introduced
+SCHEMA_VERSION = 3
+
+
+def schema_version(d):
+    if 'schema_version' in d:
+        return d['schema_version']
+    # Written before schema_version was introduced:
+    if 'players' in d:
+        return 3
+    if 'track_pairs' in d:
+        return 2
+    if 'track_overall' in d:
+        assert 'track_individual' in d
+        return 1
+    return 0
+
+
+def migrate_from_v0(d):
+    # Straight to version 2, as version 1 would need a tracker entry for every pair.
+    print(f'WARNING: Migrating users to generational RNG! Affected users: {list(d["joined_users"].keys())}\nRNG experience may feel discontinuous.')
+    track_overall = GenerationTracker()
+    track_pairs = PairTracker()
+    for username in d['joined_users'].keys():
+        track_overall.notify_join(username)
+        track_pairs.notify_join(username)
+    return dict(d, schema_version=2, track_overall=track_overall.to_dict(), track_pairs=track_pairs.to_dict())
+
+
+def migrate_from_v1(d):
+    migrated = {k: v for k, v in d.items() if k != 'track_individual'}
+    migrated.update(schema_version=2, track_pairs=PairTracker.from_legacy_dict(d['track_individual']).to_dict())
+    return migrated
+
+
+def migrate_from_v2(d):
+    # The players get provisional keys in join order, see PlayerRegistry.
+    keys = {username: -i for i, username in enumerate(d['joined_users'].keys(), 1)}
+    track_overall = GenerationTracker.from_dict(d['track_overall'])
+    track_overall.rekey(keys)
+    track_pairs = PairTracker.from_dict(d['track_pairs'])
+    track_pairs.rekey(keys)
+
+    def migrate_player(player):
+        # (username, firstname), or in very old versions just the username, or None.
+        if isinstance(player, (list, tuple)):
+            player = player[0]
+        return keys.get(player)
+
+    migrated = {k: v for k, v in d.items() if k != 'joined_users'}
+    migrated.update(
+        schema_version=3,
+        players={str(keys[username]): [username, firstname] for username, firstname in d['joined_users'].items()},
+        last_chooser=migrate_player(d['last_chooser']),
+        last_chosen=migrate_player(d['last_chosen']),
+        track_overall=track_overall.to_dict(str),
+        track_pairs=track_pairs.to_dict(str),
+    )
+    return migrated
+
+
+MIGRATIONS = {0: migrate_from_v0, 1: migrate_from_v1, 2: migrate_from_v2}  # From that schema_version to a later one
+
+
+def migrate(d):
+    """Returns the game dict upgraded to SCHEMA_VERSION. Doesn't modify d."""
+    version = schema_version(d)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f'Game dict has schema_version {version}, but this version only knows up to {SCHEMA_VERSION}')
+    while version < SCHEMA_VERSION:
+        d = MIGRATIONS[version](d)
+        version = d['schema_version']
+    return d
+
+
+def compute_join(game, argument, sender_firstname, sender_username, sender):
     if not sender_username:
         return ('welcome_no_username', sender_firstname)
 
-    if sender_username in game.joined_users.keys():
+    if sender in game.joined_users:
         return ('already_in', sender_firstname)
     else:
-        game.notify_join(sender_username, sender_firstname)
+        game.notify_join(sender_username, sender_firstname, sender)
         return ('welcome', sender_firstname)
 
 
-def compute_leave(game, argument, sender_firstname, sender_username):
-    if sender_username not in game.joined_users.keys():
+def compute_leave(game, argument, sender_firstname, sender_username, sender):
+    if sender not in game.joined_users:
         return ('already_left', sender_firstname)
 
     response = ('leave', sender_firstname)
 
-    if game.last_chooser is not None and game.last_chooser[0] == sender_username:
+    if game.last_chooser == sender:
         if game.last_chosen is None:
             response = ('leave_chooser_dunno', sender_firstname)
         else:
-            response = ('leave_chooser_handover', sender_firstname, game.last_chosen[0])
-    if game.last_chosen is not None and game.last_chosen[0] == sender_username:
+            response = ('leave_chooser_handover', sender_firstname, game.username(game.last_chosen))
+    if game.last_chosen == sender:
         if game.last_chooser is None:
             response = ('leave_chosen_dunno', sender_firstname)
         else:
-            response = ('leave_chosen_flee', sender_firstname, game.last_chooser[0])
+            response = ('leave_chosen_flee', sender_firstname, game.username(game.last_chooser))
 
-    game.notify_leave(sender_username)
+    game.notify_leave(sender)
     return response
 
 
-def compute_show_random(game, argument, sender_firstname, sender_username):
+def compute_show_random(game, argument, sender_firstname, sender_username, sender):
     if argument:
-        argument = argument.strip('@')
-        if argument not in game.joined_users:
+        sender = game.joined_users.find_by_username(argument.strip('@'))
+        if sender is None:
             return ('unknown_user', sender_firstname, sender_username)
-        sender_username, sender_firstname = argument, game.joined_users[argument]
+        sender_firstname = game.firstname(sender)
 
-    if sender_username not in game.joined_users.keys():
+    if sender not in game.joined_users:
         return ('nonplayer', sender_firstname)
 
     if len(game.joined_users) <= 1:
         return ('random_singleplayer', sender_firstname)
 
-    weights = game.compute_weigths_for(sender_username)
-    weight_tuples = list(weights.items())
+    weights = game.compute_weigths_for(sender)
+    weight_tuples = [(game.username(key), weight) for key, weight in weights.items()]
     return ('debug1', str(weight_tuples))
 
 
-def compute_whytho(game, argument, sender_firstname, sender_username):
-    return ('debug1', game.last_reason)
+def compute_whytho(game, argument, sender_firstname, sender_username, sender):
+    return ('debug1', render_reason(game.last_reason))
 
 
-def compute_random(game, argument, sender_firstname, sender_username):
-    why_not = game.check_can_choose_player(sender_firstname, sender_username)
+def compute_random(game, argument, sender_firstname, sender_username, sender):
+    why_not = game.check_can_choose_player(sender_firstname, sender_username, sender)
     if why_not:
         return why_not
 
     if len(game.joined_users) <= 1:
         return ('random_singleplayer', sender_firstname)
 
-    weights = game.compute_weigths_for(sender_username)
-    weight_tuples = list(weights.items())
-    game.rng.shuffle(weight_tuples)  # Wtf? This shouldn't be necessary!
-    chosen_username = game.rng.choices(*zip(*weight_tuples))[0]
-    chosen_firstname = game.joined_users[chosen_username]  # This is unfortunate
-
-    game.notify_chosen(sender_username, sender_firstname, chosen_username, chosen_firstname, f'random{weight_tuples}')
-    return ('random_chosen', chosen_username)
-
-
-def compute_true_random(game, argument, sender_firstname, sender_username):
-    why_not = game.check_can_choose_player(sender_firstname, sender_username)
+    if game.sampler is not None:
+        chosen, weight, total = game.sampler.draw(sender, game.rng, OVERALL_WEIGHT, INDIVIDUAL_WEIGHT)
+        reason = dict(m='fenwick', c=[game.username(chosen)], w=[weight], n=1, t=total)
+    else:
+        weights = game.compute_weigths_for(sender)
+        weight_tuples = list(weights.items())
+        game.rng.shuffle(weight_tuples)  # Wtf? This shouldn't be necessary!
+        candidates, candidate_weights = zip(*weight_tuples)
+        # Same as game.rng.choices(candidates, candidate_weights)[0], but keeps the random number for /whytho.
+        cum_weights = list(itertools.accumulate(candidate_weights))
+        total = cum_weights[-1] + 0.0
+        if total <= 0.0:
+            raise ValueError('Total of weights must be greater than zero')
+        r = game.rng.random() * total
+        chosen = candidates[bisect.bisect(cum_weights, r, 0, len(candidates) - 1)]
+        reason = dict(m='random', c=[game.username(key) for key in candidates[:REASON_MAX_CANDIDATES]],
+                      w=list(candidate_weights[:REASON_MAX_CANDIDATES]), n=len(candidates), r=r)
+
+    game.notify_chosen(sender, chosen, reason)
+    return ('random_chosen', game.username(chosen))
+
+
+def compute_true_random(game, argument, sender_firstname, sender_username, sender):
+    why_not = game.check_can_choose_player(sender_firstname, sender_username, sender)
     if why_not:
         return why_not
 
-    available_players = game.joined_users.copy()
-    del available_players[sender_username]
-
-    if len(available_players) == 0:
+    if len(game.joined_users) <= 1:
         return ('random_singleplayer', sender_firstname)
 
     # Purely uniform distribution, except only the player sending the request.
-    chosen_username, chosen_firstname = game.rng.choice(list(available_players.items()))
+    chosen = game.joined_users.pick_other(game.rng, sender)
+    available_firstnames = [fina for key, fina in itertools.islice(game.joined_users.items(), REASON_MAX_CANDIDATES + 1) if key != sender]
+    reason = dict(m='true_random', c=available_firstnames[:REASON_MAX_CANDIDATES], n=len(game.joined_users) - 1)
 
-    game.notify_chosen(sender_username, sender_firstname, chosen_username, chosen_firstname, f'true_random{list(available_players.values())}')
-    return ('random_chosen', chosen_username)
+    game.notify_chosen(sender, chosen, reason)
+    return ('random_chosen', game.username(chosen))
 
 
-def compute_who(game, argument, sender_firstname, sender_username) -> None:
+def compute_who(game, argument, sender_firstname, sender_username, sender) -> None:
     if game.last_chooser is None and game.last_chosen is None:
         return ('who_nobody', sender_firstname)
 
     if game.last_chooser is None:
-        return ('who_no_chooser', sender_firstname, game.last_chosen[0])
+        return ('who_no_chooser', sender_firstname, game.username(game.last_chosen))
 
     if game.last_chosen is None:
-        return ('who_no_chosen', game.last_chooser[0])
+        return ('who_no_chosen', game.username(game.last_chooser))
 
     if game.last_wop is None:
-        return ('who_no_wop', game.last_chosen[0], game.last_chooser[1])
+        return ('who_no_wop', game.username(game.last_chosen), game.firstname(game.last_chooser))
     else:
-        return ('who_wop_' + game.last_wop, game.last_chooser[1], game.last_chosen[0])
+        return ('who_wop_' + game.last_wop, game.firstname(game.last_chooser), game.username(game.last_chosen))
 
 
-def compute_kick(game, argument, sender_firstname, sender_username) -> None:
-    if sender_username not in game.joined_users:
+def compute_kick(game, argument, sender_firstname, sender_username, sender) -> None:
+    if sender not in game.joined_users:
         return ('kick_nonplayer', sender_firstname)
 
     if game.last_chosen is None:
         return ('kick_no_chosen', sender_firstname)
 
-    if game.last_chosen[0] == sender_username:
+    if game.last_chosen == sender:
         return ('kick_self', sender_firstname)
 
-    old_last_chosen = game.last_chosen
-    game.notify_leave(old_last_chosen[0])
-    return ('kick', sender_firstname, old_last_chosen[0])
+    old_last_chosen_username = game.username(game.last_chosen)
+    game.notify_leave(game.last_chosen)
+    return ('kick', sender_firstname, old_last_chosen_username)
 
 
-def compute_players(game, argument, sender_firstname, sender_username) -> None:
+def compute_players(game, argument, sender_firstname, sender_username, sender) -> None:
     num_players = len(game.joined_users)
     if num_players == 0:
         return ('players_nobody', sender_firstname)
 
-    firstnames = list(game.joined_users.values())
-    firstnames.sort()
-    sender_is_in = sender_username in game.joined_users.keys()
+    sender_is_in = sender in game.joined_users
     msg_suffix = '_self' if sender_is_in else '_other'
 
     if num_players == 1:
-        return ('players_one' + msg_suffix, sender_firstname, firstnames[0])
+        return ('players_one' + msg_suffix, sender_firstname, game.joined_users.roster[0])
 
-    firstnames_head = ', '.join(firstnames[:-1])
-    firstnames_tail = firstnames[-1]
-    # Extending the message-interface is too painful, so let's do this instead.
-    firstnames_text = f'{firstnames_head} und {firstnames_tail}'
+    firstnames_text = game.joined_users.render_roster()
 
     if num_players < 5:
         return ('players_few' + msg_suffix, sender_firstname, firstnames_text)
@@ -270,12 +478,12 @@ def compute_players(game, argument, sender_firstname, sender_username) -> None:
     return ('players_many' + msg_suffix, sender_firstname, firstnames_text)
 
 
-def compute_uptime(game, argument, sender_firstname, sender_username) -> None:
+def compute_uptime(game, argument, sender_firstname, sender_username, sender) -> None:
     return ('uptime', game.init_datetime.strftime(DATETIME_FORMAT), datetime.datetime.now().strftime(DATETIME_FORMAT))
 
 
-def compute_choose(game, argument, sender_firstname, sender_username) -> None:
-    why_not = game.check_can_choose_player(sender_firstname, sender_username)
+def compute_choose(game, argument, sender_firstname, sender_username, sender) -> None:
+    why_not = game.check_can_choose_player(sender_firstname, sender_username, sender)
     if why_not:
         return why_not
 
@@ -288,25 +496,21 @@ def compute_choose(game, argument, sender_firstname, sender_username) -> None:
     if argument.startswith('@'):
         argument = argument[1:]
 
-    if argument in game.joined_users.keys():
-        chosen_username, chosen_firstname = argument, game.joined_users[argument]
-    else:
-        for usna, fina in game.joined_users.items():
-            if argument == fina:
-                chosen_username, chosen_firstname = usna, fina
-                break
-        else:
+    chosen = game.joined_users.find_by_username(argument)
+    if chosen is None:
+        chosen = game.joined_users.find_by_firstname(argument)
+        if chosen is None:
             return ('unknown_user', sender_firstname, sender_username)
 
-    if chosen_username == sender_username:
+    if chosen == sender:
         return ('chosen_self', sender_firstname)
 
-    game.notify_chosen(sender_username, sender_firstname, chosen_username, chosen_firstname, f'choose')
-    return ('chosen_chosen', chosen_username, sender_firstname)
+    game.notify_chosen(sender, chosen, f'choose')
+    return ('chosen_chosen', game.username(chosen), sender_firstname)
 
 
-def check_can_do_x(game, sender_firstname, sender_username):
-    if sender_username not in game.joined_users.keys():
+def check_can_do_x(game, sender_firstname, sender_username, sender):
+    if sender not in game.joined_users:
         return ('nonplayer', sender_firstname)
 
     if game.last_chosen is None:
@@ -314,66 +518,66 @@ def check_can_do_x(game, sender_firstname, sender_username):
     if game.last_chooser is None:
         return ('dox_no_chooser', sender_username)
 
-    if game.last_chooser[0] == sender_username:
-        return ('dox_wrong_side', sender_firstname, game.last_chosen[0])
-    if game.last_chosen[0] != sender_username:
-        return ('dox_not_involved', sender_firstname, game.last_chosen[0], game.last_chooser[1])
+    if game.last_chooser == sender:
+        return ('dox_wrong_side', sender_firstname, game.username(game.last_chosen))
+    if game.last_chosen != sender:
+        return ('dox_not_involved', sender_firstname, game.username(game.last_chosen), game.firstname(game.last_chooser))
 
     if game.last_wop is not None:
-        return ('dox_already_' + game.last_wop, sender_firstname, game.last_chooser[0])
+        return ('dox_already_' + game.last_wop, sender_firstname, game.username(game.last_chooser))
 
     return None
 
 
-def compute_wop(game, argument, sender_firstname, sender_username):
-    if sender_username not in game.joined_users:
+def compute_wop(game, argument, sender_firstname, sender_username, sender):
+    if sender not in game.joined_users:
         return ('nonplayer', sender_firstname)
 
     if game.last_chosen is None:
         return ('wop_nobodychosen', sender_firstname, game.rng.choice(list(WOP_TO_WOP.values())))
-    if game.last_chosen[0] != sender_username:
-        return ('wop_nonchosen', sender_firstname, game.last_chosen[0])
+    if game.last_chosen != sender:
+        return ('wop_nonchosen', sender_firstname, game.username(game.last_chosen))
 
     if game.last_wop is not None:
-        return ('wop_again', sender_firstname, WOP_TO_WOP[game.last_wop], game.last_chooser[0] if game.last_chooser is not None else '???')
+        return ('wop_again', sender_firstname, WOP_TO_WOP[game.last_wop], game.username(game.last_chooser) if game.last_chooser is not None else '???')
 
     if game.last_chooser is None:
         return ('dox_no_chooser', sender_username)
 
-    last_chooser_username = game.last_chooser[0]
+    last_chooser_username = game.username(game.last_chooser)
 
     game.last_wop = game.rng.choice('wp')
     return ('wop_result_' + game.last_wop, sender_firstname, last_chooser_username)
 
 
-def compute_do_w(game, argument, sender_firstname, sender_username) -> None:
-    why_not = check_can_do_x(game, sender_firstname, sender_username)
+def compute_do_w(game, argument, sender_firstname, sender_username, sender) -> None:
+    why_not = check_can_do_x(game, sender_firstname, sender_username, sender)
     if why_not:
         return why_not
 
     game.last_wop = 'w'
-    return ('dox_w', sender_firstname, game.last_chooser[0])
+    return ('dox_w', sender_firstname, game.username(game.last_chooser))
 
 
-def compute_do_p(game, argument, sender_firstname, sender_username) -> None:
-    why_not = check_can_do_x(game, sender_firstname, sender_username)
+def compute_do_p(game, argument, sender_firstname, sender_username, sender) -> None:
+    why_not = check_can_do_x(game, sender_firstname, sender_username, sender)
     if why_not:
         return why_not
 
     game.last_wop = 'p'
-    return ('dox_p', sender_firstname, game.last_chooser[0])
+    return ('dox_p', sender_firstname, game.username(game.last_chooser))
 
 
-def compute_chicken(game, argument, sender_firstname, sender_username):
+def compute_chicken(game, argument, sender_firstname, sender_username, sender):
     # Very similar to check_can_do_x and compute_wop
-    if sender_username not in game.joined_users.keys():
+    if sender not in game.joined_users:
         return ('nonplayer', sender_firstname)
 
-    if game.last_chooser is not None and game.last_chooser[0] == sender_username:
-        last_chosen_username = game.last_chosen[0] if game.last_chosen is not None else '???'
+    if game.last_chooser == sender:
+        last_chosen_username = game.username(game.last_chosen) if game.last_chosen is not None else '???'
         return ('chicken_wrong_side', sender_firstname, last_chosen_username)
 
-    if game.last_chosen is None or game.last_chosen[0] != sender_username:
+    if game.last_chosen != sender:
         return ('chicken_not_involved', sender_firstname)
 
     if game.last_wop is None:
@@ -382,36 +586,38 @@ def compute_chicken(game, argument, sender_firstname, sender_username):
     return ('chicken_' + game.last_wop, secret.MESSAGES_SHEET, secret.OWNER)
 
 
-def handle(game, command, argument, sender_firstname, sender_username):
+def handle(game, command, argument, sender_firstname, sender_username, sender_id=None):
+    game.last_activity = datetime.datetime.now()
+    sender = game.identify(sender_id, sender_username, sender_firstname)
     if command == 'join':
-        return compute_join(game, argument, sender_firstname, sender_username)
+        return compute_join(game, argument, sender_firstname, sender_username, sender)
     elif command == 'leave':
-        return compute_leave(game, argument, sender_firstname, sender_username)
+        return compute_leave(game, argument, sender_firstname, sender_username, sender)
     elif command == 'random':
-        return compute_random(game, argument, sender_firstname, sender_username)
+        return compute_random(game, argument, sender_firstname, sender_username, sender)
     elif command == 'true_random':
-        return compute_true_random(game, argument, sender_firstname, sender_username)
+        return compute_true_random(game, argument, sender_firstname, sender_username, sender)
     elif command == 'wop':
-        return compute_wop(game, argument, sender_firstname, sender_username)
+        return compute_wop(game, argument, sender_firstname, sender_username, sender)
     elif command == 'who':
-        return compute_who(game, argument, sender_firstname, sender_username)
+        return compute_who(game, argument, sender_firstname, sender_username, sender)
     elif command == 'kick':
-        return compute_kick(game, argument, sender_firstname, sender_username)
+        return compute_kick(game, argument, sender_firstname, sender_username, sender)
     elif command == 'players':
-        return compute_players(game, argument, sender_firstname, sender_username)
+        return compute_players(game, argument, sender_firstname, sender_username, sender)
     elif command == 'uptime':
-        return compute_uptime(game, argument, sender_firstname, sender_username)
+        return compute_uptime(game, argument, sender_firstname, sender_username, sender)
     elif command == 'do_w':
-        return compute_do_w(game, argument, sender_firstname, sender_username)
+        return compute_do_w(game, argument, sender_firstname, sender_username, sender)
     elif command == 'do_p':
-        return compute_do_p(game, argument, sender_firstname, sender_username)
+        return compute_do_p(game, argument, sender_firstname, sender_username, sender)
     elif command == 'choose':
-        return compute_choose(game, argument, sender_firstname, sender_username)
+        return compute_choose(game, argument, sender_firstname, sender_username, sender)
     elif command == 'show_random':
-        return compute_show_random(game, argument, sender_firstname, sender_username)
+        return compute_show_random(game, argument, sender_firstname, sender_username, sender)
     elif command == 'whytho':
-        return compute_whytho(game, argument, sender_firstname, sender_username)
+        return compute_whytho(game, argument, sender_firstname, sender_username, sender)
     elif command == 'chicken':
-        return compute_chicken(game, argument, sender_firstname, sender_username)
+        return compute_chicken(game, argument, sender_firstname, sender_username, sender)
     else:
         return ('unknown_command', sender_firstname)
@@ -0,0 +1,83 @@
+#!/bin/false
+# Not for execution
+
+# The weights of all choosers of a room at once: weights[i][j] is the weight of candidate j when chooser i does
+# /random, exactly as OngoingGame.compute_weigths_for() computes them, and 0 on the diagonal.
+# Uses NumPy if it is installed, and plain Python otherwise; both give identical results.
+
+import generation
+import logic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_PLAYERS = 20  # Rows and columns shown by format_matrix()
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit, in characters
+
+
+def weight_matrix(game, use_numpy=None):
+    """Returns (usernames in join order, weights as a list of lists of ints)."""
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    keys = list(game.track_individual.choosers.keys())
+    usernames = [game.username(key) for key in keys]
+    if use_numpy:
+        return usernames, weight_matrix_numpy(game, keys)
+    rows = []
+    for chooser in keys:
+        weights = game.compute_weigths_for(chooser)
+        rows.append([weights.get(candidate, 0) for candidate in keys])
+    return usernames, rows
+
+
+def weight_matrix_numpy(game, keys):
+    pairs = game.track_individual
+    choosers = [pairs.choosers[key] for key in keys]
+    n = len(keys)
+    index = {key: i for i, key in enumerate(keys)}
+
+    # Array-backed copies of both trackers:
+    last_overall = numpy.array([game.track_overall.last_chosen[key] for key in keys], dtype=numpy.int64)
+    generations = numpy.array([chooser.generation for chooser in choosers], dtype=numpy.int64)
+    joined = numpy.array([chooser.joined for chooser in choosers], dtype=numpy.int64)
+    run_choosers = numpy.array([i for i, chooser in enumerate(choosers) for _ in chooser.choices], dtype=numpy.int64)
+    run_seqs = numpy.array([seq for chooser in choosers for seq, _ in chooser.choices], dtype=numpy.int64)
+    run_counts = numpy.array([count for chooser in choosers for _, count in chooser.choices], dtype=numpy.int64)
+
+    # The implicit defaults of the PairTracker: Each run of choices counts for every player who joined afterwards.
+    earlier = numpy.zeros((n, n), dtype=numpy.int64)
+    numpy.add.at(earlier, run_choosers, (joined[None, :] > run_seqs[:, None]) * run_counts[:, None])
+    last_individual = 1 + earlier - generation.DEFAULT_AGE
+    for i, chooser in enumerate(choosers):
+        for key, last_time in chooser.last_chosen.items():
+            last_individual[i, index[key]] = last_time
+
+    overall = (game.track_overall.generation - last_overall)[None, :] ** generation.WEIGHT_EXPONENT
+    individual = (generations[:, None] - last_individual) ** generation.WEIGHT_EXPONENT
+    weights = logic.OVERALL_WEIGHT * overall + logic.INDIVIDUAL_WEIGHT * individual
+    numpy.fill_diagonal(weights, 0)
+    return weights.tolist()
+
+
+def format_matrix(usernames, weights, max_players=MAX_PLAYERS, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Renders the probabilities in percent, one row per chooser, of the first max_players players only. Returns a list
+    of messages of at most max_length characters, split between rows.
+    """
+    shown = usernames[:max_players]
+    lines = ['Chooser → ' + ' '.join(shown)]
+    for chooser, row in zip(shown, weights):
+        total = sum(row)  # Including the candidates that aren't shown
+        cells = ' '.join(f'{100 * w / total:5.1f}' if total else '    -' for w in row[:max_players])
+        lines.append(f'{chooser}: {cells}')
+    if len(usernames) > max_players:
+        lines.append(f'(Nur die ersten {max_players} von {len(usernames)} Spielern)')
+    messages = [lines[0]]
+    for line in lines[1:]:
+        if len(messages[-1]) + 1 + len(line) > max_length:
+            messages.append(line)
+        else:
+            messages[-1] += '\n' + line
+    return messages
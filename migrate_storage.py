@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Upgrades all stored games to logic.SCHEMA_VERSION once, instead of on every start of the bot. Loads the storage like
+# `bot.py --dry-run`, migrates the outdated chats on a process pool, checks that each one survives a round trip
+# through OngoingGame (like TestMigration does), and only then writes everything back in one atomic snapshot.
+# Don't run this while the bot is running.
+
+import argparse
+import concurrent.futures
+import logic
+import logging
+import time
+
+
+def migrate_game(item):
+    """Returns (chat_id, upgraded game dict, error message or None)."""
+    chat_id, game_dict = item
+    try:
+        d2 = logic.OngoingGame.from_dict(game_dict).to_dict()
+        d3 = logic.OngoingGame.from_dict(d2).to_dict()
+    except Exception as e:
+        return chat_id, None, f'{type(e).__name__}: {e}'
+    if d2 != d3:
+        return chat_id, None, f'round trip changed the game: {d2} != {d3}'
+    return chat_id, d2, None
+
+
+def run(args):
+    import bot  # Not at the top, so that worker processes don't open the storage, too
+    begin = time.perf_counter()
+    kind = args.kind or bot.STORAGE_KIND
+    source = bot.STORAGE if kind == bot.STORAGE_KIND else bot.make_storage(kind)
+    games = source.load()
+    outdated = {chat_id: game_dict for chat_id, game_dict in games.items()
+                if logic.schema_version(game_dict) < logic.SCHEMA_VERSION}
+    print(f'Loaded {len(games)} games from {kind} storage, {len(outdated)} of them older than schema_version '
+          f'{logic.SCHEMA_VERSION}.')
+
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(args.processes) as executor:
+        for chat_id, game_dict, error in executor.map(migrate_game, outdated.items(), chunksize=64):
+            if error is not None:
+                print(f'Chat {chat_id}: {error}')
+                failures += 1
+            else:
+                games[chat_id] = game_dict
+    if failures:
+        print(f'{failures} games could not be migrated, so nothing was written.')
+        source.close()
+        return 1
+
+    if args.dry_run or not outdated:
+        print('Nothing written.')
+    else:
+        source.write_all(games)
+    source.close()
+    print(f'Done in {time.perf_counter() - begin:.1f} seconds.')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Upgrades all stored games to the current schema_version.')
+    parser.add_argument('--kind', default=None, help='storage kind (json, binary, sqlite, sharded); STORAGE_KIND by default')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes; all cores by default')
+    parser.add_argument('--dry-run', action='store_true', help='migrate and verify, but don\'t write anything')
+    exit(run(parser.parse_args()))
@@ -0,0 +1,152 @@
+#!/bin/false
+# Not for execution
+
+# A local stand-in for the Telegram Bot API, just enough for bot.py: getMe, deleteWebhook, getUpdates (with long
+# polling) and sendMessage. Point the bot at it with BOT_API_URL in secret.py; see loadgen.py.
+
+import collections
+import http.server
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+BOT_USER = {'id': 4242, 'is_bot': True, 'first_name': 'Wopper', 'username': 'der_wopper_bot'}
+MAX_UPDATES = 100  # Per getUpdates, like Telegram
+
+
+class MockBotApi:
+    """
+    Serves the Bot API on (host, port) in a background thread, for any token.
+
+    push_command() queues an update like Telegram would send it for a command in a group. Every sendMessage is passed
+    to on_reply(chat_id, reply_to_message_id, text, timestamp), from the server's threads, so it must be thread-safe.
+    """
+
+    def __init__(self, host, port, on_reply=None):
+        self.on_reply = on_reply
+        self.lock = threading.Condition()
+        self.pending = collections.deque()  # Updates that weren't confirmed by getUpdates yet, oldest first
+        self.next_update_id = 1
+        self.next_message_id = dict()  # chat_id to the next message_id in that chat
+        self.max_delivered_id = 0  # Of all updates returned by getUpdates so far
+        self.polls = 0
+        self.server = http.server.ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MockBotApi', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+            disable_nagle_algorithm = True  # Otherwise each reply waits for the client's delayed ACK
+
+            def do_GET(self):
+                self.respond(urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = urllib.parse.parse_qs(body.decode())
+                self.respond(params)
+
+            def respond(self, params):
+                params = {key: value[0] if isinstance(value, list) else value for key, value in params.items()}
+                method = urllib.parse.urlsplit(self.path).path.rsplit('/', 1)[-1]
+                result = api.call(method, params)
+                if result is None:
+                    reply = {'ok': False, 'error_code': 404, 'description': f'Not Found: method {method} not mocked'}
+                else:
+                    reply = {'ok': True, 'result': result}
+                data = json.dumps(reply).encode()
+                self.send_response(200 if result is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass  # Far too chatty under load
+
+        return Handler
+
+    def call(self, method, params):
+        """Returns the result of the API method, or None if it isn't mocked."""
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('deleteWebhook', 'setMyCommands'):
+            return True
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)),
+                                    int(params.get('limit', MAX_UPDATES)))
+        if method == 'sendMessage':
+            return self.send_message(int(params['chat_id']), params['text'], params.get('reply_to_message_id'))
+        return None
+
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.polls += 1
+            while self.pending and self.pending[0]['update_id'] < offset:
+                self.pending.popleft()  # Confirmed
+            while not self.pending and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            updates = list(itertools.islice(self.pending, limit))
+            if updates:
+                self.max_delivered_id = max(self.max_delivered_id, updates[-1]['update_id'])
+            return updates
+
+    def send_message(self, chat_id, text, reply_to_message_id):
+        now = time.perf_counter()
+        with self.lock:
+            message_id = self.take_message_id(chat_id)
+        if self.on_reply is not None:
+            self.on_reply(chat_id, None if reply_to_message_id is None else int(reply_to_message_id), text, now)
+        message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER, 'text': text,
+                   'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'}}
+        return message
+
+    def take_message_id(self, chat_id):
+        # Must hold self.lock.
+        message_id = self.next_message_id.get(chat_id, 1)
+        self.next_message_id[chat_id] = message_id + 1
+        return message_id
+
+    def push_command(self, chat_id, user, text):
+        """
+        Queues the message text from user (a dict with id, first_name and username) in the group chat_id. The text
+        must start with a command. Returns the message_id.
+        """
+        command_length = text.find(' ') if ' ' in text else len(text)
+        with self.lock:
+            message_id = self.take_message_id(chat_id)
+            self.pending.append({
+                'update_id': self.next_update_id,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'from': dict(user, is_bot=False),
+                    'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'},
+                    'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}],
+                },
+            })
+            self.next_update_id += 1
+            self.lock.notify_all()
+        return message_id
+
+    def backlog(self):
+        """Returns the number of queued updates that the bot hasn't fetched yet."""
+        with self.lock:
+            return self.next_update_id - 1 - self.max_delivered_id
@@ -0,0 +1,168 @@
+#!/bin/false
+# Not for execution
+
+import bisect
+import collections.abc
+import sys
+
+
+class PlayerRegistry(collections.abc.Mapping):
+    """
+    The joined players of a game, as key -> firstname in join order, like a read-only dict.
+
+    Players are keyed by their numeric Telegram user id, so that renaming doesn't lose their state. Usernames and
+    firstnames are only an alias table, for display and for resolving '/choose @username'. Players whose id isn't
+    known (e.g. from snapshots of older versions, which keyed everything by username) get negative provisional keys
+    instead; OngoingGame.identify() replaces those as soon as the player writes again.
+
+    Additionally, the keys are kept in an array with a position map, so that picking a player uniformly at random takes
+    O(1). The array stays in join order, so that a pick only depends on the random number, even after a restart;
+    removing a player costs O(n) for that, but is rare. Players can be looked up by firstname, also
+    case-insensitively, and the sorted roster of firstnames is maintained incrementally. Names are interned, as the
+    same players appear in many chats.
+    """
+
+    __slots__ = ('entries', 'by_username', 'slots', 'positions', 'by_firstname', 'by_folded_firstname', 'roster',
+                 'roster_text')
+
+    def __init__(self):
+        self.entries = dict()  # key to (username, firstname), in join order
+        self.by_username = dict()  # username to key
+        self.slots = []  # keys, in join order
+        self.positions = dict()  # key to index in slots
+        self.by_firstname = dict()  # firstname to keys, in join order
+        self.by_folded_firstname = dict()  # firstname.casefold() to keys, in join order
+        self.roster = []  # all firstnames, sorted
+        self.roster_text = None  # Cached result of render_roster()
+
+    def __getitem__(self, key):
+        return self.entries[key][1]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        return {str(key): list(entry) for key, entry in self.entries.items()}  # Like JSON would
+
+    @staticmethod
+    def from_dict(d):
+        registry = PlayerRegistry()
+        for key, (username, firstname) in d.items():
+            registry.add(int(key), username, firstname)
+        return registry
+
+    def username(self, key):
+        return self.entries[key][0]
+
+    def add(self, key, username, firstname):
+        """Adds a player and returns their key, which is a new provisional one if key is None."""
+        if key is None:
+            # Below all provisional keys in use. Only depends on the players, so it's the same after a restart.
+            key = min(min(self.entries, default=0), 0) - 1
+        assert key not in self.entries
+        username = sys.intern(username)
+        firstname = sys.intern(firstname)
+        self.entries[key] = (username, firstname)
+        self.by_username[username] = key
+        self.positions[key] = len(self.slots)
+        self.slots.append(key)
+        self.index_firstname(key, firstname)
+        return key
+
+    def remove(self, key):
+        username, firstname = self.entries.pop(key)
+        if self.by_username.get(username) == key:
+            self.index_username(username)
+        position = self.positions.pop(key)
+        del self.slots[position]
+        for later in self.slots[position:]:
+            self.positions[later] -= 1
+        self.unindex_firstname(key, firstname)
+
+    def rename(self, key, username, firstname):
+        """Updates the alias table when a player's username or firstname has changed."""
+        old_username, old_firstname = self.entries[key]
+        username = sys.intern(username)
+        firstname = sys.intern(firstname)
+        self.entries[key] = (username, firstname)
+        if username != old_username:
+            self.index_username(old_username)
+            self.index_username(username)
+        if firstname != old_firstname:
+            self.unindex_firstname(key, old_firstname)
+            self.index_firstname(key, firstname)
+
+    def rekey(self, mapping):
+        """Replaces keys according to mapping, from old to new keys, keeping all orders."""
+        self.entries = {mapping.get(key, key): entry for key, entry in self.entries.items()}
+        self.by_username = {username: mapping.get(key, key) for username, key in self.by_username.items()}
+        self.slots = [mapping.get(key, key) for key in self.slots]
+        self.positions = {key: position for position, key in enumerate(self.slots)}
+        for index in [self.by_firstname, self.by_folded_firstname]:
+            for keys in index.values():
+                keys[:] = [mapping.get(key, key) for key in keys]
+                self.sort_in_join_order(keys)
+
+    def index_username(self, username):
+        # Several players can have the same username, e.g. if one renamed and the other didn't write since. Like
+        # add() and hence from_dict(), the last one to join wins, so that the result survives a restart.
+        keys = [key for key, entry in self.entries.items() if entry[0] == username]
+        if keys:
+            self.by_username[username] = keys[-1]
+        else:
+            self.by_username.pop(username, None)
+
+    def sort_in_join_order(self, keys):
+        # All indexes keep their keys in join order, however they got there, so that lookups give the same player
+        # after a restart: from_dict() adds the players in join order.
+        keys.sort(key=self.positions.__getitem__)
+
+    def index_firstname(self, key, firstname):
+        for index, index_key in [(self.by_firstname, firstname), (self.by_folded_firstname, firstname.casefold())]:
+            keys = index.setdefault(index_key, [])
+            keys.append(key)
+            self.sort_in_join_order(keys)  # Not necessarily the last one to join, e.g. after rename()
+        bisect.insort(self.roster, firstname)
+        self.roster_text = None
+
+    def unindex_firstname(self, key, firstname):
+        for index, index_key in [(self.by_firstname, firstname), (self.by_folded_firstname, firstname.casefold())]:
+            keys = index[index_key]
+            keys.remove(key)
+            if not keys:
+                del index[index_key]
+        del self.roster[bisect.bisect_left(self.roster, firstname)]
+        self.roster_text = None
+
+    def pick_other(self, rng, key):
+        """Returns a uniformly random player other than key, who must have joined. Uses rng.randrange()."""
+        index = rng.randrange(len(self.slots) - 1)
+        if index >= self.positions[key]:
+            index += 1  # Skip over key
+        return self.slots[index]
+
+    def find_by_username(self, username):
+        """Returns the key of the player with this username, or None."""
+        return self.by_username.get(username)
+
+    def find_by_firstname(self, firstname):
+        """Returns the key of the first player to join with exactly this firstname; failing that, ignoring case; or
+        None."""
+        keys = self.by_firstname.get(firstname) or self.by_folded_firstname.get(firstname.casefold())
+        return keys[0] if keys else None
+
+    def render_roster(self):
+        """Returns the sorted firstnames as 'A, B und C'. Needs at least two players."""
+        if self.roster_text is None:
+            # Extending the message-interface is too painful, so let's do this instead.
+            self.roster_text = f'{", ".join(self.roster[:-1])} und {self.roster[-1]}'
+        return self.roster_text
@@ -0,0 +1,71 @@
+#!/bin/false
+# Not for execution
+
+# Random number generators for the games and the bot's replies.
+#
+# 'fast' is a Mersenne Twister, seeded from the OS and reseeded with fresh OS entropy after RESEED_WORDS 32-bit words
+# of output. It counts the words it has produced, so (seed, words) is its complete state: restoring it means seeding
+# and skipping that many words in one getrandbits() call. That state is saved with the game, so that a chat draws
+# the same numbers after a restart, which helps with debugging.
+# 'system' is secrets.SystemRandom(), which costs an os.urandom() syscall per draw and has no state to save.
+
+import math
+import os
+import random
+import secrets
+
+RESEED_WORDS = 1 << 14
+KINDS = ('fast', 'system')
+
+_random = random.Random.random
+_getrandbits = random.Random.getrandbits
+
+
+class GameRandom(random.Random):
+    def __init__(self, seed=None, reseed=True):
+        # Reseeds from the OS once this many words were produced, unless disabled
+        self.reseed_after = RESEED_WORDS if reseed else math.inf
+        super().__init__(seed)
+
+    def seed(self, a=None, version=2):
+        if a is None:
+            a = int.from_bytes(os.urandom(16), 'big')
+        super().seed(a, version)
+        self.seed_value = a
+        self.words = 0  # 32-bit words produced since seeding
+
+    # All other methods of random.Random draw through these two. They are called for every draw, hence the inlining.
+    def random(self):
+        words = self.words + 2
+        if words > self.reseed_after:
+            self.seed()
+            words = 2
+        self.words = words
+        return _random(self)
+
+    def getrandbits(self, k):
+        words = self.words + ((k + 31) >> 5)
+        if words > self.reseed_after:
+            self.seed()
+            words = (k + 31) >> 5
+        self.words = words
+        return _getrandbits(self, k)
+
+    def to_dict(self):
+        return dict(s=self.seed_value, n=self.words)
+
+    @staticmethod
+    def from_dict(d):
+        rng = GameRandom(d['s'])
+        if d['n']:
+            _getrandbits(rng, 32 * d['n'])  # Skips exactly that many words
+            rng.words = d['n']
+        return rng
+
+
+def make_rng(kind):
+    if kind == 'fast':
+        return GameRandom()
+    if kind == 'system':
+        return secrets.SystemRandom()
+    raise ValueError(f'Unknown kind of RNG {kind!r}, must be one of {KINDS}')
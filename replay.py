@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Replays recorded traffic against logic.handle() and the persistence layer, to benchmark real traffic shapes like
+# bursty game nights, or to check that a change keeps the outcome of real games.
+#
+# Reads the logs of `./bot.py 2>&1 | tee bot_$(date +%s).log` (the dispatcher logs every update it processes), or a
+# capture in JSON lines with the fields of Event, as written by --extract. Commands are handled by a BotState like in
+# bot.py, including /permit, /deny and the resets by OWNER, but without sending any replies. Games live in a GameStore
+# backed by a SnapshotStorage in a temporary directory, and are written the same way, so persistence costs the same.
+#
+# --initial starts from a snapshot file (json or binary, e.g. a copy of wopper_data.json; its journal is ignored)
+# instead of no permitted chats. At the end, the state is diffed against --expect, or else against the initial state.
+
+import argparse
+import ast
+import botstate
+import collections
+import datetime
+import flusher
+import games
+import json
+import logic
+import os
+import re
+import secret  # See secret_template.py
+import shutil
+import storage
+import tempfile
+import time
+
+Event = collections.namedtuple('Event', 't chat_id user_id username firstname command argument')
+
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - telegram\.ext\.dispatcher - DEBUG - Processing Update: (\{.*\})$')
+IGNORED_KEYS = {'init_datetime', 'last_activity', 'rng'}  # Differ between any two runs
+JOURNAL_COMPACT_EVERY = 1000
+PERCENTILES = [0.5, 0.9, 0.99, 0.999, 1]
+MAX_SHOWN_DIFFS = 10
+
+
+def parse_command(text):
+    """Returns (command, argument) of a message text, or None if it isn't a command."""
+    if not text or not text.startswith('/'):
+        return None
+    parts = text.split(' ', 1)
+    command = parts[0][1:].split('@', 1)[0].lower()
+    return botstate.ALIASES.get(command, command), parts[1] if len(parts) == 2 else ''
+
+
+def event_from_update(timestamp, update):
+    message = update.get('message')
+    if message is None or 'from' not in message:
+        return None  # Like cmd_for(), ignore everything but new messages
+    parsed = parse_command(message.get('text'))
+    if parsed is None:
+        return None
+    user = message['from']
+    return Event(timestamp, message['chat']['id'], user['id'], user.get('username'), user.get('first_name'), *parsed)
+
+
+def extract(lines):
+    """Yields the Events in a log of bot.py, or in a JSON lines capture."""
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('{'):
+            yield Event(**json.loads(line))
+            continue
+        match = LOG_LINE.match(line)
+        if match is None:
+            continue
+        timestamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp()
+        event = event_from_update(timestamp, ast.literal_eval(match.group(2)))
+        if event is not None:
+            yield event
+
+
+def read_events(filenames):
+    events = []
+    for filename in filenames:
+        with open(filename, errors='replace') as fp:
+            events.extend(extract(fp))
+    events.sort(key=lambda event: event.t)  # Stable, and the logs may be given in any order
+    return events
+
+
+def load_state(filename, dirname):
+    """Returns all game dicts in a snapshot file, without touching it or its directory."""
+    copy = os.path.join(dirname, 'state' + os.path.splitext(filename)[1])
+    shutil.copyfile(filename, copy)
+    source = storage.SnapshotStorage(copy, os.path.join(dirname, 'state.journal'), JOURNAL_COMPACT_EVERY)
+    state = source.load()
+    source.close()
+    return state
+
+
+class Replayer:
+    def __init__(self, dirname, initial, mode, window, max_changes, permit_all):
+        filename = os.path.join(dirname, 'replay.json')
+        if initial is not None:
+            shutil.copyfile(initial, filename)
+        self.storage = storage.SnapshotStorage(filename, os.path.join(dirname, 'replay.journal'), JOURNAL_COMPACT_EVERY)
+        self.games = games.GameStore(self.storage)
+        self.games.load()
+        self.bot_state = botstate.BotState(self.games, mode, window, max_changes)
+        self.permit_all = permit_all
+        self.counts = collections.Counter()
+        self.elapsed = None  # Of the last run()
+
+    def apply(self, event):
+        with self.bot_state.lock:
+            if event.command in botstate.OWNER_COMMANDS:
+                self.counts[event.command] += 1
+                if event.username == secret.OWNER:
+                    self.bot_state.apply_owner_command(event.command, event.chat_id)
+                return
+            if event.command not in botstate.LOGIC_COMMANDS:
+                self.counts['(not for logic)'] += 1
+                return
+            if event.chat_id not in self.games:
+                if not self.permit_all:
+                    self.counts['(not permitted)'] += 1
+                    return
+                self.games[event.chat_id] = logic.OngoingGame()
+            self.counts[event.command] += 1
+            self.bot_state.handle(event.chat_id, event.command, event.argument, event.firstname, event.username,
+                              event.user_id)
+
+    def run(self, events, speed):
+        """Applies all events, at speed times the recorded speed, or as fast as possible if speed is 0. Returns the
+        latencies in seconds, from when each event was due until it was applied."""
+        latencies = []
+        self.bot_state.flusher.start()
+        begin = time.perf_counter()
+        for event in events:
+            if speed:
+                due = begin + (event.t - events[0].t) / speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            else:
+                due = time.perf_counter()
+            self.apply(event)
+            latencies.append(time.perf_counter() - due)
+        self.bot_state.stop()
+        self.elapsed = time.perf_counter() - begin
+        return latencies
+
+    def state(self):
+        with self.bot_state.lock:
+            return {chat_id: self.games[chat_id].to_dict() for chat_id in self.games.keys()}
+
+
+def peak_rate(events, window):
+    """Returns the most events within any window seconds of the recording."""
+    peak = 0
+    first = 0
+    for last, event in enumerate(events):
+        while event.t - events[first].t >= window:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+
+def comparable(game_dict):
+    game_dict = logic.OngoingGame.from_dict(game_dict).to_dict()  # Migrates older snapshots
+    return {key: value for key, value in game_dict.items() if key not in IGNORED_KEYS}
+
+
+def diff_states(before, after):
+    """Prints how the chats differ between two states, as chat_id -> game_dict, and returns the number of
+    differences."""
+    missing = sorted(before.keys() - after.keys())
+    extra = sorted(after.keys() - before.keys())
+    changed = []
+    for chat_id in sorted(before.keys() & after.keys()):
+        old, new = comparable(before[chat_id]), comparable(after[chat_id])
+        keys = sorted(key for key in old.keys() | new.keys() if old.get(key) != new.get(key))
+        if keys:
+            changed.append((chat_id, keys))
+    print(f'{len(before.keys() & after.keys()) - len(changed)} chats equal, {len(changed)} changed, {len(missing)} '
+          f'gone, {len(extra)} new.')
+    for chat_id, keys in changed[:MAX_SHOWN_DIFFS]:
+        print(f'  chat {chat_id}: {", ".join(keys)}')
+    if missing:
+        print(f'  gone: {missing[:MAX_SHOWN_DIFFS]}')
+    if extra:
+        print(f'  new: {extra[:MAX_SHOWN_DIFFS]}')
+    return len(missing) + len(extra) + len(changed)
+
+
+def report(events, latencies, replayer, speed):
+    span = events[-1].t - events[0].t
+    print(f'Recording: {len(events)} commands in {len(set(event.chat_id for event in events))} chats over '
+          f'{datetime.timedelta(seconds=round(span))}; at most {peak_rate(events, 60)} in a minute, '
+          f'{peak_rate(events, 1)} in a second.')
+    print('Commands: ' + ', '.join(f'{command} {count}' for command, count in replayer.counts.most_common()))
+    pace = f'{speed:g}x recorded speed' if speed else 'as fast as possible'
+    print(f'Replayed {pace} in {replayer.elapsed:.2f} seconds: {len(events) / replayer.elapsed:.0f} commands/s.')
+    latencies = sorted(latencies)
+    print('Latency: ' + '  '.join(f'p{q * 100:g}={latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6:.0f}us'
+                                  for q in PERCENTILES))
+
+
+def run(args):
+    events = read_events(args.logs)
+    print(f'Extracted {len(events)} commands from {len(args.logs)} files.')
+    if args.extract:
+        with open(args.extract, 'w') as fp:
+            for event in events:
+                fp.write(json.dumps(event._asdict(), ensure_ascii=False) + '\n')
+        print(f'Wrote them to {args.extract}.')
+        return 0
+    if not events:
+        return 1
+    with tempfile.TemporaryDirectory() as dirname:
+        initial = load_state(args.initial, dirname) if args.initial else dict()
+        replayer = Replayer(dirname, args.initial, args.mode, args.window, args.max_changes, args.permit_all)
+        latencies = replayer.run(events, args.speed)
+        report(events, latencies, replayer, args.speed)
+        final = replayer.state()
+        replayer.storage.close()
+        if args.expect:
+            print(f'Final state compared to {args.expect}:')
+            return 1 if diff_states(load_state(args.expect, dirname), final) else 0
+        print('Final state compared to the initial state:')
+        diff_states(initial, final)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays recorded commands against logic.handle() and the storage.')
+    parser.add_argument('logs', nargs='+', help='logs of bot.py, or JSON lines captures')
+    parser.add_argument('--extract', metavar='FILE', help='only write the commands to FILE as JSON lines')
+    parser.add_argument('--speed', type=float, default=0, help='multiple of the recorded speed; 0 for full speed')
+    parser.add_argument('--initial', metavar='FILE', help='snapshot to start from')
+    parser.add_argument('--expect', metavar='FILE', help='snapshot to compare the final state to')
+    parser.add_argument('--permit-all', action='store_true', help='play in all chats, even without /permit')
+    parser.add_argument('--mode', choices=flusher.MODES, default='group', help='like PERSISTENCE_MODE')
+    parser.add_argument('--window', type=float, default=0.2, help='like FLUSH_WINDOW')
+    parser.add_argument('--max-changes', type=int, default=100, help='like FLUSH_MAX_CHANGES')
+    exit(run(parser.parse_args()))
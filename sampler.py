@@ -0,0 +1,216 @@
+#!/bin/false
+# Not for execution
+
+# Draws the next player for /random in O(log n), with exactly the weights of OngoingGame.compute_weigths_for().
+#
+# The weight of candidate o for chooser u is
+#     overall_weight * (G - lo)² + individual_weight * (g - lu)²
+# where G and lo are the overall generation and o's entry in track_overall, and g and lu are u's generation and
+# u's entry for o in track_individual. Players occupy slots in join order, and a Fenwick tree sums (1, lo, lo²)
+# over the slots, so the overall weight of any prefix of slots follows from three sums, whatever G currently is.
+#
+# For most pairs, lu is the implicit default of the PairTracker, which only depends on how often u chose before o
+# joined. In join order, that is a step function, so the default weights are constant on a few ranges of slots.
+# Only the explicit pairs differ from it; for each chooser, a sparse Fenwick tree sums their difference to the
+# default as (lu - d, lu² - d²), again independent of g.
+#
+# A draw picks r uniformly in [0, total) and descends the trees to the slot whose prefix sums bracket r.
+# All of this relies on the weights being quadratic, i.e. generation.WEIGHT_EXPONENT == 2.
+
+import bisect
+import generation
+
+
+def lowbit(i):
+    return i & -i
+
+
+class FenwickSampler:
+    def __init__(self, game):
+        self.game = game
+        self.stale = True  # Rebuilt on the next draw
+
+    def rebuild(self):
+        pairs = self.game.track_individual
+        usernames = list(pairs.choosers.keys())  # Join order
+        self.capacity = 8
+        while self.capacity < 2 * len(usernames):
+            self.capacity *= 2
+        self.slots = usernames  # username, or None for a player who left
+        self.slot_seqs = [pairs.choosers[username].joined for username in usernames]
+        self.slot_of = {username: slot for slot, username in enumerate(usernames)}
+        self.holes = 0
+        self.tree = [[0, 0, 0] for _ in range(self.capacity + 1)]
+        for username in usernames:
+            self.update_overall(username, 1)
+        self.corrections = {username: dict() for username in usernames}  # chooser to slot to (a, b)
+        self.correction_trees = {username: dict() for username in usernames}  # chooser to sparse Fenwick tree
+        for chooser_username, chooser in pairs.choosers.items():
+            for chosen_username in chooser.last_chosen.keys():
+                self.set_correction(chooser_username, chosen_username)
+        self.stale = False
+
+    def update_overall(self, username, sign):
+        lo = self.game.track_overall.last_chosen[username]
+        i = self.slot_of[username] + 1
+        while i <= self.capacity:
+            node = self.tree[i]
+            node[0] += sign
+            node[1] += sign * lo
+            node[2] += sign * lo * lo
+            i += lowbit(i)
+
+    def update_correction(self, chooser_username, slot, a, b):
+        tree = self.correction_trees[chooser_username]
+        i = slot + 1
+        while i <= self.capacity:
+            node = tree.setdefault(i, [0, 0])
+            node[0] += a
+            node[1] += b
+            i += lowbit(i)
+
+    def earlier_choices(self, chooser, joined):
+        """How often the chooser chose before the join with the given sequence number."""
+        return sum(count for seq, count in chooser.choices if seq < joined)
+
+    def default_last_chosen(self, chooser, other_username):
+        other = self.game.track_individual.choosers[other_username]
+        return 1 + self.earlier_choices(chooser, other.joined) - generation.DEFAULT_AGE
+
+    def set_correction(self, chooser_username, chosen_username):
+        chooser = self.game.track_individual.choosers[chooser_username]
+        slot = self.slot_of[chosen_username]
+        old_a, old_b = self.corrections[chooser_username].get(slot, (0, 0))
+        lu = chooser.last_chosen[chosen_username]
+        d = self.default_last_chosen(chooser, chosen_username)
+        a, b = lu - d, lu * lu - d * d
+        self.corrections[chooser_username][slot] = (a, b)
+        self.update_correction(chooser_username, slot, a - old_a, b - old_b)
+
+    def clear_correction(self, chooser_username, chosen_username):
+        slot = self.slot_of[chosen_username]
+        a, b = self.corrections[chooser_username].pop(slot)
+        self.update_correction(chooser_username, slot, -a, -b)
+
+    def notify_join(self, username):
+        # Call after the trackers know about the player.
+        if self.stale or len(self.slots) == self.capacity:
+            self.stale = True
+            return
+        self.slot_of[username] = len(self.slots)
+        self.slots.append(username)
+        self.slot_seqs.append(self.game.track_individual.choosers[username].joined)
+        self.update_overall(username, 1)
+        self.corrections[username] = dict()
+        self.correction_trees[username] = dict()
+
+    def notify_leave(self, username):
+        # Call before the trackers forget about the player.
+        if self.stale:
+            return
+        for chooser_username in self.game.track_individual.chosen_by[username]:
+            self.clear_correction(chooser_username, username)
+        self.update_overall(username, -1)
+        self.slots[self.slot_of.pop(username)] = None
+        del self.corrections[username]
+        del self.correction_trees[username]
+        self.holes += 1
+        if self.holes * 2 > len(self.slots):
+            self.stale = True
+
+    def notify_chosen(self, chooser_username, chosen_username, old_lo):
+        # Call after the trackers were updated; old_lo is the chosen player's previous track_overall entry.
+        if self.stale:
+            return
+        lo = self.game.track_overall.last_chosen[chosen_username]
+        i = self.slot_of[chosen_username] + 1
+        while i <= self.capacity:
+            node = self.tree[i]
+            node[1] += lo - old_lo
+            node[2] += lo * lo - old_lo * old_lo
+            i += lowbit(i)
+        self.set_correction(chooser_username, chosen_username)
+
+    def prefix(self, k):
+        """Sums of (1, lo, lo²) over the first k slots."""
+        result = [0, 0, 0]
+        while k > 0:
+            node = self.tree[k]
+            result[0] += node[0]
+            result[1] += node[1]
+            result[2] += node[2]
+            k -= lowbit(k)
+        return result
+
+    def draw(self, chooser_username, rng, overall_weight, individual_weight):
+        """Returns (player key, weight, total weight), like rng.choices() on compute_weigths_for(chooser_username)."""
+        assert generation.WEIGHT_EXPONENT == 2, 'Only quadratic weights can be sampled this way'
+        if self.stale:
+            self.rebuild()
+        pairs = self.game.track_individual
+        chooser = pairs.choosers[chooser_username]
+        big_g = self.game.track_overall.generation
+        g = chooser.generation
+
+        def default_weight(earlier):
+            return individual_weight * (g - (1 + earlier - generation.DEFAULT_AGE)) ** 2
+
+        # Ranges of slots in which the chooser's default entries are the same: bounds[p] is the first slot of range
+        # p, with counts[p] players before it, and cum_default[p] the default weight of all of them.
+        bounds = [0]
+        earliers = [0]
+        for seq, count in chooser.choices:
+            bound = bisect.bisect_right(self.slot_seqs, seq)
+            if bound == bounds[-1]:
+                earliers[-1] += count
+            else:
+                bounds.append(bound)
+                earliers.append(earliers[-1] + count)
+        counts = [self.prefix(bound)[0] for bound in bounds]
+        cum_default = [0]
+        for p in range(1, len(bounds)):
+            cum_default.append(cum_default[-1] + default_weight(earliers[p - 1]) * (counts[p] - counts[p - 1]))
+
+        own_slot = self.slot_of[chooser_username]
+        own_lo = self.game.track_overall.last_chosen[chooser_username]
+        own_weight = overall_weight * (big_g - own_lo) ** 2 + default_weight(0)
+
+        def prefix_weight(k, sums, corrections):
+            """The weight of the first k slots, given the sums of both trees over them."""
+            count, s1, s2 = sums
+            weight = overall_weight * (count * big_g * big_g - 2 * big_g * s1 + s2)
+            p = bisect.bisect_right(bounds, k) - 1
+            weight += cum_default[p] + default_weight(earliers[p]) * (count - counts[p])
+            weight += individual_weight * (-2 * g * corrections[0] + corrections[1])
+            if k > own_slot:
+                weight -= own_weight  # Can't choose oneself
+            return weight
+
+        correction_tree = self.correction_trees[chooser_username]
+        # The last node covers all slots.
+        total = prefix_weight(self.capacity, self.tree[self.capacity], correction_tree.get(self.capacity, (0, 0)))
+        if total <= 0:
+            raise ValueError('Total of weights must be greater than zero')  # Same as rng.choices()
+        r = rng.randrange(total)
+
+        pos = 0
+        sums = [0, 0, 0]
+        corrections = [0, 0]
+        step = self.capacity
+        while step:
+            candidate = pos + step
+            if candidate <= self.capacity:
+                node = self.tree[candidate]
+                candidate_sums = [sums[0] + node[0], sums[1] + node[1], sums[2] + node[2]]
+                correction_node = correction_tree.get(candidate, (0, 0))
+                candidate_corrections = [corrections[0] + correction_node[0], corrections[1] + correction_node[1]]
+                if prefix_weight(candidate, candidate_sums, candidate_corrections) <= r:
+                    pos, sums, corrections = candidate, candidate_sums, candidate_corrections
+            step //= 2
+        chosen_username = self.slots[pos]
+
+        lo = self.game.track_overall.last_chosen[chosen_username]
+        lu = chooser.last_chosen.get(chosen_username)
+        if lu is None:
+            lu = self.default_last_chosen(chooser, chosen_username)
+        return chosen_username, overall_weight * (big_g - lo) ** 2 + individual_weight * (g - lu) ** 2, total
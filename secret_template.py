@@ -2,6 +2,18 @@ TOKEN = '1234567891:ABCDEFGHIJKLMNOPQRSTUVWXYZ1234-abcd'
 OWNER = 'your_username'  # Without the '@'
 MESSAGES_SHEET = 'https://yopad.eu/p/aaaaaaaaaaaaa-365days'
 
+# Optional, see bot.py for the defaults:
+# STORAGE_KIND = 'json'  # or 'binary' or 'sqlite' or 'sharded'
+# PERSISTENCE_MODE = 'group'  # or 'fsync' or 'periodic'
+# FLUSH_WINDOW = 0.2  # seconds
+# FLUSH_MAX_CHANGES = 100
+# GAME_CACHE_SIZE = 1000  # games kept in memory; unlimited by default
+# COLD_AFTER_DAYS = 30  # or None to keep idle games uncompressed
+# COLD_COMPRESSION = 'zlib'  # or 'lzma'
+# SAMPLER = 'shuffle'  # or 'fenwick' for O(log n) draws in /random; see logic.py
+# RNG = 'fast'  # or 'system' for secrets.SystemRandom(); see randomness.py
+# BOT_API_URL = 'http://127.0.0.1:8081/bot'  # only for loadgen.py
+
 MESSAGES_CHICKEN_W = [
         'Was ist dein Lieblings-Sorte Eis?',
         'Was hast du als Letztes gegessen?',
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Plays many synthetic rounds of /random through the real logic module, for several choices of
+# generation.DEFAULT_AGE, generation.WEIGHT_EXPONENT and logic.OVERALL_WEIGHT/INDIVIDUAL_WEIGHT, and reports how fair
+# the outcome is:
+# - wait: rounds between two times a player is chosen (or between joining and being chosen)
+# - repeat: how often a chooser picks the same player as last time
+# - pingpong: how often the chosen player is the one who chose last round
+# - chi2/dof: Pearson's chi-square of how often each player was chosen, against picking uniformly among all others
+# Simulations are spread over a process pool; each round depends on the previous one, so they are sequential.
+
+import argparse
+import collections
+import concurrent.futures
+import generation
+import logic
+import random
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def simulate(params, room_size, churn, rounds, seed):
+    default_age, exponent, overall_weight, individual_weight = params
+    # Every task sets the parameters anew, as worker processes are reused for different parameters.
+    generation.DEFAULT_AGE = default_age
+    generation.WEIGHT_EXPONENT = exponent
+    logic.OVERALL_WEIGHT = overall_weight
+    logic.INDIVIDUAL_WEIGHT = individual_weight
+    rng = random.Random(f'{seed} {params} {room_size} {churn}')
+    game = logic.OngoingGame(seed=rng.random(), sampler_kind='fenwick' if exponent == 2 else 'shuffle')
+    next_player = 0
+
+    def join():
+        nonlocal next_player
+        user_id = next_player  # Rejoining counts as a new player
+        next_player += 1
+        game.notify_join(f'usna{user_id}', f'fina{user_id}', user_id)
+        last_chosen_round[user_id] = round_number
+
+    waits = collections.Counter()
+    chosen = collections.Counter()
+    expected = collections.Counter()
+    previous_choice = dict()  # chooser to whom they chose last
+    last_chosen_round = dict()
+    repeats = 0
+    pingpongs = 0
+    round_number = 0
+    for _ in range(room_size):
+        join()
+    chooser = rng.choice(list(game.joined_users.keys()))
+    previous_chooser = None
+    for round_number in range(rounds):
+        if rng.random() < churn:
+            # Someone leaves and a new player joins, so the room size stays the same.
+            leaving = rng.choice(list(game.joined_users.keys()))
+            game.notify_leave(leaving)
+            join()
+            if leaving == chooser:
+                chooser = rng.choice(list(game.joined_users.keys()))
+            if leaving == previous_chooser:
+                previous_chooser = None
+        response = logic.compute_random(game, '', game.firstname(chooser), game.username(chooser), chooser)
+        assert response[0] == 'random_chosen', response
+        target = game.joined_users.find_by_username(response[1])
+
+        candidates = len(game.joined_users) - 1
+        for user_id in game.joined_users.keys():
+            if user_id != chooser:
+                expected[user_id] += 1 / candidates
+        chosen[target] += 1
+        waits[round_number - last_chosen_round[target]] += 1
+        last_chosen_round[target] = round_number
+        if previous_choice.get(chooser) == target:
+            repeats += 1
+        if target == previous_chooser:
+            pingpongs += 1
+        previous_choice[chooser] = target
+        previous_chooser = chooser
+        game.last_wop = 'w'  # So that the chosen player may do /random next
+        chooser = target
+
+    chi2 = sum((chosen[user_id] - e) ** 2 / e for user_id, e in expected.items() if e > 0)
+    dof = max(1, len([e for e in expected.values() if e > 0]) - 1)
+    return dict(waits=waits, repeats=repeats, pingpongs=pingpongs, rounds=rounds, chi2=chi2, dof=dof)
+
+
+def percentiles(waits, ps):
+    if numpy is not None:
+        values = numpy.array(list(waits.keys()))
+        counts = numpy.array(list(waits.values()))
+        order = numpy.argsort(values)
+        cumulative = numpy.cumsum(counts[order])
+        return [int(values[order][numpy.searchsorted(cumulative, p * cumulative[-1])]) for p in ps]
+    result = []
+    total = sum(waits.values())
+    for p in ps:
+        seen = 0
+        for value in sorted(waits.keys()):
+            seen += waits[value]
+            if seen >= p * total:
+                result.append(value)
+                break
+    return result
+
+
+def run(args):
+    grid = [(age, exponent, overall, individual)
+            for age in args.ages for exponent in args.exponents for overall, individual in args.coefficients]
+    tasks = [(params, room_size, args.churn, args.rounds, seed)
+             for params in grid for room_size in args.room_sizes for seed in range(args.repeat)]
+    begin = time.perf_counter()
+    results = collections.defaultdict(list)
+    with concurrent.futures.ProcessPoolExecutor(args.processes) as executor:
+        futures = {executor.submit(simulate, *task): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            params, room_size = futures[future][:2]
+            results[params, room_size].append(future.result())
+    duration = time.perf_counter() - begin
+    total_rounds = args.rounds * len(tasks)
+    print(f'Simulated {total_rounds} rounds in {duration:.1f} seconds ({total_rounds / duration:.0f} rounds/s).')
+
+    print('age exp  coeff players | wait: mean  p50  p90  p99   max | repeat% pingpong% | chi2/dof')
+    for (params, room_size), room_results in sorted(results.items()):
+        age, exponent, overall, individual = params
+        waits = collections.Counter()
+        for result in room_results:
+            waits.update(result['waits'])
+        rounds = sum(result['rounds'] for result in room_results)
+        mean_wait = sum(value * count for value, count in waits.items()) / sum(waits.values())
+        p50, p90, p99 = percentiles(waits, [0.5, 0.9, 0.99])
+        repeat = 100 * sum(result['repeats'] for result in room_results) / rounds
+        pingpong = 100 * sum(result['pingpongs'] for result in room_results) / rounds
+        chi2 = sum(result['chi2'] for result in room_results) / sum(result['dof'] for result in room_results)
+        print(f'{age:3} {exponent:3} {overall:3}:{individual:<3} {room_size:7} |'
+              f' {mean_wait:10.2f} {p50:4} {p90:4} {p99:4} {max(waits):5} | {repeat:7.2f} {pingpong:9.2f} | {chi2:8.2f}')
+
+
+def parse_list(convert):
+    return lambda text: [convert(item) for item in text.split(',')]
+
+
+def parse_coefficients(text):
+    return [tuple(int(c) for c in pair.split(':')) for pair in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates /random to tune its parameters.')
+    parser.add_argument('--ages', type=parse_list(int), default=[1, 3, 6], help='values for DEFAULT_AGE, e.g. 1,3,6')
+    parser.add_argument('--exponents', type=parse_list(int), default=[1, 2, 3], help='values for WEIGHT_EXPONENT')
+    parser.add_argument('--coefficients', type=parse_coefficients, default=[(1, 1), (1, 2), (2, 1)],
+                        help='OVERALL_WEIGHT:INDIVIDUAL_WEIGHT pairs, e.g. 1:1,1:2')
+    parser.add_argument('--room-sizes', type=parse_list(int), default=[3, 8, 20], help='players per room')
+    parser.add_argument('--churn', type=float, default=0.05, help='chance per round that a player is replaced by a new one')
+    parser.add_argument('--rounds', type=int, default=20000, help='rounds per simulation')
+    parser.add_argument('--repeat', type=int, default=4, help='simulations per parameters and room size')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes; all cores by default')
+    run(parser.parse_args())
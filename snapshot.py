@@ -0,0 +1,257 @@
+#!/bin/false
+# Not for execution
+
+# Compact binary encoding for JSON-like data, in particular for {chat_id: game_dict} snapshots.
+#
+# A record consists of:
+#     varint number of strings, then each string as varint length + UTF-8 bytes
+#     one tagged value
+# Version 1 layout:
+#     MAGIC, version byte 1
+#     one record
+# Version 2 layout, indexed by chat id so that games can be decoded one by one:
+#     MAGIC, version byte 2
+#     varint number of games, then for each game its zigzag chat id and varint record length
+#     the records, in the same order
+# Each value starts with a tag byte. Integers are zigzag varints, floats are 8-byte IEEE doubles, strings are
+# varint indices into the string table, lists and dicts are a varint length followed by their items (or key-value
+# pairs). As every username is stored only once, and the tracker dicts shrink to a few bytes per entry, this is
+# much smaller than the JSON file.
+# The format is self-describing, so it doesn't need to change when the game dicts do.
+
+import struct
+
+MAGIC = b'WOPS'
+VERSION_PLAIN = 1
+VERSION_INDEXED = 2
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_LIST = 6
+TAG_DICT = 7
+
+FLOAT = struct.Struct('<d')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_varint(out, value):
+    assert value >= 0
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def unzigzag(value):
+    return (value >> 1) if not (value & 1) else -((value + 1) >> 1)
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class Encoder:
+    def __init__(self):
+        self.strings = dict()  # str to index
+        self.out = bytearray()
+
+    def encode_value(self, value):
+        out = self.out
+        if value is None:
+            out.append(TAG_NONE)
+        elif value is False:
+            out.append(TAG_FALSE)
+        elif value is True:
+            out.append(TAG_TRUE)
+        elif isinstance(value, int):
+            out.append(TAG_INT)
+            write_varint(out, zigzag(value))
+        elif isinstance(value, float):
+            out.append(TAG_FLOAT)
+            out += FLOAT.pack(value)
+        elif isinstance(value, str):
+            index = self.strings.get(value)
+            if index is None:
+                index = len(self.strings)
+                self.strings[value] = index
+            out.append(TAG_STR)
+            write_varint(out, index)
+        elif isinstance(value, (list, tuple)):
+            out.append(TAG_LIST)
+            write_varint(out, len(value))
+            for item in value:
+                self.encode_value(item)
+        elif isinstance(value, dict):
+            out.append(TAG_DICT)
+            write_varint(out, len(value))
+            for k, v in value.items():
+                self.encode_value(k)
+                self.encode_value(v)
+        else:
+            raise SnapshotError(f'Cannot encode {type(value)}')
+
+    def finish(self):
+        header = bytearray()
+        write_varint(header, len(self.strings))
+        for string in self.strings.keys():  # Dicts keep insertion order, which is the index order.
+            encoded = string.encode()
+            write_varint(header, len(encoded))
+            header += encoded
+        return bytes(header + self.out)
+
+
+class Decoder:
+    def __init__(self, data, pos, strings):
+        self.data = data
+        self.pos = pos
+        self.strings = strings
+
+    def decode_value(self):
+        # Hot path: Most varints fit into a single byte, so check that before calling read_varint.
+        data = self.data
+        tag = data[self.pos]
+        self.pos += 1
+        if tag == TAG_STR:
+            index = data[self.pos]
+            if index < 0x80:
+                self.pos += 1
+            else:
+                index, self.pos = read_varint(data, self.pos)
+            return self.strings[index]
+        elif tag == TAG_INT:
+            zigzag = data[self.pos]
+            if zigzag < 0x80:
+                self.pos += 1
+            else:
+                zigzag, self.pos = read_varint(data, self.pos)
+            return unzigzag(zigzag)
+        elif tag == TAG_DICT:
+            length, self.pos = read_varint(data, self.pos)
+            result = dict()
+            decode_value = self.decode_value
+            for _ in range(length):
+                k = decode_value()
+                result[k] = decode_value()
+            return result
+        elif tag == TAG_LIST:
+            length, self.pos = read_varint(data, self.pos)
+            decode_value = self.decode_value
+            return [decode_value() for _ in range(length)]
+        elif tag == TAG_NONE:
+            return None
+        elif tag == TAG_FALSE:
+            return False
+        elif tag == TAG_TRUE:
+            return True
+        elif tag == TAG_FLOAT:
+            value, = FLOAT.unpack_from(data, self.pos)
+            self.pos += FLOAT.size
+            return value
+        else:
+            raise SnapshotError(f'Unknown tag {tag} at offset {self.pos - 1}')
+
+
+def is_snapshot(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_record(value):
+    encoder = Encoder()
+    encoder.encode_value(value)
+    return encoder.finish()
+
+
+def decode_record(data, pos, end):
+    if end is None:
+        end = len(data)
+    num_strings, pos = read_varint(data, pos)
+    strings = []
+    for _ in range(num_strings):
+        length, pos = read_varint(data, pos)
+        strings.append(bytes(data[pos:pos + length]).decode())
+        pos += length
+    decoder = Decoder(data, pos, strings)
+    value = decoder.decode_value()
+    if decoder.pos != end:
+        raise SnapshotError(f'Record ends at offset {decoder.pos}, expected {end}')
+    return value
+
+
+def encode(value):
+    return MAGIC + bytes([VERSION_PLAIN]) + encode_record(value)
+
+
+def encode_indexed(records):
+    """Takes a dict chat_id -> record (as returned by encode_record)."""
+    header = bytearray(MAGIC)
+    header.append(VERSION_INDEXED)
+    write_varint(header, len(records))
+    for chat_id, record in records.items():
+        write_varint(header, zigzag(chat_id))
+        write_varint(header, len(record))
+    return b''.join([header, *records.values()])
+
+
+class IndexedSnapshot:
+    """Reads only the index on construction; each game is decoded on demand."""
+
+    def __init__(self, data):
+        if not is_snapshot(data) or data[len(MAGIC)] != VERSION_INDEXED:
+            raise SnapshotError('Not an indexed snapshot')
+        self.data = data
+        pos = len(MAGIC) + 1
+        num_records, pos = read_varint(data, pos)
+        lengths = []
+        for _ in range(num_records):
+            chat_id, pos = read_varint(data, pos)
+            length, pos = read_varint(data, pos)
+            lengths.append((unzigzag(chat_id), length))
+        self.offsets = dict()  # chat_id to (begin, end)
+        for chat_id, length in lengths:
+            self.offsets[chat_id] = (pos, pos + length)
+            pos += length
+        if pos != len(data):
+            raise SnapshotError(f'Index covers {pos} bytes, but the snapshot has {len(data)}')
+
+    def chat_ids(self):
+        return self.offsets.keys()
+
+    def raw(self, chat_id):
+        begin, end = self.offsets[chat_id]
+        return bytes(self.data[begin:end])
+
+    def load(self, chat_id):
+        begin, end = self.offsets[chat_id]
+        return decode_record(self.data, begin, end)
+
+
+def decode(data):
+    if not is_snapshot(data):
+        raise SnapshotError('Not a binary snapshot')
+    version = data[len(MAGIC)]
+    if version == VERSION_PLAIN:
+        return decode_record(data, len(MAGIC) + 1, len(data))
+    elif version == VERSION_INDEXED:
+        indexed = IndexedSnapshot(data)
+        return {chat_id: indexed.load(chat_id) for chat_id in indexed.chat_ids()}
+    else:
+        raise SnapshotError(f'Unsupported snapshot version {version}')
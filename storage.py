@@ -0,0 +1,427 @@
+#!/bin/false
+# Not for execution
+
+from atomicwrites import atomic_write
+import concurrent.futures
+import journal
+import json
+import logging
+import mmap
+import os
+import snapshot
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# All storages speak in terms of game dicts, as returned by OngoingGame.to_dict().
+# Each implements:
+# - chat_ids(): returns the ids of all stored chats, without loading the games
+# - load_game(chat_id): returns the game_dict of a single chat
+# - load(chat_ids=None): returns a dict chat_id -> game_dict, optionally only for the given chats
+# - write(changes): takes a dict chat_id -> game_dict, or None if the game was deleted
+# - write_all(games): replaces everything by the dict chat_id -> game_dict; a game_dict may also be UNCHANGED,
+#   which keeps whatever is stored for that chat right now
+# - begin_write_all(games): like write_all(), but returns a function that finishes the writing, which may be called
+#   from another thread while the storage is in use
+# - wants_snapshot: whether the caller should do a write_all() soon
+# - close()
+# All methods may be called from any thread.
+
+UNCHANGED = object()
+
+
+class SnapshotStorage:
+    """
+    A single snapshot file, plus a journal of changes since then.
+
+    The snapshot is written either as JSON (readable, good for debugging and export) or in the indexed binary format
+    of snapshot.py (compact, and games can be read one by one). Both are read regardless of snapshot_format, so
+    switching between them just works.
+
+    The JSON snapshot has one line per chat. Each game is kept as its encoded line (a "fragment") until it is needed,
+    and written back verbatim unless it changed, so a snapshot only encodes the games that changed since the last one.
+    """
+
+    def __init__(self, filename, journal_filename, compact_every, snapshot_format='json'):
+        assert snapshot_format in ('json', 'binary'), snapshot_format
+        self.filename = filename
+        self.journal = journal.Journal(journal_filename)
+        self.compact_every = compact_every
+        self.snapshot_format = snapshot_format
+        self.lock = threading.Lock()
+        self.opened = False
+        self.mapping = None  # mmap of a binary snapshot
+        self.indexed = None  # snapshot.IndexedSnapshot, if the snapshot has an index
+        self.decoded = dict()  # chat_id to game_dict, for snapshots without an index or fragments
+        self.fragments = dict()  # chat_id to the game_dict as compact JSON, if known; always the most recent state
+        self.journaled = dict()  # chat_id to game_dict (or None), for everything newer than the snapshot
+
+    def open_snapshot(self):
+        # Must hold self.lock.
+        if self.opened:
+            return
+        self.opened = True
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as fp:
+                if fp.read(len(snapshot.MAGIC)) == snapshot.MAGIC:
+                    self.mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        self.indexed = snapshot.IndexedSnapshot(self.mapping)
+                    except snapshot.SnapshotError:
+                        self.decoded = snapshot.decode(self.mapping)  # Old, unindexed format
+                else:
+                    fp.seek(0)
+                    fragments = read_fragments(fp)
+                    if fragments is not None:
+                        self.fragments = fragments
+                    else:
+                        fp.seek(0)  # Written by json.dump(), so decode it all
+                        self.decoded = {int(chat_id): game_dict for chat_id, game_dict in json.load(fp).items()}
+            logger.info(f'Opened {self.filename} with {len(self.snapshot_chat_ids())} games.')
+        else:
+            logger.info(f'Permanence file {self.filename} does not exist; starting with all games denied.')
+
+        self.journaled = self.journal.replay()
+        for chat_id in self.journaled.keys():
+            self.fragments.pop(chat_id, None)  # Outdated
+        if self.journal.entries:
+            logger.info(f'Replayed {self.journal.entries} journal entries for {len(self.journaled)} chats.')
+
+    def snapshot_chat_ids(self):
+        if self.indexed is not None:
+            return self.indexed.chat_ids()
+        return self.decoded.keys() | self.fragments.keys()
+
+    def chat_ids(self):
+        with self.lock:
+            self.open_snapshot()
+            chat_ids = set(self.snapshot_chat_ids())
+            for chat_id, game_dict in self.journaled.items():
+                if game_dict is None:
+                    chat_ids.discard(chat_id)
+                else:
+                    chat_ids.add(chat_id)
+            return chat_ids
+
+    def load_game_locked(self, chat_id):
+        if chat_id in self.journaled:
+            game_dict = self.journaled[chat_id]
+        elif self.indexed is not None:
+            game_dict = self.indexed.load(chat_id)
+        elif chat_id in self.fragments:
+            game_dict = json.loads(self.fragments[chat_id])
+        else:
+            game_dict = self.decoded[chat_id]
+        if game_dict is None:
+            raise KeyError(chat_id)
+        return game_dict
+
+    def load_game(self, chat_id):
+        with self.lock:
+            self.open_snapshot()
+            return self.load_game_locked(chat_id)
+
+    def load(self, chat_ids=None):
+        known_chat_ids = self.chat_ids()
+        if chat_ids is None:
+            chat_ids = known_chat_ids
+        return {chat_id: self.load_game(chat_id) for chat_id in chat_ids if chat_id in known_chat_ids}
+
+    def write(self, changes):
+        with self.lock:
+            self.open_snapshot()
+            # Append the new state of just the changed chats, instead of rewriting all chats.
+            lines = []
+            for chat_id, game_dict in changes.items():
+                fragment = json.dumps(game_dict, separators=(',', ':'))
+                lines.append(journal.Journal.encode_fragment(chat_id, fragment))
+                if game_dict is None:
+                    self.fragments.pop(chat_id, None)
+                else:
+                    self.fragments[chat_id] = fragment  # The next JSON snapshot can reuse it
+            self.journal.write(lines)
+            self.journaled.update(changes)
+
+    def begin_write_all(self, games):
+        """
+        Captures what write_all(games) would write, and returns a function that actually writes it.
+
+        The capture is cheap: It only rotates the journal, and resolves games that are UNCHANGED because of it. The
+        returned function does all the encoding and writing, may run on any thread, and the storage can still be
+        used in the meantime. Don't begin another one before it has returned.
+        """
+        with self.lock:
+            self.open_snapshot()
+            captured = dict()
+            for chat_id, game_dict in games.items():
+                if game_dict is UNCHANGED:
+                    if self.snapshot_format == 'json' and chat_id in self.fragments:
+                        game_dict = self.fragments[chat_id]
+                    elif chat_id in self.journaled or self.indexed is None:
+                        game_dict = self.load_game_locked(chat_id)  # Game dicts are never modified, so no need to copy.
+                # Now a game_dict, a fragment, or still UNCHANGED if it's only in the binary snapshot file.
+                captured[chat_id] = game_dict
+            indexed = self.indexed  # Stays open until the new snapshot is in place.
+            # New writes go to a fresh journal; the old one is only dropped once the snapshot covers it.
+            self.journal.rotate()
+
+        def write():
+            if self.snapshot_format == 'binary':
+                records = dict()
+                for chat_id, game_dict in captured.items():
+                    if game_dict is UNCHANGED:
+                        records[chat_id] = indexed.raw(chat_id)  # No need to decode and re-encode
+                    else:
+                        records[chat_id] = snapshot.encode_record(game_dict)
+                with atomic_write(self.filename, mode='wb', overwrite=True) as fp:
+                    fp.write(snapshot.encode_indexed(records))
+            else:
+                fragments = dict()
+                for chat_id, game_dict in captured.items():
+                    if game_dict is UNCHANGED:
+                        game_dict = indexed.load(chat_id)
+                    if isinstance(game_dict, str):
+                        fragments[chat_id] = game_dict
+                    else:
+                        fragments[chat_id] = json.dumps(game_dict, separators=(',', ':'))
+                with atomic_write(self.filename, overwrite=True) as fp:
+                    write_fragments(fp, fragments)
+            with self.lock:
+                # Only now is it safe to drop the old journal: Every entry in it is already part of the snapshot.
+                self.journal.drop_old()
+                self.close_snapshot()
+            logger.info(f'Wrote {len(captured)} to {self.filename}.')
+        return write
+
+    def write_all(self, games):
+        self.begin_write_all(games)()
+
+    @property
+    def wants_snapshot(self):
+        return self.journal.entries >= self.compact_every
+
+    def close_snapshot(self):
+        # Must hold self.lock. The next access reopens the snapshot.
+        self.indexed = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.decoded = dict()
+        self.fragments = dict()
+        self.journaled = dict()
+        self.opened = False
+
+    def close(self):
+        with self.lock:
+            self.close_snapshot()
+
+
+def write_fragments(fp, fragments):
+    """Writes a dict chat_id -> fragment as a JSON object, one chat per line."""
+    fp.write('{\n')
+    fp.write(',\n'.join(f'"{chat_id}":{fragment}' for chat_id, fragment in fragments.items()))
+    fp.write('\n}\n')
+
+
+def read_fragments(fp):
+    """Returns the dict chat_id -> fragment written by write_fragments(), or None if the binary fp is laid out
+    differently."""
+    lines = fp.read().decode().split('\n')
+    if lines[:1] != ['{'] or lines[-2:] != ['}', '']:
+        return None
+    fragments = dict()
+    for line in lines[1:-2]:
+        if not line.startswith('"'):
+            return None
+        key, _, fragment = line.rstrip(',').partition(':')
+        fragments[int(json.loads(key))] = fragment
+    return fragments
+
+
+class SqliteStorage:
+    """One row per chat in an SQLite database in WAL mode, so that a change only touches the affected rows."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = None  # Connected on first use, so that merely constructing this doesn't create files
+
+    def connection(self):
+        # Must hold self.lock.
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS games (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+            self.conn.commit()
+        return self.conn
+
+    def chat_ids(self):
+        with self.lock:
+            return {chat_id for chat_id, in self.connection().execute('SELECT chat_id FROM games')}
+
+    def load_game(self, chat_id):
+        with self.lock:
+            row = self.connection().execute('SELECT data FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            raise KeyError(chat_id)
+        return json.loads(row[0])
+
+    def load(self, chat_ids=None):
+        with self.lock:
+            conn = self.connection()
+            if chat_ids is None:
+                rows = conn.execute('SELECT chat_id, data FROM games').fetchall()
+            else:
+                rows = []
+                for chat_id in chat_ids:
+                    rows.extend(conn.execute('SELECT chat_id, data FROM games WHERE chat_id = ?', (chat_id,)).fetchall())
+        logger.info(f'Loaded {len(rows)} games from {self.filename}.')
+        return {chat_id: json.loads(data) for chat_id, data in rows}
+
+    def write(self, changes):
+        with self.lock, self.connection() as conn:
+            for chat_id, game_dict in changes.items():
+                if game_dict is None:
+                    conn.execute('DELETE FROM games WHERE chat_id = ?', (chat_id,))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO games (chat_id, data) VALUES (?, ?)', (chat_id, json.dumps(game_dict, separators=(',', ':'))))
+
+    def write_all(self, games):
+        with self.lock, self.connection() as conn:
+            stale_chat_ids = [(chat_id,) for chat_id, in conn.execute('SELECT chat_id FROM games').fetchall() if chat_id not in games]
+            conn.executemany('DELETE FROM games WHERE chat_id = ?', stale_chat_ids)
+            conn.executemany('INSERT OR REPLACE INTO games (chat_id, data) VALUES (?, ?)',
+                             [(chat_id, json.dumps(game_dict, separators=(',', ':'))) for chat_id, game_dict in games.items() if game_dict is not UNCHANGED])
+        logger.info(f'Wrote {len(games)} to {self.filename}.')
+
+    def begin_write_all(self, games):
+        # Nothing to gain from writing in the background, as every game goes to its own place anyway.
+        self.write_all(games)
+        return lambda: None
+
+    @property
+    def wants_snapshot(self):
+        return False  # Every write already goes to its final place.
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class ShardedStorage:
+    """
+    One JSON file per chat in a directory, plus a manifest listing the permitted chats.
+
+    Shards that are not in the manifest are leftovers and ignored.
+    """
+
+    def __init__(self, dirname, threads=8):
+        self.dirname = dirname
+        self.threads = threads
+        self.lock = threading.Lock()  # Guards the manifest
+        self.manifest = None  # Set of chat ids, read on first use
+
+    def manifest_filename(self):
+        return os.path.join(self.dirname, 'manifest.json')
+
+    def shard_filename(self, chat_id):
+        return os.path.join(self.dirname, f'{chat_id}.json')
+
+    def read_manifest(self):
+        # Must hold self.lock.
+        if self.manifest is None:
+            if os.path.exists(self.manifest_filename()):
+                with open(self.manifest_filename(), 'r') as fp:
+                    self.manifest = set(json.load(fp))
+            else:
+                self.manifest = set()
+        return self.manifest
+
+    def write_manifest(self, chat_ids):
+        # Must hold self.lock.
+        os.makedirs(self.dirname, exist_ok=True)
+        with atomic_write(self.manifest_filename(), overwrite=True) as fp:
+            json.dump(sorted(chat_ids), fp)
+        self.manifest = set(chat_ids)
+
+    def read_shard(self, chat_id):
+        with open(self.shard_filename(chat_id), 'r') as fp:
+            return json.load(fp)
+
+    def write_shard(self, chat_id, game_dict):
+        with atomic_write(self.shard_filename(chat_id), overwrite=True) as fp:
+            json.dump(game_dict, fp, separators=(',', ':'))
+
+    def remove_shard(self, chat_id):
+        if os.path.exists(self.shard_filename(chat_id)):
+            os.remove(self.shard_filename(chat_id))
+
+    def chat_ids(self):
+        with self.lock:
+            return set(self.read_manifest())
+
+    def load_game(self, chat_id):
+        with self.lock:
+            if chat_id not in self.read_manifest():
+                raise KeyError(chat_id)
+            return self.read_shard(chat_id)
+
+    def load(self, chat_ids=None):
+        known_chat_ids = self.chat_ids()
+        if chat_ids is None:
+            chat_ids = known_chat_ids
+        else:
+            chat_ids = [chat_id for chat_id in chat_ids if chat_id in known_chat_ids]
+        chat_ids = list(chat_ids)
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+            games = dict(zip(chat_ids, executor.map(self.read_shard, chat_ids)))
+        logger.info(f'Loaded {len(games)} games from {self.dirname}.')
+        return games
+
+    def write(self, changes):
+        with self.lock:
+            os.makedirs(self.dirname, exist_ok=True)
+            old_chat_ids = self.read_manifest()
+            new_chat_ids = set(old_chat_ids)
+            for chat_id, game_dict in changes.items():
+                if game_dict is None:
+                    new_chat_ids.discard(chat_id)
+                else:
+                    new_chat_ids.add(chat_id)
+            # A shard must exist before the manifest mentions it, and must not be removed while it's still mentioned.
+            for chat_id, game_dict in changes.items():
+                if game_dict is not None:
+                    self.write_shard(chat_id, game_dict)
+            if new_chat_ids != old_chat_ids:
+                self.write_manifest(new_chat_ids)
+            for chat_id, game_dict in changes.items():
+                if game_dict is None:
+                    self.remove_shard(chat_id)
+
+    def write_all(self, games):
+        with self.lock:
+            os.makedirs(self.dirname, exist_ok=True)
+            changed = {chat_id: game_dict for chat_id, game_dict in games.items() if game_dict is not UNCHANGED}
+            with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+                list(executor.map(self.write_shard, changed.keys(), changed.values()))
+            self.write_manifest(games.keys())
+            for filename in os.listdir(self.dirname):
+                chat_id, ext = os.path.splitext(filename)
+                if ext == '.json' and filename != 'manifest.json' and int(chat_id) not in games:
+                    os.remove(os.path.join(self.dirname, filename))
+        logger.info(f'Wrote {len(games)} to {self.dirname}.')
+
+    def begin_write_all(self, games):
+        # Nothing to gain from writing in the background, as every game goes to its own place anyway.
+        self.write_all(games)
+        return lambda: None
+
+    @property
+    def wants_snapshot(self):
+        return False  # Every write already goes to its final place.
+
+    def close(self):
+        pass
@@ -1,10 +1,30 @@
 #!/usr/bin/env python3
 # Run as: ./tests.py
 
-from generation import GenerationTracker
+from generation import GenerationTracker, PairTracker
+import random
 import unittest
 
 
+def random_walk(rng, steps, num_keys, players, chosen_share=3):
+    """
+    Yields (step, action, *keys) of a random walk over the keys 0 .. num_keys - 1: ('join', key), ('leave', key) or
+    ('chosen', chooser, chosen). players() must return the keys that are in, in join order, after the caller applied
+    the previous action. Joining players who are in already is skipped.
+    """
+    for step in range(steps):
+        action = rng.choice(['join', 'leave'] + ['chosen'] * chosen_share)
+        keys = players()
+        if action == 'join' or len(keys) < 2:
+            key = rng.randrange(num_keys)
+            if key not in keys:
+                yield step, 'join', key
+        elif action == 'leave':
+            yield step, 'leave', rng.choice(keys)
+        else:
+            yield step, 'chosen', *rng.sample(keys, 2)
+
+
 class TestSequences(unittest.TestCase):
     def check_sequence(self, sequence):
         generator = GenerationTracker()
@@ -29,6 +49,16 @@ class TestSequences(unittest.TestCase):
     def test_empty(self):
         self.check_sequence([])
 
+    def test_version(self):
+        generator = GenerationTracker()
+        self.assertEqual(0, generator.version)
+        generator.get_weights()
+        self.assertEqual(0, generator.version)
+        generator.notify_join('a')
+        generator.notify_chosen('a')
+        generator.notify_leave('a')
+        self.assertEqual(3, generator.version)
+
     def test_join(self):
         self.check_sequence([
             ('join', 'a', dict(a=9)),
@@ -84,5 +114,70 @@ class TestSequences(unittest.TestCase):
         ])
 
 
+class TestPairTracker(unittest.TestCase):
+    def test_like_dense(self):
+        # The dense reference: One GenerationTracker per user, as OngoingGame used to do it.
+        rng = random.Random('Static seed for reproducible randomness, do not change')
+        dense = dict()
+        sparse = PairTracker()
+        for step, action, *keys in random_walk(rng, 2000, 12, lambda: list(dense.keys())):
+            with self.subTest(step=step):
+                if action == 'join':
+                    new_tracker = GenerationTracker()
+                    for other_key, other_tracker in dense.items():
+                        new_tracker.notify_join(other_key)
+                        other_tracker.notify_join(keys[0])
+                    dense[keys[0]] = new_tracker
+                    sparse.notify_join(keys[0])
+                elif action == 'leave':
+                    del dense[keys[0]]
+                    for other_tracker in dense.values():
+                        other_tracker.notify_leave(keys[0])
+                    sparse.notify_leave(keys[0])
+                else:
+                    dense[keys[0]].notify_chosen(keys[1])
+                    sparse.notify_chosen(*keys)
+                for key, tracker in dense.items():
+                    self.assertEqual(tracker.get_weights(), sparse.get_weights(key))
+                self.assertEqual({k: t.to_dict() for k, t in dense.items()}, sparse.to_legacy_dict())
+                if step % 100 == 0:
+                    sparse = PairTracker.from_dict(sparse.to_dict())
+                elif step % 100 == 50:
+                    sparse = PairTracker.from_legacy_dict(sparse.to_legacy_dict())
+
+    def test_sparse(self):
+        sparse = PairTracker()
+        for i in range(100):
+            sparse.notify_join(f'usna{i}')
+        sparse.notify_chosen('usna0', 'usna1')
+        sparse.notify_leave('usna50')
+        d = sparse.to_dict()
+        self.assertEqual({'usna1': 2}, d['u']['usna0']['lc'])
+        self.assertEqual(0, sum(len(sub_dict['lc']) for u, sub_dict in d['u'].items() if u != 'usna0'))
+        legacy = sparse.to_legacy_dict()
+        self.assertEqual(99, len(legacy))
+        self.assertEqual(2, legacy['usna0']['g'])
+        self.assertEqual(2, legacy['usna0']['lc']['usna1'])
+        self.assertEqual(-2, legacy['usna0']['lc']['usna2'])
+        self.assertNotIn('usna50', legacy['usna0']['lc'])
+
+    def test_compact(self):
+        sparse = PairTracker()
+        sparse.notify_join('a')
+        sparse.notify_join('b')
+        for i in range(100):
+            # Every choice after a join starts a new run, but the joins of players who left separate nothing.
+            sparse.notify_join(f'usna{i}')
+            sparse.notify_chosen('a', 'b')
+            sparse.notify_leave(f'usna{i}')
+        d = sparse.to_dict()
+        self.assertLessEqual(len(d['u']['a']['c']), 2 * 3)
+        version = sparse.version
+        sparse.get_weights('a')
+        sparse.to_legacy_dict()
+        self.assertEqual(d, sparse.to_dict())
+        self.assertEqual(version, sparse.version)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,33 @@
 # Run as: ./tests.py
 
 import bot  # check whether the file parses
+import botstate
+import contextlib
+import datetime
+import flusher
+import fuzz
+import games
+import io
+import journal
+import json
 import logic
+import matrix
+import migrate_storage
+import mock_bot_api
 import msg  # check keyset
+import os
+import players
+import random
+import randomness
+import replay
+import sampler
 import secret  # need MESSAGES_SHEET, ugh
+import snapshot
+import storage
+import telegram
+import tempfile
+import test_generator
+import threading
 import unittest
 
 
@@ -71,6 +95,840 @@ class TestMigration(unittest.TestCase):
                 }
             })
 
+    def test_schema_versions(self):
+        v0 = {'joined_users': {'usna1': 'fina1', 'usna2': 'fina2'}, 'last_chooser': None, 'last_chosen': None,
+              'last_wop': None, 'init_datetime': 1234}
+        self.assertEqual(0, logic.schema_version(v0))
+        v2 = logic.MIGRATIONS[0](v0)
+        self.assertEqual(2, logic.schema_version(v2))
+        current = logic.migrate(v2)
+        self.assertEqual(logic.SCHEMA_VERSION, current['schema_version'])
+        self.assertIs(current, logic.migrate(current))
+        self.assertEqual({'-1': ['usna1', 'fina1'], '-2': ['usna2', 'fina2']}, current['players'])
+        self.assertEqual(logic.SCHEMA_VERSION, logic.OngoingGame.from_dict(v0).to_dict()['schema_version'])
+        with self.assertRaises(ValueError):
+            logic.migrate(dict(current, schema_version=logic.SCHEMA_VERSION + 1))
+
+    def test_migrate_storage(self):
+        v1 = {'joined_users': {'usna1': 'fina1', 'usna2': 'fina2'}, 'last_chooser': ['usna1', 'fina1'],
+              'last_chosen': ['usna2', 'fina2'], 'last_wop': 'w', 'init_datetime': 1234,
+              'track_overall': {'g': 2, 'lc': {'usna1': -2, 'usna2': 2}},
+              'track_individual': {'usna1': {'g': 2, 'lc': {'usna2': 2}}, 'usna2': {'g': 1, 'lc': {'usna1': -2}}}}
+        chat_id, migrated, error = migrate_storage.migrate_game((-123, v1))
+        self.assertEqual((-123, None), (chat_id, error))
+        self.assertEqual((-1, -2), (migrated['last_chooser'], migrated['last_chosen']))
+        self.assertEqual(migrated, logic.OngoingGame.from_dict(migrated).to_dict())
+        self.assertIsNotNone(migrate_storage.migrate_game((5, {'joined_users': {}}))[2])
+
+
+class TestVersion(unittest.TestCase):
+    def test_readonly(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        initial_version = game.version
+        for command in ['who', 'players', 'uptime', 'whytho', 'random', 'do_w', 'leave', 'unknown_command']:
+            with self.subTest(command=command):
+                logic.handle(game, command, '', 'fina', 'usna')
+                self.assertEqual(initial_version, game.version)
+
+    def test_mutating(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        sequence = [
+            ('join', '', 'fina1', 'usna1'),
+            ('join', '', 'fina2', 'usna2'),
+            ('random', '', 'fina1', 'usna1'),
+            ('wop', '', 'fina2', 'usna2'),
+            ('kick', '', 'fina1', 'usna1'),
+        ]
+        for query in sequence:
+            with self.subTest(query=query):
+                version_before = game.version
+                logic.handle(game, *query)
+                self.assertLess(version_before, game.version)
+                version_before = game.version
+                logic.handle(game, 'who', '', query[2], query[3])
+                logic.handle(game, 'show_random', '', query[2], query[3])
+                self.assertEqual(version_before, game.version)
+
+
+def apply_to_game(game, action, *keys):
+    """Applies an action of test_generator.random_walk(), with the keys as user ids."""
+    if action == 'join':
+        game.notify_join(f'usna{keys[0]}', 'fina', keys[0])
+    elif action == 'leave':
+        game.notify_leave(keys[0])
+    else:
+        game.notify_chosen(*keys, 'test')
+
+
+class FixedRandom:
+    def __init__(self, r):
+        self.r = r
+
+    def randrange(self, total):
+        assert 0 <= self.r < total
+        return self.r
+
+
+class TestFenwickSampler(unittest.TestCase):
+    def check_draws(self, game):
+        for chooser in game.joined_users.keys():
+            weights = game.compute_weigths_for(chooser)
+            total = sum(weights.values())
+            begin = 0
+            for candidate, weight in weights.items():
+                for r in [begin, begin + weight - 1] if weight else []:
+                    self.assertEqual((candidate, weight, total), game.sampler.draw(chooser, FixedRandom(r), logic.OVERALL_WEIGHT, logic.INDIVIDUAL_WEIGHT))
+                begin += weight
+
+    def test_same_weights(self):
+        rng = random.Random('Static seed for reproducible randomness, do not change')
+        game = logic.OngoingGame(sampler_kind='fenwick')
+        for step, *action in test_generator.random_walk(rng, 400, 20, lambda: list(game.joined_users.keys())):
+            with self.subTest(step=step):
+                apply_to_game(game, *action)
+                if len(game.joined_users) >= 2:
+                    self.check_draws(game)
+                if step % 50 == 0:
+                    game = logic.OngoingGame.from_dict(json.loads(json.dumps(game.to_dict())))
+                    game.sampler = sampler.FenwickSampler(game)
+
+    def test_reproducible(self):
+        responses = []
+        for _ in range(2):
+            game = logic.OngoingGame('Static seed for reproducible randomness, do not change', 'fenwick')
+            for username in ['usna1', 'usna2', 'usna3']:
+                logic.handle(game, 'join', '', 'fina', username)
+            chooser = 'usna1'
+            run = []
+            for _ in range(20):
+                response = logic.handle(game, 'random', '', 'fina', chooser)
+                run.append(response)
+                chooser = response[1]
+                logic.handle(game, 'do_w', '', 'fina', chooser)
+            responses.append(run)
+        self.assertEqual(responses[0], responses[1])
+        self.assertEqual({'random_chosen'}, {response[0] for response in responses[0]})
+
+
+class TestReason(unittest.TestCase):
+    def test_persisted(self):
+        game = logic.OngoingGame(seed=1)
+        for i in range(3):
+            game.notify_join(f'usna{i}', f'fina{i}', i)
+        logic.compute_random(game, '', 'fina0', 'usna0', 0)
+        text = logic.render_reason(game.last_reason)
+        self.assertTrue(text.startswith('random[('), text)
+        d = json.loads(json.dumps(game.to_dict()))
+        self.assertEqual(text, logic.render_reason(logic.OngoingGame.from_dict(d).last_reason))
+
+    def test_bounded(self):
+        game = logic.OngoingGame(seed=1)
+        for i in range(logic.REASON_MAX_CANDIDATES + 5):
+            game.notify_join(f'usna{i}', f'fina{i}', i)
+        chosen = logic.compute_random(game, '', 'fina0', 'usna0', 0)[1]
+        self.assertEqual(logic.REASON_MAX_CANDIDATES, len(game.last_reason['c']))
+        self.assertTrue(logic.render_reason(game.last_reason).endswith(', … and 4 more]'))
+        game.last_wop = 'w'  # So that the chosen player may choose next
+        chosen_id = game.joined_users.find_by_username(chosen)
+        logic.compute_true_random(game, '', game.joined_users[chosen_id], chosen, chosen_id)
+        expected = [f'fina{i}' for i in range(logic.REASON_MAX_CANDIDATES + 1) if f'usna{i}' != chosen][:logic.REASON_MAX_CANDIDATES]
+        self.assertEqual(f'true_random{expected}'[:-1] + ', … and 4 more]', logic.render_reason(game.last_reason))
+
+
+class TestRandomness(unittest.TestCase):
+    def test_same_as_random(self):
+        fast = randomness.GameRandom('seed', reseed=False)
+        reference = random.Random('seed')
+        for rng in [fast, reference]:
+            rng.draws = [rng.random(), rng.choice('abcdef'), rng.randrange(10), rng.choices('abc', [1, 2, 3]),
+                         rng.getrandbits(100), rng.sample(range(20), 3)]
+        self.assertEqual(reference.draws, fast.draws)
+
+    def test_restore(self):
+        rng = randomness.GameRandom()
+        for _ in range(randomness.RESEED_WORDS // 2 + 10):
+            rng.random()
+        self.assertEqual(20, rng.words)  # Reseeded once
+        restored = randomness.GameRandom.from_dict(json.loads(json.dumps(rng.to_dict())))
+        self.assertEqual([rng.choice(range(100)) for _ in range(10)], [restored.choice(range(100)) for _ in range(10)])
+
+    def test_game(self):
+        game = logic.OngoingGame()
+        for i in range(5):
+            game.notify_join(f'usna{i}', f'fina{i}')
+        game.rng.shuffle([1, 2, 3])
+        restored = logic.OngoingGame.from_dict(game.to_dict())
+        self.assertEqual([game.rng.random() for _ in range(3)], [restored.rng.random() for _ in range(3)])
+
+
+class TestPlayerRegistry(unittest.TestCase):
+    def test_registry(self):
+        registry = players.PlayerRegistry.from_dict({'1': ['usna1', 'Fina'], '2': ['usna2', 'bob'], '3': ['usna3', 'alice'], '4': ['usna4', 'fina']})
+        registry.remove(2)
+        self.assertEqual(-1, registry.add(None, 'usna5', 'Carl'))
+        self.assertEqual({1: 'Fina', 3: 'alice', 4: 'fina', -1: 'Carl'}, registry)
+        self.assertEqual(['1', '3', '4', '-1'], list(registry.to_dict().keys()))
+        self.assertEqual(['Carl', 'Fina', 'alice', 'fina'], registry.roster)
+        self.assertEqual('Carl, Fina, alice und fina', registry.render_roster())
+        self.assertEqual(4, registry.find_by_firstname('fina'))
+        self.assertEqual(1, registry.find_by_firstname('FINA'))
+        self.assertEqual(-1, registry.find_by_firstname('carl'))
+        self.assertIsNone(registry.find_by_firstname('bob'))
+        self.assertEqual(3, registry.find_by_username('usna3'))
+        self.assertIsNone(registry.find_by_username('usna2'))
+        picks = [registry.pick_other(FixedRandom(r), 3) for r in range(3)]
+        self.assertEqual([1, 4, -1], picks)  # In join order, like after a restart
+        restored = players.PlayerRegistry.from_dict(registry.to_dict())
+        self.assertEqual(picks, [restored.pick_other(FixedRandom(r), 3) for r in range(3)])
+        registry.remove(1)
+        self.assertEqual(4, registry.find_by_firstname('FINA'))
+        self.assertEqual('Carl, alice und fina', registry.render_roster())
+        registry.rename(4, 'usnd', 'Dora')
+        registry.rekey({-1: 5})
+        self.assertEqual({3: ('usna3', 'alice'), 4: ('usnd', 'Dora'), 5: ('usna5', 'Carl')}, registry.entries)
+        self.assertEqual(4, registry.find_by_username('usnd'))
+        self.assertIsNone(registry.find_by_username('usna4'))
+        self.assertEqual(5, registry.find_by_firstname('carl'))
+        self.assertEqual('Carl, Dora und alice', registry.render_roster())
+        self.assertEqual({3, 4}, {registry.pick_other(FixedRandom(r), 5) for r in range(2)})
+
+    def test_aliases_survive_restart(self):
+        registry = players.PlayerRegistry()
+        self.assertEqual(-1, registry.add(None, 'usna7', 'fina7'))
+        registry.add(7, 'usna7x', 'fina7x')
+        registry.rename(7, 'usna7', 'fina7')  # Now both go by usna7, and the one who joined last wins
+        self.assertEqual(7, registry.find_by_username('usna7'))
+        self.assertIsNone(registry.find_by_username('usna7x'))
+        registry.remove(7)
+        self.assertEqual(-1, registry.find_by_username('usna7'))
+        registry.rekey({-1: 8})
+        self.assertEqual(-1, registry.add(None, 'usna3', 'fina3'))
+        restored = players.PlayerRegistry.from_dict(registry.to_dict())
+        self.assertEqual(registry.by_username, restored.by_username)
+        self.assertEqual(-2, restored.add(None, 'usna4', 'fina4'))
+
+    def test_choose_ignoring_case(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        logic.handle(game, 'join', '', 'Fina', 'usna1')
+        logic.handle(game, 'join', '', 'Alice', 'usna2')
+        self.assertEqual(('chosen_chosen', 'usna2', 'Fina'), logic.handle(game, 'choose', 'alice', 'Fina', 'usna1'))
+
+    def test_user_ids(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        self.assertEqual(('welcome', 'Fina'), logic.handle(game, 'join', '', 'Fina', 'usna1', 11))
+        self.assertEqual(('welcome', 'Alice'), logic.handle(game, 'join', '', 'Alice', 'usna2', 12))
+        self.assertEqual(('chosen_chosen', 'usna2', 'Fina'), logic.handle(game, 'choose', 'alice', 'Fina', 'usna1', 11))
+        # Renaming keeps the state, and the new names are used right away:
+        self.assertEqual(('who_no_wop', 'usnb', 'Fina'), logic.handle(game, 'who', '', 'Bob', 'usnb', 12))
+        self.assertEqual(('dox_w', 'Bob', 'usna1'), logic.handle(game, 'do_w', '', 'Bob', 'usnb', 12))
+        self.assertEqual(('chosen_chosen', 'usna1', 'Bob'), logic.handle(game, 'choose', '@usna1', 'Bob', 'usnb', 12))
+        self.assertEqual(('nonplayer', 'Alice'), logic.handle(game, 'do_w', '', 'Alice', 'usna2', 13))
+        self.assertEqual({11: ('usna1', 'Fina'), 12: ('usnb', 'Bob')}, game.joined_users.entries)
+
+    def test_rename_keeps_join_order(self):
+        # Shrunk by fuzz.py: 1000000005 renames, a provisional player takes over the old names, and then 1000000005
+        # renames back. Both are 'fina5' now, and the one who joined first must be found, also after a restart.
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        logic.handle(game, 'join', '', 'fina5', 'usna5', 1000000005)
+        logic.handle(game, 'random', '', 'fina5x', 'usna5x', 1000000005)
+        logic.handle(game, 'join', '', 'fina5', 'usna5', None)
+        logic.handle(game, 'join', '', 'fina0', 'usna0', 1000000000)
+        logic.handle(game, 'kick', '', 'fina5', 'usna5', 1000000005)
+        restored = logic.OngoingGame.from_dict(json.loads(json.dumps(game.to_dict())))
+        for g in [game, restored]:
+            self.assertEqual({'fina5': [1000000005, -1], 'fina0': [1000000000]}, g.joined_users.by_firstname)
+            self.assertEqual(('chosen_chosen', 'usna5', 'fina0'), logic.handle(g, 'choose', 'FINA5', 'fina0', 'usna0', 1000000000))
+            self.assertEqual(1000000005, g.last_chosen)
+
+    def test_migrate_usernames(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        for username in ['usna1', 'usna2', 'usna3']:
+            logic.handle(game, 'join', '', 'fina', username)
+        logic.handle(game, 'choose', 'usna2', 'fina', 'usna1')
+        d = game.to_dict()
+        # As written by older versions:
+        legacy = dict(d, joined_users={'usna1': 'fina', 'usna2': 'fina', 'usna3': 'fina'}, last_chooser=['usna1', 'fina'],
+                      last_chosen=['usna2', 'fina'], track_overall=game.track_overall.to_dict(lambda key: game.username(key)),
+                      track_pairs=game.track_individual.to_dict(lambda key: game.username(key)))
+        del legacy['players']
+        del legacy['schema_version']
+        migrated = logic.OngoingGame.from_dict(legacy)
+        self.assertEqual(d, migrated.to_dict())
+        # The provisional keys are replaced by the user ids as soon as the players write:
+        self.assertEqual(('dox_w', 'fina', 'usna1'), logic.handle(migrated, 'do_w', '', 'fina', 'usna2', 22))
+        self.assertEqual(('random_chosen', 'usna3'), logic.handle(migrated, 'random', '', 'fina', 'usna2', 22))  # Relies on seeded RNG
+        self.assertEqual({-1: 'fina', 22: 'fina', -3: 'fina'}, migrated.joined_users)
+        self.assertEqual((22, -3), (migrated.last_chooser, migrated.last_chosen))
+        self.assertEqual(2, migrated.track_individual.choosers[22].generation)
+
+
+class TestWeightCache(unittest.TestCase):
+    def test_hits(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        for username in ['usna1', 'usna2', 'usna3']:
+            logic.handle(game, 'join', '', 'fina', username)
+        before = logic.WEIGHT_CACHE_STATS.copy()
+        first = logic.handle(game, 'show_random', '', 'fina', 'usna1')
+        logic.handle(game, 'show_random', 'usna2', 'fina', 'usna1')
+        self.assertEqual(first, logic.handle(game, 'show_random', '', 'fina', 'usna1'))
+        self.assertEqual(None, game.weight_cache.get(game.joined_users.find_by_username('usna3')))
+        self.assertEqual(1, logic.WEIGHT_CACHE_STATS['hits'] - before['hits'])
+        self.assertEqual(2, logic.WEIGHT_CACHE_STATS['misses'] - before['misses'])
+        logic.handle(game, 'random', '', 'fina', 'usna1')
+        self.assertEqual(2, logic.WEIGHT_CACHE_STATS['hits'] - before['hits'])
+        # Choosing invalidates everything:
+        self.assertNotEqual(first, logic.handle(game, 'show_random', '', 'fina', 'usna1'))
+        self.assertEqual(3, logic.WEIGHT_CACHE_STATS['misses'] - before['misses'])
+        logic.handle(game, 'join', '', 'fina', 'usna4')
+        self.assertIn('usna4', logic.handle(game, 'show_random', '', 'fina', 'usna1')[1])
+        self.assertNotIn('weight_cache', game.to_dict())
+
+
+class TestMatrix(unittest.TestCase):
+    def test_weights(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        for user_id in [1, 2, 3]:
+            game.notify_join(f'usna{user_id}', 'fina', user_id)
+        game.notify_chosen(1, 2, 'test')
+        game.notify_join('usna4', 'fina', 4)
+        game.notify_chosen(2, 4, 'test')
+        game.notify_leave(3)
+        engines = [False] if matrix.numpy is None else [False, True]
+        for use_numpy in engines:
+            with self.subTest(use_numpy=use_numpy):
+                usernames, weights = matrix.weight_matrix(game, use_numpy)
+                self.assertEqual(['usna1', 'usna2', 'usna4'], usernames)
+                for chooser, row in zip([1, 2, 4], weights):
+                    expected = game.compute_weigths_for(chooser)
+                    self.assertEqual([expected.get(candidate, 0) for candidate in [1, 2, 4]], row)
+                self.assertEqual(0, weights[1][1])
+        [text] = matrix.format_matrix(*matrix.weight_matrix(game))
+        self.assertEqual(4, len(text.split('\n')))
+
+    def test_large_room(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        for user_id in range(100):
+            game.notify_join(f'a_rather_long_username_number_{user_id}', 'fina', user_id)
+        usernames, weights = matrix.weight_matrix(game)
+        messages = matrix.format_matrix(usernames, weights)
+        self.assertTrue(all(len(text) <= matrix.MAX_MESSAGE_LENGTH for text in messages))
+        lines = '\n'.join(messages).split('\n')
+        self.assertEqual(1 + matrix.MAX_PLAYERS + 1, len(lines))
+        self.assertEqual(matrix.MAX_PLAYERS, len(lines[1].split(': ')[1].split()))
+        self.assertEqual('(Nur die ersten 20 von 100 Spielern)', lines[-1])
+        split = matrix.format_matrix(usernames, weights, max_length=1000)
+        self.assertGreater(len(split), 1)
+        self.assertTrue(all(len(text) <= 1000 for text in split))
+        self.assertEqual(lines, '\n'.join(split).split('\n'))
+
+    @unittest.skipIf(matrix.numpy is None, 'NumPy is not installed')
+    def test_numpy_like_python(self):
+        rng = random.Random('Static seed for reproducible randomness, do not change')
+        game = logic.OngoingGame()
+        for _, *action in test_generator.random_walk(rng, 300, 15, lambda: list(game.joined_users.keys()), 2):
+            apply_to_game(game, *action)
+            self.assertEqual(matrix.weight_matrix(game, False), matrix.weight_matrix(game, True))
+
+
+def journal_lines(records):
+    return [journal.Journal.encode_fragment(chat_id, json.dumps(game_dict)) for chat_id, game_dict in records]
+
+
+class TestJournal(unittest.TestCase):
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'journal')
+            j1 = journal.Journal(filename)
+            self.assertEqual({}, j1.replay())
+            j1.write(journal_lines([(12, {'x': 1}), (34, {'y': 2})]))
+            j1.write(journal_lines([(12, {'x': 3})]))
+            j1.write(journal_lines([(34, None)]))
+            j2 = journal.Journal(filename)
+            self.assertEqual({12: {'x': 3}, 34: None}, j2.replay())
+            self.assertEqual(4, j2.entries)
+            j2.rotate()
+            j2.write(journal_lines([(56, {'z': 4})]))
+            j3 = journal.Journal(filename)
+            self.assertEqual({12: {'x': 3}, 34: None, 56: {'z': 4}}, j3.replay())  # The old entries first
+            self.assertEqual(1, j3.entries)
+            j3.drop_old()
+            self.assertEqual({56: {'z': 4}}, journal.Journal(filename).replay())
+
+    def test_torn_write(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'journal')
+            j1 = journal.Journal(filename)
+            j1.write(journal_lines([(12, {'x': 1})]))
+            with open(filename, 'a') as fp:
+                fp.write('{"c":12,"g":{"x"')
+            j2 = journal.Journal(filename)
+            self.assertEqual({12: {'x': 1}}, j2.replay())
+            j2.write(journal_lines([(34, {'y': 2})]))
+            self.assertEqual({12: {'x': 1}, 34: {'y': 2}}, journal.Journal(filename).replay())
+
+
+class TestSnapshot(unittest.TestCase):
+    def check_roundtrip(self, value):
+        data = snapshot.encode(value)
+        self.assertTrue(snapshot.is_snapshot(data))
+        self.assertEqual(value, snapshot.decode(data))
+
+    def test_values(self):
+        for value in [None, True, False, 0, 1, -1, 63, -64, 64, 2 ** 70, -2 ** 70, 0.0, -1.5, 1792241026.498145,
+                      '', 'usna', 'Größenwahn 🐓', [], {}, [1, 'a', None], {'a': {'b': [1, 2, {'c': 'a'}]}, 12: -3}]:
+            with self.subTest(value=value):
+                self.check_roundtrip(value)
+
+    def test_games(self):
+        game = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        for i in range(1, 6):
+            logic.handle(game, 'join', '', f'fina{i}', f'usna{i}')
+        logic.handle(game, 'random', '', 'fina1', 'usna1')
+        games = {-1001234: game.to_dict(), 5: logic.OngoingGame().to_dict()}
+        decoded = snapshot.decode(snapshot.encode(games))
+        # Tuples become lists, exactly like with JSON:
+        self.assertEqual(json.loads(json.dumps(games[5])), decoded[5])
+        self.assertEqual(json.loads(json.dumps(games[-1001234])), decoded[-1001234])
+
+    def test_indexed(self):
+        records = {-1001234: snapshot.encode_record({'a': [1, 'b']}), 5: snapshot.encode_record('b'), 0: snapshot.encode_record(None)}
+        data = snapshot.encode_indexed(records)
+        indexed = snapshot.IndexedSnapshot(data)
+        self.assertEqual([-1001234, 5, 0], list(indexed.chat_ids()))
+        self.assertEqual('b', indexed.load(5))
+        self.assertEqual({'a': [1, 'b']}, indexed.load(-1001234))
+        self.assertEqual(records[0], indexed.raw(0))
+        self.assertEqual({-1001234: {'a': [1, 'b']}, 5: 'b', 0: None}, snapshot.decode(data))
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.IndexedSnapshot(snapshot.encode({}))
+
+    def test_errors(self):
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.decode(b'{"12": {}}')
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.decode(snapshot.encode({}) + b'x')
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.encode({'a': object()})
+
+
+class TestStorage(unittest.TestCase):
+    def storage_factories(self, tmpdir):
+        return [
+            lambda: storage.SnapshotStorage(os.path.join(tmpdir, 'data.json'), os.path.join(tmpdir, 'data.journal'), 3, 'json'),
+            lambda: storage.SnapshotStorage(os.path.join(tmpdir, 'data.wops'), os.path.join(tmpdir, 'data.wops.journal'), 3, 'binary'),
+            lambda: storage.SqliteStorage(os.path.join(tmpdir, 'data.sqlite')),
+            lambda: storage.ShardedStorage(os.path.join(tmpdir, 'data.d')),
+        ]
+
+    def check_storage(self, make_storage):
+        game1 = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        logic.handle(game1, 'join', '', 'fina1', 'usna1')
+        game2 = logic.OngoingGame('Static seed for reproducible randomness, do not change')
+        st = make_storage()
+        self.assertEqual({}, st.load())
+        st.write_all({12: game1.to_dict(), 34: game2.to_dict()})
+        logic.handle(game1, 'join', '', 'fina2', 'usna2')
+        st.write({12: game1.to_dict(), 34: None})
+        st.close()
+        st = make_storage()
+        loaded = st.load()
+        self.assertEqual({12}, set(loaded.keys()))
+        self.assertEqual(game1.to_dict(), logic.OngoingGame.from_dict(loaded[12]).to_dict())
+        self.assertEqual({}, st.load([34, 56]))
+        st.write({56: game2.to_dict()})
+        self.assertEqual({12, 56}, set(make_storage().load().keys()))
+        st.close()
+
+    def test_storages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for make_storage in self.storage_factories(tmpdir):
+                with self.subTest(storage=make_storage()):
+                    self.check_storage(make_storage)
+
+    def test_sharded_write_all(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dirname = os.path.join(tmpdir, 'data.d')
+            st = storage.ShardedStorage(dirname)
+            game_dict = logic.OngoingGame().to_dict()
+            st.write({12: game_dict, 34: game_dict})
+            st.write_all({56: game_dict})
+            self.assertEqual(['56.json', 'manifest.json'], sorted(os.listdir(dirname)))
+            self.assertEqual({56: game_dict}, storage.ShardedStorage(dirname).load())
+
+    def test_json_wants_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            st = storage.SnapshotStorage(os.path.join(tmpdir, 'data.json'), os.path.join(tmpdir, 'data.journal'), 3)
+            st.write({12: None, 34: None})
+            self.assertFalse(st.wants_snapshot)
+            st.write({12: None})
+            self.assertTrue(st.wants_snapshot)
+            st.write_all({})
+            self.assertFalse(st.wants_snapshot)
+
+    def test_json_fragments(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'data.json')
+            make_storage = lambda: storage.SnapshotStorage(filename, os.path.join(tmpdir, 'data.journal'), 1000)
+            game_dict = logic.OngoingGame().to_dict()
+            # Files written by older versions are still read:
+            with open(filename, 'w') as fp:
+                json.dump({'12': game_dict, '34': game_dict}, fp, indent=1)
+            st = make_storage()
+            self.assertEqual({12: game_dict, 34: game_dict}, st.load())
+            st.write_all({12: storage.UNCHANGED, 34: storage.UNCHANGED})
+            with open(filename, 'r') as fp:
+                self.assertEqual(4, len(fp.readlines()))
+            self.assertEqual({12: game_dict, 34: game_dict}, st.load())
+            self.assertEqual({12, 34}, set(st.fragments.keys()))
+            # Unchanged games are written back verbatim, without encoding them again:
+            st.fragments[12] = '{"reused":true}'
+            st.write({34: None})
+            st.write_all({12: storage.UNCHANGED, 56: game_dict})
+            self.assertEqual({12: {'reused': True}, 56: game_dict}, make_storage().load())
+
+    def test_background_write_all(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for snapshot_format in ['json', 'binary']:
+                with self.subTest(snapshot_format=snapshot_format):
+                    filename = os.path.join(tmpdir, f'data.{snapshot_format}')
+                    journal_filename = os.path.join(tmpdir, f'{snapshot_format}.journal')
+                    make_storage = lambda: storage.SnapshotStorage(filename, journal_filename, 1000, snapshot_format)
+                    old_dict = logic.OngoingGame().to_dict()
+                    game = logic.OngoingGame()
+                    game.notify_join('usna', 'fina')
+                    new_dict = game.to_dict()
+                    st = make_storage()
+                    st.write_all({12: old_dict, 34: old_dict})
+                    st.write({34: new_dict})
+                    write = st.begin_write_all({12: storage.UNCHANGED, 34: storage.UNCHANGED})
+                    st.write({12: new_dict, 56: old_dict})
+                    # If the bot dies now, neither the old snapshot nor the journals lose anything:
+                    expected = {12: new_dict, 34: new_dict, 56: old_dict}
+                    self.assertEqual(expected, make_storage().load())
+                    write()
+                    self.assertFalse(os.path.exists(journal_filename + '.old'))
+                    self.assertEqual(expected, st.load())
+                    self.assertEqual(expected, make_storage().load())
+                    st.close()
+
+
+class TestGameStore(unittest.TestCase):
+    def make_store(self, tmpdir, capacity):
+        st = storage.SnapshotStorage(os.path.join(tmpdir, 'data.wops'), os.path.join(tmpdir, 'data.journal'), 1000, 'binary')
+        game_dicts = dict()
+        for chat_id in range(5):
+            game = logic.OngoingGame()
+            game.notify_join(f'usna{chat_id}', f'fina{chat_id}')
+            game_dicts[chat_id] = game.to_dict()
+        st.write_all(game_dicts)
+        store = games.GameStore(st, capacity)
+        store.load()
+        return store
+
+    def test_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = self.make_store(tmpdir, None)
+            self.assertEqual(5, len(store))
+            self.assertIn(3, store)
+            self.assertNotIn(7, store)
+            self.assertEqual(0, store.hydrations)
+            self.assertEqual({-1: ('usna3', 'fina3')}, store[3].joined_users.entries)
+            self.assertEqual({-1: ('usna3', 'fina3')}, store[3].joined_users.entries)
+            self.assertEqual(1, store.hydrations)
+            self.assertEqual({0, 1, 2, 3, 4}, set(store.keys()))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = self.make_store(tmpdir, 2)
+            for chat_id in range(5):
+                store[chat_id]
+            self.assertEqual([3, 4], list(store.hydrated.keys()))
+            self.assertEqual(3, store.evictions)
+            # Dirty games must not be evicted before they are written:
+            store[0].notify_join('usnb', 'finb')
+            store[1].notify_join('usnb', 'finb')
+            store[2]
+            self.assertEqual([0, 1, 2], list(store.hydrated.keys()))
+            changes, versions = store.collect([0, 1])
+            store.storage.write(changes)
+            store.mark_saved(versions)
+            self.assertEqual([1, 2], list(store.hydrated.keys()))
+            self.assertEqual({-1: ('usna0', 'fina0'), -2: ('usnb', 'finb')}, store[0].joined_users.entries)
+
+    def test_write_all(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = self.make_store(tmpdir, None)
+            store[1].notify_join('usnb', 'finb')
+            store[2] = logic.OngoingGame()
+            del store[3]
+            all_games, versions = store.collect_all()
+            self.assertIs(storage.UNCHANGED, all_games[0])
+            store.storage.write_all(all_games)
+            store.mark_saved(versions)
+            store.load()
+            self.assertEqual({0, 1, 2, 4}, set(store.keys()))
+            self.assertEqual({-1: ('usna1', 'fina1'), -2: ('usnb', 'finb')}, store[1].joined_users.entries)
+            self.assertEqual({}, store[2].joined_users.entries)
+            self.assertEqual({-1: ('usna4', 'fina4')}, store[4].joined_users.entries)
+
+    def test_cold(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = self.make_store(tmpdir, None)
+            for chat_id in range(5):
+                store[chat_id]
+            logic.handle(store[1], 'join', '', 'finb', 'usnb')
+            store[0].last_activity -= datetime.timedelta(days=10)
+            store[1].last_activity -= datetime.timedelta(days=10)
+            store[2]
+            store.demote_idle(datetime.timedelta(days=5))
+            # Game 1 is idle, but dirty:
+            self.assertEqual([0], list(store.cold.keys()))
+            self.assertEqual([3, 4, 1, 2], list(store.hydrated.keys()))
+            stats = store.tier_stats()
+            self.assertEqual(4, stats['hot'][0])
+            self.assertEqual(1, stats['cold'][0])
+            self.assertEqual(5, len(store))
+            all_games, _ = store.collect_all()
+            self.assertIs(storage.UNCHANGED, all_games[0])
+            self.assertEqual({-1: ('usna0', 'fina0')}, store[0].joined_users.entries)
+            self.assertEqual([], list(store.cold.keys()))
+
+
+class TestFlusher(unittest.TestCase):
+    def test_fsync(self):
+        writes = []
+        f = flusher.Flusher(lambda *args: writes.append(args), 'fsync')
+        f.start()
+        f.mark_dirty(12)
+        self.assertEqual([({12}, False)], writes)
+        f.request_snapshot()
+        self.assertEqual([({12}, False), (set(), True)], writes)
+        f.stop()
+        self.assertEqual(2, len(writes))
+
+    def test_group(self):
+        writes = []
+        f = flusher.Flusher(lambda *args: writes.append(args), 'group', window=60, max_changes=3)
+        f.start()
+        f.mark_dirty(12)
+        f.mark_dirty(34)
+        f.mark_dirty(12)
+        self.assertEqual([], writes)
+        f.stop()
+        self.assertEqual([({12, 34}, False)], writes)
+
+    def test_retry(self):
+        writes = []
+        def write_fn(*args):
+            writes.append(args)
+            if len(writes) == 1:
+                raise OSError('Disk full')
+        f = flusher.Flusher(write_fn, 'periodic', window=60)
+        f.mark_dirty(12)
+        with self.assertRaises(OSError):
+            f.flush()
+        f.mark_dirty(34)
+        f.flush()
+        self.assertEqual([({12}, False), ({12, 34}, False)], writes)
+
+
+class TestSnapshotWriter(unittest.TestCase):
+    def test_one_at_a_time(self):
+        events = []
+        release = threading.Event()
+        def slow_write():
+            events.append('begin slow')
+            release.wait()
+            events.append('end slow')
+        def failing_write():
+            raise OSError('Disk full')
+        w = flusher.SnapshotWriter()
+        self.assertEqual('No snapshot written yet.', w.stats())
+        w.start(slow_write)
+        self.assertIn('one is running', w.stats())
+        threading.Timer(0.1, release.set).start()
+        w.start(lambda: events.append('fast'))
+        w.wait()
+        self.assertEqual(['begin slow', 'end slow', 'fast'], events)
+        self.assertTrue(w.stats().startswith('Last snapshot took'))
+        w.start(failing_write)
+        w.wait()
+        self.assertEqual(1, w.failures)
+        self.assertIsNotNone(w.last_finished)
+
+
+class SlowSnapshotStorage(storage.SnapshotStorage):
+    def __init__(self, *args, release):
+        super().__init__(*args)
+        self.release = release
+
+    def begin_write_all(self, games):
+        write = super().begin_write_all(games)
+        def slow_write():
+            self.release.wait()
+            write()
+        return slow_write
+
+
+class TestBotState(unittest.TestCase):
+    def test_owner_commands(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            st = storage.SnapshotStorage(os.path.join(tmpdir, 'data.json'), os.path.join(tmpdir, 'data.journal'), 1000)
+            state = botstate.BotState(games.GameStore(st), 'fsync')
+            with state.lock:
+                self.assertEqual([1, 0, 1], [state.apply_owner_command('permit', chat_id) for chat_id in [12, 12, 34]])
+                self.assertIsNotNone(state.handle(12, 'join', '', 'fina1', 'usna1', 1000000001))
+                self.assertEqual(2, state.apply_owner_command('resetall', 56))
+                self.assertEqual(0, state.apply_owner_command('resethere', 56))
+                self.assertEqual(1, state.apply_owner_command('deny', 34))
+                self.assertEqual(0, state.apply_owner_command('deny', 34))
+                self.assertEqual([12], list(state.ongoing_games.keys()))
+            state.stop()
+            self.assertEqual({}, st.load()[12]['players'])  # Reset by resetall
+            with state.lock:
+                self.assertEqual(1, state.apply_owner_command('denyall', 12))
+            state.stop()
+            self.assertEqual({}, st.load())
+            st.close()
+
+
+class TestSaveUnderLock(unittest.TestCase):
+    def test_fsync(self):
+        # Handlers request snapshots while holding the lock, and in 'fsync' mode, the flusher writes them right away.
+        release = threading.Event()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            st = SlowSnapshotStorage(os.path.join(tmpdir, 'data.json'), os.path.join(tmpdir, 'data.journal'), 1000,
+                                     release=release)
+            store = games.GameStore(st)
+            state = botstate.BotState(store, 'fsync')
+            def resetall_twice():
+                with state.lock:
+                    store[12] = logic.OngoingGame()
+                    state.flusher.request_snapshot([12])
+                    threading.Timer(0.1, release.set).start()  # Only while we still hold the lock
+                    store[34] = logic.OngoingGame()
+                    state.flusher.request_snapshot([34])
+            handler = threading.Thread(target=resetall_twice, daemon=True)
+            handler.start()
+            handler.join(5)
+            self.assertFalse(handler.is_alive(), 'Deadlocked')
+            state.snapshots.wait()
+            def snapshot_chat_ids():
+                with open(st.filename) as fp:
+                    return sorted(int(chat_id) for chat_id in json.load(fp).keys())
+            self.assertEqual([12], snapshot_chat_ids())  # The second snapshot was put off ...
+            state.flusher.mark_dirty(34)
+            state.snapshots.wait()
+            self.assertEqual([12, 34], snapshot_chat_ids())  # ... until the next flush.
+            state.flusher.flush()  # Marks the last snapshot as saved
+            self.assertTrue(store.is_clean(12) and store.is_clean(34))
+            st.close()
+
+
+class TestMockBotApi(unittest.TestCase):
+    def test_roundtrip(self):
+        replies = []
+        api = mock_bot_api.MockBotApi('127.0.0.1', 0, lambda *reply: replies.append(reply))
+        api.start()
+        try:
+            client = telegram.Bot('123:TOKEN', base_url=f'http://127.0.0.1:{api.server.server_address[1]}/bot')
+            self.assertEqual('der_wopper_bot', client.username)
+            self.assertEqual([], client.get_updates(timeout=0))
+            user = {'id': 1000000001, 'first_name': 'fina1', 'username': 'usna1'}
+            message_id = api.push_command(-1234, user, '/choose @usna2')
+            self.assertEqual(1, api.backlog())
+            updates = client.get_updates(timeout=0)
+            self.assertEqual(1, len(updates))
+            self.assertEqual(0, api.backlog())
+            self.assertEqual(('/choose @usna2', 'usna1', -1234), (updates[0].message.text, updates[0].effective_user.username, updates[0].effective_chat.id))
+            entity = updates[0].message.entities[0]
+            self.assertEqual(('bot_command', 0, 7), (entity.type, entity.offset, entity.length))
+            self.assertEqual(1, len(client.get_updates(timeout=0)))  # Not confirmed yet
+            self.assertEqual([], client.get_updates(offset=updates[0].update_id + 1, timeout=0))
+            updates[0].message.reply_text('Hallo', quote=True)
+            self.assertEqual([(-1234, message_id, 'Hallo')], [reply[:3] for reply in replies])
+        finally:
+            api.stop()
+
+
+class TestReplay(unittest.TestCase):
+    def test_extract(self):
+        lines = [
+            "2021-11-20 21:30:00,250 - telegram.ext.dispatcher - DEBUG - Processing Update: {'update_id': 7, 'message': {'message_id': 3, 'chat': {'id': -1234, 'type': 'group'}, 'text': '/choose@der_wopper_bot @usna2', 'from': {'id': 1000000001, 'first_name': 'fina1', 'is_bot': False, 'username': 'usna1'}}}\n",
+            "2021-11-20 21:30:01,000 - telegram.ext.dispatcher - DEBUG - Processing Update: {'update_id': 8, 'message': {'message_id': 4, 'chat': {'id': -1234, 'type': 'group'}, 'text': 'Ich nicht', 'from': {'id': 1000000002, 'first_name': 'fina2', 'is_bot': False}}}\n",
+            "2021-11-20 21:30:01,500 - telegram.bot - DEBUG - Entering: get_updates\n",
+            '{"t": 1637440202.0, "chat_id": -1234, "user_id": 1000000002, "username": null, "firstname": "fina2", "command": "chicken", "argument": ""}\n',
+        ]
+        events = list(replay.extract(lines))
+        self.assertEqual([(-1234, 1000000001, 'usna1', 'fina1', 'choose', '@usna2'), (-1234, 1000000002, None, 'fina2', 'chicken', '')],
+                         [event[1:] for event in events])
+        self.assertEqual(('chicken', 'x y'), replay.parse_command('/NOPE x y'))
+        self.assertIsNone(replay.parse_command('hallo /join'))
+
+    def test_replay(self):
+        events = [replay.Event(i, -1234, 1000000000 + user, f'usna{user}', f'fina{user}', command, '')
+                  for i, (user, command) in enumerate([(1, 'join'), (0, 'permit'), (1, 'join'), (2, 'join'), (1, 'random'), (2, 'players')])]
+        events[1] = events[1]._replace(username=secret.OWNER)
+        with tempfile.TemporaryDirectory() as dirname:
+            replayer = replay.Replayer(dirname, None, 'fsync', 0, 1, False)
+            self.assertEqual(len(events), len(replayer.run(events, 0)))
+            state = replayer.state()
+            self.assertEqual([-1234], list(state.keys()))
+            self.assertEqual({'1000000001': ['usna1', 'fina1'], '1000000002': ['usna2', 'fina2']}, state[-1234]['players'])
+            self.assertEqual({'(not permitted)': 1, 'permit': 1, 'join': 2, 'random': 1, 'players': 1}, dict(replayer.counts))
+            self.assertEqual(replay.comparable(state[-1234]), replay.comparable(replayer.storage.load()[-1234]))  # Written
+            replayer.storage.close()
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(0, replay.diff_states(state, state))
+                self.assertEqual(1, replay.diff_states(dict(), state))
+
+
+class OffByOneGame(logic.OngoingGame):
+    __slots__ = ()
+
+    def compute_weigths_for(self, sender):
+        weights = dict(super().compute_weigths_for(sender))
+        if len(weights) >= 3:
+            weights[next(iter(weights))] += 1
+        return weights
+
+
+class TestFuzz(unittest.TestCase):
+    def test_candidates(self):
+        for name, candidate in fuzz.CANDIDATES.items():
+            with self.subTest(candidate=name):
+                self.assertEqual([], fuzz.fuzz_batch((name, 0, 20, 40, 1, fuzz.ALIASES)))
+
+    def test_aliases(self):
+        # Renames, provisional players taking over old names, and renaming back: Short sequences rarely get there.
+        self.assertEqual([], fuzz.fuzz_batch(('current', 0, 100, 300, 5, 0.2)))
+        queries = [
+            ('join', '', 'fina5', 'usna5', 1000000005),
+            ('random', '', 'fina5x', 'usna5x', 1000000005),
+            ('join', '', 'fina5', 'usna5', None),
+            ('join', '', 'fina0', 'usna0', 1000000000),
+            ('kick', '', 'fina5', 'usna5', 1000000005),
+            ('choose', 'FINA5', 'fina0', 'usna0', 1000000000),
+        ]
+        for name, candidate in fuzz.CANDIDATES.items():
+            with self.subTest(candidate=name):
+                self.assertIsNone(fuzz.find_mismatch(candidate(), queries))
+
+    def test_shrink(self):
+        class OffByOne(fuzz.Candidate):
+            def make_game(self):
+                return OffByOneGame(fuzz.SEED, 'shuffle')
+        fuzz.CANDIDATES['off_by_one'] = OffByOne
+        try:
+            failures = fuzz.fuzz_batch(('off_by_one', 0, 20, 40, 1, fuzz.ALIASES))
+        finally:
+            del fuzz.CANDIDATES['off_by_one']
+        self.assertTrue(failures)
+        queries = fuzz.shrink(OffByOne(), fuzz.make_sequence(failures[0][0], 40))
+        self.assertEqual(['join'] * 4, [query[0] for query in queries])  # Three players, plus the fourth to compare
+        self.assertEqual('compute_weigths_for', fuzz.find_mismatch(OffByOne(), queries).what)
+        self.assertTrue(fuzz.format_sequence(queries).startswith("self.check_sequence([\n    (('join', '', "))
+
 
 class RandomReplyTests(unittest.TestCase):
     def test(self):